@@ -1,11 +1,12 @@
+import asyncio
+import threading
 import discord
 from discord.ext import commands
 from .my_discord_secrets import MyDiscordSecrets
 import re
 # from MCP31PRINT.printer_driver import PrinterDriver # ★★★ 完全に削除またはコメントアウト
-from MCP31PRINT.image_converter import ImageConverter
 from WebService.client.client import FileSenderClient
-from MCP31PRINT.qr_image_generator import QRImageGenerator
+from MCP31PRINT.receipt_renderer import ReceiptRenderer
 import requests
 import aiohttp
 from MCP31PRINT.text_formatter import format_text_with_url_summary
@@ -31,6 +32,26 @@ intents.guild_messages = True
 
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+# 印刷ジョブはボット側で1ビットラスターまでレンダリングしてから送信する (印刷サーバーの描画負荷を分散)
+# 送信は asyncio.to_thread で並行して行うため、レンダラーはスレッドごとに持つ
+# (ImageConverter やフォントの状態、送信ごとに変える紙幅はスレッド間で共有できない)
+_renderer_local = threading.local()
+
+def get_receipt_renderer() -> ReceiptRenderer:
+    """このスレッドの ReceiptRenderer を返す (フォントサイズは印刷サーバーのワーカーと同じ値にすること)"""
+    renderer = getattr(_renderer_local, "renderer", None)
+    if renderer is None:
+        renderer = _renderer_local.renderer = ReceiptRenderer(font_path=FONT_PATH, font_size=30)
+    return renderer
+
+def send_print_job(source: str, **send_kwargs):
+    """
+    印刷ジョブを送信する。レンダリングと ACK の待機を行うため、asyncio.to_thread から呼び出す。
+    紙幅は印刷サーバーが通知するプリンターの紙幅に自動的に合わせられる。
+    """
+    client = FileSenderClient(renderer=get_receipt_renderer(), source=source)
+    client.send_data(**send_kwargs)
+
 # DM送信済みユーザーIDをメモリにロードする関数
 def load_dm_sent_users() -> list[int]:
     if os.path.exists(DM_SENT_USERS_FILE):
@@ -194,17 +215,6 @@ async def on_message(message: discord.Message):
         # PrinterDriver を bot.py で直接使う必要はないため、インスタンス化しない
         # driver = PrinterDriver() # ★★★ 削除
 
-        # ImageConverter は QRコード結合のために必要なので残す
-        # default_width は PrinterDriver.paper_width_dots の値（通常384）に合わせる
-        converter = ImageConverter(
-            font_path=FONT_PATH,
-            font_size=20,
-            default_width=384 # MCP31PRINT/printer_driver.py の paper_width_dots と同じ値にすること
-        )
-        
-        # FileSenderClient のインスタンス化
-        client = FileSenderClient() 
-
         # ヘッダー情報の生成
         header_text = ""
         if data_structure["type"] == "dm":
@@ -238,44 +248,32 @@ async def on_message(message: discord.Message):
                 if image_bytes:
                     body_image_bytes_list.append(image_bytes)
 
-        # フッター (QRコード画像) の準備と結合
-        footer_qr_images_pil = [] # PIL Imageオブジェクトのリスト
-        qr_generator = QRImageGenerator(font_path=FONT_PATH)
-        if urls_from_content: # urls_from_content を使用
-            for url_data in urls_from_content:
-                qr_data_short = url_data[0]
-                description_short = url_data[1]
-                qr_small_image_pil = qr_generator.generate_qr_with_text(
-                    qr_data_short, 
-                    description_short, 
-                    "output_qr_small.png", 
-                    qr_box_size=4,
-                    qr_border=2
-                )
-                if qr_small_image_pil:
-                    footer_qr_images_pil.append(qr_small_image_pil)
-        
-        combined_qr_image_bytes = None
-        if footer_qr_images_pil:
-            combined_pil_image = converter.combine_images_vertically(footer_qr_images_pil)
-            if combined_pil_image:
-                import io
-                with io.BytesIO() as buffer:
-                    combined_pil_image.save(buffer, format='PNG') # または 'BMP', 'JPEG' などプリンターがサポートする形式
-                    combined_qr_image_bytes = buffer.getvalue()
+        # フッター (QRコード) の準備
+        # 画像にはせず、QRコードのデータと説明文だけを渡す (レンダラーが紙幅の1ビットラスターに直接描画する)
+        footer_qr_entries = [
+            {"data": url_data[0], "caption": url_data[1]}
+            for url_data in (urls_from_content or [])
+        ]
 
         # client.send_data の呼び出し
         print(f"ヘッダーデータをFileSenderClientに送信（最終形式）:\n{header_text.strip()}")
         print(f"本文テキストをFileSenderClientに送信（整形済み）:\n{body_text_to_send.strip()}")
         print(f"添付画像数: {len(body_image_bytes_list)}")
-        print(f"QRコード画像データあり: {combined_qr_image_bytes is not None}")
+        print(f"QRコード数: {len(footer_qr_entries)}")
 
         try:
-            client.send_data(
+            # レンダリング (合成・ディザリング・QRコードの描画) と ACK の待機は同期処理のため、
+            # ボットのイベントループを止めないよう別スレッドで行う
+            await asyncio.to_thread(
+                send_print_job,
+                f"discord:{data_structure.get('channel_name') or data_structure['type']}",
                 header_data={"type": "text", "content": header_text},
                 body_text_message=body_text_to_send, # 整形済みテキスト
                 body_image_bytes_list=body_image_bytes_list if body_image_bytes_list else None,
-                footer_data={"type": "image", "content": combined_qr_image_bytes} if combined_qr_image_bytes else None # QRコードはバイトデータ
+                footer_data={"type": "qr", "content": footer_qr_entries} if footer_qr_entries else None, # QRコードはデータのまま送る
+                body_preformatted=True, # format_text_with_url_summary で整形済み
+                # 再送時の重複判定はメッセージ ID で行う (内容のハッシュでは、同じ内容の別のメッセージまで重複と判定される)
+                idempotency_key=str(message.id)
             )
             print("データをFileSenderClientに正常に送信しました。")
         except Exception as e:
@@ -8,4 +8,5 @@ class PrinterConfig:
     PRINTER_IP: str = "192.168.1.XXX"  # 仮のIPアドレス。実際は継承先で上書き
     PRINTER_PORT: int = 9100         # 一般的なプリンターポート
     PAPER_WIDTH_DOTS: int = 576      # 一般的な80mm幅プリンターのドット数 (例えば、203dpiで80mm幅なら576ドット)
+    PRINTER_DPI: int = 203           # プリンターの解像度 (dpi)
     # その他の設定項目があればここに追加
\ No newline at end of file
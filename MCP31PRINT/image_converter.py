@@ -3,6 +3,43 @@
 from PIL import Image, ImageDraw, ImageFont
 import io
 
+class _BufferReader(io.RawIOBase):
+    """
+    bytes / memoryview をコピーせずに読み出すための読み取り専用ストリーム。
+    io.BytesIO は memoryview を渡すと全体をコピーするため、受信バッファ (mmap を含む) を
+    そのまま Pillow のデコーダーに渡す用途で使用する。
+    """
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self._view.nbytes - self._pos)
+        if n <= 0:
+            return 0
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._view.nbytes + offset
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
 class ImageConverter:
     def __init__(self, font_path: str = None, font_size: int = 24, default_width: int = 576):
         """
@@ -122,19 +159,21 @@ class ImageConverter:
                 print(f"ERROR: 画像保存中にエラーが発生しました: {e}")
         return img
     
-    def image_from_bytes(self, image_bytes: bytes, auto_rotate_for_max_size: bool = False) -> Image.Image | None:
+    def image_from_bytes(self, image_bytes: bytes | memoryview, auto_rotate_for_max_size: bool = False) -> Image.Image | None:
         """
         バイト列形式の画像データをPIL.Imageオブジェクトに変換する。
         必要に応じて、画像を90度回転させて、より大きな表示領域に収まるようにする。
-        :param image_bytes: 画像のバイト列データ (PNG, JPEGなどのファイルデータ)
+        :param image_bytes: 画像のバイト列データ (PNG, JPEGなどのファイルデータ)。
+                            memoryview の場合はコピーせずに受信バッファから直接デコードする。
         :param auto_rotate_for_max_size: Trueの場合、画像の幅がデフォルト幅より小さいが、
                                          高さを幅として回転するとデフォルト幅に近づく場合、画像を90度回転させる。
                                          デフォルトはFalse（回転させない）。
         :return: 変換されたPIL.Imageオブジェクト、またはエラーの場合はNone
         """
         try:
-            img_io = io.BytesIO(image_bytes)
+            img_io = io.BufferedReader(_BufferReader(image_bytes))
             img = Image.open(img_io)
+            img.load() # 遅延デコードのまま受信バッファが解放されないよう、ここでデコードを完了させる
             print(f"DEBUG: Successfully converted bytes to PIL Image. Mode: {img.mode}, Original Size: {img.size}")
 
             if auto_rotate_for_max_size:
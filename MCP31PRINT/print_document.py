@@ -0,0 +1,114 @@
+# print_document.py
+
+from MCP31PRINT.raster import RasterImage, stack_rasters
+
+# プリンター内蔵フォントで印刷するテキストのエンコーディング (print_text_raw と同じ)
+NATIVE_TEXT_ENCODING = 'shift_jis'
+
+# StarPRNT のテキスト関連コマンド
+_KANJI_MODE_ON = b'\x1B\x24\x01'  # ESC $ 1 (Shift JIS 漢字モード)
+_EMPHASIS_ON = b'\x1B\x45'        # ESC E (強調印字)
+_EMPHASIS_OFF = b'\x1B\x46'       # ESC F (強調印字の解除)
+_ALIGN = b'\x1B\x1D\x61'          # ESC GS a n (0: 左寄せ, 1: 中央寄せ, 2: 右寄せ)
+_EXPAND = b'\x1B\x69'             # ESC i n1 n2 (文字の縦倍率 - 1, 横倍率 - 1)
+
+# 内蔵フォント (フォントA) の半角1文字の幅と、1行の送り量 (ドット)
+HALF_WIDTH_CHAR_DOTS = 12
+LINE_HEIGHT_DOTS = 32
+
+def encode_native_text(text: str) -> bytes | None:
+    """
+    テキストをプリンター内蔵フォントで印刷できるバイト列にする。
+    エンコーディングで表せない文字 (絵文字など) や制御文字を含む場合は None を返す。
+    """
+    text = text.replace('\t', '    ').rstrip('\r')
+    if any(ord(char) < 0x20 for char in text):
+        return None
+    try:
+        return text.encode(NATIVE_TEXT_ENCODING)
+    except UnicodeEncodeError:
+        return None
+
+class NativeText:
+    """
+    プリンター内蔵フォント (漢字フォントを含む) で印刷するテキストの行。
+    ラスターに変換せず文字コードのまま送るため、画像として送る場合より送信量と描画の処理が大幅に少ない。
+    行の折り返しはプリンターが紙幅で行う。
+    """
+    def __init__(self, lines: list[bytes], scale: int = 1, emphasis: bool = False, alignment: int = 0):
+        """
+        :param lines: encode_native_text でエンコード済みの行のリスト
+        :param scale: 文字の倍率 (1〜6)
+        :param emphasis: Trueの場合は強調印字する
+        :param alignment: 0: 左寄せ, 1: 中央寄せ, 2: 右寄せ
+        """
+        self.lines = lines
+        self.scale = max(1, min(scale, 6))
+        self.emphasis = emphasis
+        self.alignment = alignment
+
+    def estimate_height(self, paper_width_dots: int) -> int:
+        """印刷される長さ (ドット) の見積もり (プリンターでの折り返しを含む)"""
+        columns = max(1, paper_width_dots // (HALF_WIDTH_CHAR_DOTS * self.scale))
+        rows = sum(max(1, -(-len(line) // columns)) for line in self.lines)
+        return rows * LINE_HEIGHT_DOTS * self.scale
+
+    def to_commands(self) -> bytes:
+        """テキストを印刷するコマンド列を返す (印刷後は書式を既定に戻す)"""
+        commands = [_KANJI_MODE_ON, _ALIGN + bytes([self.alignment]), _EXPAND + bytes([self.scale - 1, self.scale - 1])]
+        if self.emphasis:
+            commands.append(_EMPHASIS_ON)
+        commands.append(b''.join(line + b'\x0A' for line in self.lines))
+        if self.emphasis:
+            commands.append(_EMPHASIS_OFF)
+        commands.append(_EXPAND + b'\x00\x00')
+        commands.append(_ALIGN + b'\x00')
+        return b''.join(commands)
+
+class PrintDocument:
+    """
+    ネイティブテキスト (NativeText) とラスター (RasterImage) を印刷順に並べたジョブ。
+    テキストは内蔵フォントで、内蔵フォントで表せない文字を含む行や画像はラスターで印刷する。
+    パイプラインでは RasterImage と同じく width_dots / height / nbytes を使って扱う。
+    """
+    def __init__(self, segments: list, width_dots: int):
+        """
+        :param segments: NativeText または RasterImage のリスト
+        :param width_dots: プリンターの紙幅 (ドット)
+        """
+        self.segments = segments
+        self.width_dots = width_dots
+
+    @property
+    def height(self) -> int:
+        """印刷される長さ (ドット) の見積もり"""
+        return sum(
+            segment.height if isinstance(segment, RasterImage) else segment.estimate_height(self.width_dots)
+            for segment in self.segments
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """プリンターに送るデータ量 (ラスターデータとテキストのバイト数)"""
+        return sum(
+            segment.nbytes if isinstance(segment, RasterImage) else sum(len(line) + 1 for line in segment.lines)
+            for segment in self.segments
+        )
+
+def stack_documents(items: list, separator_gap: int = 8) -> RasterImage | PrintDocument:
+    """
+    複数のジョブ (RasterImage / PrintDocument) を、区切り線を挟んで1つのジョブにする。
+    すべてラスターの場合は stack_rasters と同じく1つのラスターに連結する。
+    """
+    if all(isinstance(item, RasterImage) for item in items):
+        return stack_rasters(items, separator_gap)
+    width_dots = max(item.width_dots for item in items)
+    # stack_rasters の区切り線だけを取り出す (空のラスター2つを連結すると区切り線だけが残る)
+    empty = RasterImage(width_dots - width_dots % 8, 0, b"")
+    separator = stack_rasters([empty, empty], separator_gap)
+    segments = []
+    for i, item in enumerate(items):
+        if i > 0:
+            segments.append(separator)
+        segments.extend(item.segments if isinstance(item, PrintDocument) else [item])
+    return PrintDocument(segments, width_dots)
@@ -9,14 +9,21 @@ from struct import pack
 
 # local_configから設定をインポート
 from MCP31PRINT.local_config import LocalPrinterConfig
+from MCP31PRINT.print_document import PrintDocument
+from MCP31PRINT.raster import RasterImage, rasterize_image
 
 class PrinterDriver:
     def __init__(self):
         self.printer_ip = LocalPrinterConfig.PRINTER_IP
         self.printer_port = LocalPrinterConfig.PRINTER_PORT
         self.paper_width_dots = LocalPrinterConfig.PAPER_WIDTH_DOTS
+        self.dpi = LocalPrinterConfig.PRINTER_DPI
         self.printer = None
         self.connection_timeout = 5 # 接続試行時のタイムアウト (秒)
+        # 接続の統計 (印刷サーバーのメトリクスで使用)
+        self.connect_count = 0      # 接続に成功した回数
+        self.connect_failures = 0   # 接続に失敗した回数
+        self.last_connect_ok = False # 最後の接続試行が成功したかどうか
 
     def _connect(self) -> bool:
         """
@@ -36,20 +43,20 @@ class PrinterDriver:
             time.sleep(0.5) # プリンターがコマンドを処理するのを待つ
 
             print("DEBUG: Connection established and printer initialized.")
+            self.connect_count += 1
+            self.last_connect_ok = True
             return True
         except socket.timeout:
             print(f"ERROR: 接続タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) への接続がタイムアウトしました。")
-            self.printer = None
-            return False
         except socket.error as e:
             print(f"ERROR: ソケットエラー - プリンターへの接続中にエラーが発生しました: {e}")
             print(f"DEBUG: ホスト ({self.printer_ip}) が到達可能か、ポート ({self.printer_port}) が開いているか確認してください。")
-            self.printer = None
-            return False
         except Exception as e:
             print(f"ERROR: 予期せぬエラー - プリンター接続中にエラーが発生しました: {e}")
-            self.printer = None
-            return False
+        self.printer = None
+        self.connect_failures += 1
+        self.last_connect_ok = False
+        return False
 
     def _disconnect(self):
         """
@@ -204,81 +211,11 @@ class PrinterDriver:
             else:
                 raise TypeError("image_input must be a file path (str), BytesIO, or PIL.Image object.")
             
-            img.save("debug_01_initial.png")
-            width, height = img.size
-
-            # 2. RGBA (透過) 画像の処理
-            if img.mode == "RGBA":
-                bg = Image.new("RGBA", (width, height), (255, 255, 255, 255))
-                img = Image.alpha_composite(bg, img)
-                img.save("debug_02_rgba_processed.png")
-            # 3. リサイズ (プリンターの紙幅に合わせる)
-            if width > self.paper_width_dots:
-                img = img.resize((self.paper_width_dots, height * self.paper_width_dots // width), Image.Resampling.LANCZOS)
-                width, height = img.size
-                img.save("debug_03_resized.png")
-            # 4. グレースケール変換 (BT.709 Luma + ガンマ補正)
-            if img.mode == "RGB" or img.mode == "RGBA":
-                new_img = Image.new("L", img.size)
-                img_data = img.getdata()
-                new_img.putdata([round((((0.2126 * pixel[0] + 0.7152 * pixel[1] + 0.0722 * pixel[2]) / 255) ** (1 / 2.2)) ** 1.5 * 255) for pixel in img_data])
-                img = new_img
-                img.save("debug_04_grayscale_l.png")
-            elif img.mode not in ("1", "L"):
-                img = img.convert("L")
-                img.save("debug_04_grayscale_l.png") 
-
-            # 5. モノクロ1ビット変換 (PillowのDitheringに切り替え)
-            if img.mode == "L":
-                img = img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
-                img.save("debug_05_monochrome_1bit.png")
-            img = ImageOps.invert(img)
-            # 6. 幅を8の倍数にパディング (プリンター要件)
-            if width % 8 != 0:
-                padded_width = width + (8 - width % 8)
-                padded_img = Image.new("1", (padded_width, height), 1) # 白でパディング
-                padded_img.paste(img, (0, 0))
-                img = padded_img
-                width, height = img.size
-                img.save("debug_06_padded.png")
-            
-            # 7. アライメント (余白を追加して位置調整)
-            if alignment == 1: # Center
-                padding_x = (self.paper_width_dots - width) // 2
-                if padding_x > 0:
-                    img = ImageOps.expand(img, (padding_x, 0, self.paper_width_dots - width - padding_x, 0), fill=1) # 白でパディング
-                    width, height = img.size
-                    img.save("debug_07_aligned.png")
-            
-            elif alignment == 2: # Right
-                padding_x = self.paper_width_dots - width
-                if padding_x > 0:
-                    img = ImageOps.expand(img, (padding_x, 0, 0, 0), fill=1) # 白でパディング
-                    width, height = img.size
-                    img.save("debug_07_aligned.png")
-
-            # 8. 画像データをバイト列に変換
-            data = img.tobytes()
-            
-            # 9. StarPRNTラスターコマンドの組み立てと送信 (ESC GS S 1 コマンド形式)
-            # Command: ESC GS S 1 xL xH yL yH [data]
-            # xL, xH: image width in bytes (LSB first)
-            # yL, yH: image height in dots (LSB first)
-            
-            x_bytes_val = width // 8
-            y_dots_val = height
-
-            # コマンドプレフィックスを ESC GS S 1 に変更
-            command_prefix = b'\x1B\x1D\x53\x01' # ESC GS S 1
-            
-            # struct.pack を使用してリトルエンディアンでパック
-            # ESC GS S 1 コマンドは p1-p4 (データ長) を持ちません
-            x_bytes = pack("<H", x_bytes_val) # 2バイトのunsigned short (xL xH)
-            y_bytes = pack("<H", y_dots_val) # 2バイトのunsigned short (yL yH)
+            # 2〜8. 透過処理、リサイズ、グレースケール化、ディザリング、パディング、アライメント
+            raster = rasterize_image(img, self.paper_width_dots, alignment)
 
-            full_command = command_prefix + x_bytes + y_bytes + b"\x00" + data
-            self.printer._raw(full_command)
-            #self.printer._raw(b'\x0A')
+            # 9. StarPRNTラスターコマンドの組み立てと送信
+            self._send_raster(raster)
             print("画像をラスターモードで印刷しました。")
             time.sleep(1) # 画像印刷後、十分な待ち時間を設ける
 
@@ -292,6 +229,126 @@ class PrinterDriver:
             traceback.print_exc()
         finally:
             self._disconnect()
+    def _send_raster(self, raster: RasterImage):
+        """
+        StarPRNTラスターコマンド (ESC GS S 1 xL xH yL yH n [data]) を送信する。
+        xL, xH: 画像の幅 (バイト数, LSB first) / yL, yH: 画像の高さ (ドット数, LSB first)
+        ラスターデータは結合せず、コマンドヘッダーと分けてそのまま送信する。
+        """
+        command_prefix = b'\x1B\x1D\x53\x01' # ESC GS S 1
+        self.printer._raw(command_prefix + pack("<H", raster.width_bytes) + pack("<H", raster.height) + b"\x00")
+        self.printer._raw(raster.data)
+
+    def _send_item(self, item: RasterImage | PrintDocument):
+        """ラスター、またはネイティブテキストとラスターを並べた PrintDocument を送信する"""
+        if isinstance(item, RasterImage):
+            self._send_raster(item)
+            return
+        for segment in item.segments:
+            if isinstance(segment, RasterImage):
+                self._send_raster(segment)
+            else:
+                self.printer._raw(segment.to_commands())
+
+    def print_raster(self, raster: RasterImage) -> bool:
+        """
+        1ビットにパック済みのラスター (RasterImage) をそのまま印刷する。
+        クライアント側でレンダリング済みのジョブは、画像処理を行わずにこのメソッドで送信する。
+        :param raster: 印刷するラスター (幅は紙幅以下であること)
+        :return: プリンターへの送信に成功すればTrue、そうでなければFalse
+        """
+        if raster.width_dots > self.paper_width_dots:
+            print(f"ERROR: ラスターの幅 ({raster.width_dots}) がプリンターの紙幅 ({self.paper_width_dots}) を超えています。")
+            return False
+        if not self._connect():
+            return False
+
+        try:
+            self.printer._raw(b'\x1B\x40') # プリンター初期化コマンド
+            time.sleep(1) # 初期化コマンドが処理されるのを待つ
+            self._send_raster(raster)
+            print(f"ラスター ({raster.width_dots}x{raster.height}) を印刷しました。")
+            time.sleep(1) # 画像印刷後、十分な待ち時間を設ける
+            return True
+        except socket.timeout:
+            print(f"ERROR: ラスター印刷タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) への送信がタイムアウトしました。")
+        except socket.error as e:
+            print(f"ERROR: ソケットエラー - ラスター印刷中にエラーが発生しました: {e}")
+        except Exception as e:
+            print(f"ERROR: 予期せぬエラー - ラスター印刷中にエラーが発生しました: {e}")
+        finally:
+            self._disconnect()
+        return False
+
+    def print_job(self, raster: RasterImage | PrintDocument, feed_lines: int = 5, cut_mode: str = 'full') -> bool:
+        """
+        レンダリング済みのラスター、紙送り、カットを1回の接続でまとめて送信する。
+        print_raster / print_empty_lines / cut_paper を順に呼ぶ場合と違い、
+        コマンドごとの接続・切断と固定の待ち時間が発生しないため、プリンターの印字速度に近い間隔で連続印刷できる。
+        :param raster: 印刷するラスター、またはネイティブテキストを含む PrintDocument (幅は紙幅以下であること)
+        :param feed_lines: カット前に送る空白行の数
+        :param cut_mode: 'full' / 'partial' / None (カットしない)
+        :return: プリンターへの送信に成功すればTrue、そうでなければFalse
+        """
+        if raster.width_dots > self.paper_width_dots:
+            print(f"ERROR: ラスターの幅 ({raster.width_dots}) がプリンターの紙幅 ({self.paper_width_dots}) を超えています。")
+            return False
+        if not self._connect(): # 接続時にプリンター初期化 (ESC @) 済み
+            return False
+
+        try:
+            self._send_item(raster)
+            self.printer._raw(b'\x0A' * feed_lines)
+            if cut_mode == 'full':
+                self.printer._raw(b'\x1B\x64\x02') # ESC d 2 (Full Cut)
+            elif cut_mode == 'partial':
+                self.printer._raw(b'\x1B\x64\x00') # ESC d 0 (Partial Cut)
+            print(f"ラスター ({raster.width_dots}x{raster.height}) を印刷しました (カット: {cut_mode})。")
+            return True
+        except socket.timeout:
+            print(f"ERROR: ジョブ印刷タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) への送信がタイムアウトしました。")
+        except socket.error as e:
+            print(f"ERROR: ソケットエラー - ジョブ印刷中にエラーが発生しました: {e}")
+        except Exception as e:
+            print(f"ERROR: 予期せぬエラー - ジョブ印刷中にエラーが発生しました: {e}")
+        finally:
+            self._disconnect()
+        return False
+
+    def print_batch(self, rasters: list, feed_lines: int = 5, partial_cut_feed_lines: int = 3) -> bool:
+        """
+        複数のジョブのラスターを1回の接続で続けて印刷する。
+        ジョブの間は partial_cut_feed_lines 行送ってパーシャルカットし、最後のジョブの後は feed_lines 行送ってフルカットする。
+        :param rasters: 印刷するラスター (または PrintDocument) のリスト (幅は紙幅以下であること)
+        :return: プリンターへの送信に成功すればTrue、そうでなければFalse
+        """
+        for raster in rasters:
+            if raster.width_dots > self.paper_width_dots:
+                print(f"ERROR: ラスターの幅 ({raster.width_dots}) がプリンターの紙幅 ({self.paper_width_dots}) を超えています。")
+                return False
+        if not self._connect(): # 接続時にプリンター初期化 (ESC @) 済み
+            return False
+
+        try:
+            for i, raster in enumerate(rasters):
+                self._send_item(raster)
+                if i < len(rasters) - 1:
+                    self.printer._raw(b'\x0A' * partial_cut_feed_lines)
+                    self.printer._raw(b'\x1B\x64\x00') # ESC d 0 (Partial Cut)
+            self.printer._raw(b'\x0A' * feed_lines)
+            self.printer._raw(b'\x1B\x64\x02') # ESC d 2 (Full Cut)
+            print(f"{len(rasters)}件のラスターをまとめて印刷しました。")
+            return True
+        except socket.timeout:
+            print(f"ERROR: ジョブ印刷タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) への送信がタイムアウトしました。")
+        except socket.error as e:
+            print(f"ERROR: ソケットエラー - ジョブ印刷中にエラーが発生しました: {e}")
+        except Exception as e:
+            print(f"ERROR: 予期せぬエラー - ジョブ印刷中にエラーが発生しました: {e}")
+        finally:
+            self._disconnect()
+        return False
+
     def print_image_from_bytes(self, image_bytes: bytes, alignment: int = 0):
         """
         バイト列形式の画像データをStarPRNTプリンターのラスターコマンドで印刷する。
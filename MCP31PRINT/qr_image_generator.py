@@ -3,6 +3,43 @@
 import qrcode
 from PIL import Image, ImageDraw, ImageFont
 import io
+from functools import lru_cache
+
+# 誤り訂正レベル (L: 約7%, M: 約15%, Q: 約25%, H: 約30% の欠損を復元できる。高いほど QRコードが大きくなる)
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+@lru_cache(maxsize=256)
+def qr_matrix(qr_data: str, error_correction: str = "M") -> tuple:
+    """
+    QRコードのモジュールの配置 (余白なし) を返す。True が黒のモジュール。
+    同じデータと誤り訂正レベルの組み合わせはキャッシュする (同じURLを含むメッセージが続く場合に再計算しない)。
+    """
+    qr = qrcode.QRCode(version=None, error_correction=ERROR_CORRECTION_LEVELS[error_correction], border=0)
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+def qr_to_image(qr_data: str, module_size: int = 4, border: int = 2, error_correction: str = "M") -> Image.Image:
+    """
+    QRコードを1ビット画像 (モード "1") として生成する。
+    モジュールを整数倍 (module_size ピクセル) で拡大するだけなので、リサイズやディザリングでモジュールの境界がぼやけない。
+    :param border: QRコードの周囲の余白 (モジュール数)
+    """
+    matrix = qr_matrix(qr_data, error_correction)
+    size = len(matrix) + border * 2
+    img = Image.new("1", (size, size), 255)
+    img.putdata([
+        0 if border <= y < size - border and border <= x < size - border and matrix[y - border][x - border] else 255
+        for y in range(size) for x in range(size)
+    ])
+    if module_size > 1:
+        img = img.resize((size * module_size, size * module_size), Image.Resampling.NEAREST)
+    return img
 
 class QRImageGenerator:
     def __init__(self, font_path: str = None, font_size: int = 20, default_width: int = 576):
@@ -34,6 +71,86 @@ class QRImageGenerator:
             print(f"フォントの読み込み中に予期せぬエラーが発生しました: {e}")
             return ImageFont.load_default()
 
+    def _wrap_text(self, text: str, max_width: int) -> list[str]:
+        """説明文を max_width ピクセルに収まるように折り返した行のリストを返す"""
+        lines = []
+        for line in text.splitlines():
+            current_line_text = ""
+            for char in line:
+                if current_line_text and self.font.getlength(current_line_text + char) > max_width:
+                    lines.append(current_line_text)
+                    current_line_text = char
+                else:
+                    current_line_text += char
+            lines.append(current_line_text)
+        return lines
+
+    def _caption_to_image(self, text: str, width: int) -> Image.Image | None:
+        """説明文を width ピクセル幅の1ビット画像 (中央寄せ) にする"""
+        lines = self._wrap_text(text, width)
+        if not any(line.strip() for line in lines):
+            return None
+        try:
+            ascender, descender = self.font.getmetrics()
+            line_height = ascender + abs(descender) + int(self.font_size * 0.2)
+        except AttributeError:
+            line_height = int(self.font_size * 1.4)
+        img = Image.new("1", (width, line_height * len(lines)), 255)
+        draw = ImageDraw.Draw(img)
+        for i, line in enumerate(lines):
+            x = max(0, int(width - self.font.getlength(line)) // 2)
+            draw.text((x, i * line_height), line, font=self.font, fill=0)
+        return img
+
+    def generate_qr_sheet(self, entries: list[dict], width: int = None, columns: int = None,
+                          module_size: int = 4, border: int = 2, error_correction: str = "M",
+                          gap: int = 8) -> Image.Image | None:
+        """
+        複数の QRコードを説明文付きで格子状に並べた1ビット画像 (モード "1") を返す。
+        QRコードを1件ずつ縦に並べるよりフッターが短くなり、画像の変換も1回で済む。
+        :param entries: [{"data": QRコードのデータ, "caption": 説明文 (省略可)}, ...]
+        :param width: 画像の幅 (プリンターの紙幅)。Noneの場合は default_width
+        :param columns: 列数。Noneの場合は、最も大きい QRコードが収まる範囲でできるだけ多く並べる
+        :param module_size: 1モジュールのピクセル数 (整数)。最も大きい QRコードが1列の幅に収まらない場合は小さくする
+        :param border: QRコードの周囲の余白 (モジュール数)
+        :param error_correction: 誤り訂正レベル ("L" / "M" / "Q" / "H")
+        :param gap: QRコードの間隔 (ピクセル)
+        :return: 画像。QRコードにするデータがない場合は None
+        """
+        entries = [entry for entry in entries if entry.get("data")]
+        if not entries:
+            return None
+        width = width or self.default_width
+
+        # 最も大きい QRコードのモジュール数から、1列に収まるモジュールのサイズと列数を決める
+        modules = max(len(qr_matrix(entry["data"], error_correction)) for entry in entries) + border * 2
+        module_size = max(1, min(module_size, width // modules))
+        qr_width = modules * module_size
+        if columns is None:
+            columns = max(1, (width + gap) // (qr_width + gap))
+        columns = max(1, min(columns, len(entries)))
+        cell_width = (width - gap * (columns - 1)) // columns
+
+        cells = []
+        for entry in entries:
+            qr_img = qr_to_image(entry["data"], module_size, border, error_correction)
+            caption_img = self._caption_to_image(entry.get("caption") or "", cell_width)
+            cells.append((qr_img, caption_img))
+
+        rows = [cells[i:i + columns] for i in range(0, len(cells), columns)]
+        row_heights = [max(qr.height + (caption.height if caption else 0) for qr, caption in row) for row in rows]
+        sheet = Image.new("1", (width, sum(row_heights) + gap * (len(rows) - 1)), 255)
+        y = 0
+        for row, row_height in zip(rows, row_heights):
+            for column, (qr_img, caption_img) in enumerate(row):
+                x = column * (cell_width + gap)
+                sheet.paste(qr_img, (x + (cell_width - qr_img.width) // 2, y))
+                if caption_img:
+                    sheet.paste(caption_img, (x, y + qr_img.height))
+            y += row_height + gap
+        print(f"DEBUG: QR sheet generated. {len(entries)} codes in {columns} columns, module size {module_size}. Size: {sheet.size}")
+        return sheet
+
     def generate_qr_with_text(self, qr_data: str, description_text: str = "", 
                               output_path: str = None, 
                               qr_box_size: int = 10, qr_border: int = 4, 
@@ -0,0 +1,154 @@
+# raster.py
+
+from PIL import Image, ImageOps
+import struct
+
+# ガンマ補正用のルックアップテーブル (printer_driver.py の BT.709 Luma + ガンマ補正と同じ式)
+_GAMMA_LUT = [round(((v / 255) ** (1 / 2.2)) ** 1.5 * 255) for v in range(256)]
+# RGB -> L 変換行列 (BT.709)
+_BT709_MATRIX = (0.2126, 0.7152, 0.0722, 0)
+
+class RasterImage:
+    """
+    プリンターのラスターコマンド (ESC GS S 1) にそのまま渡せる、1ビットにパック済みの画像。
+    ビットが1のドットが印字される (黒)。各行は width_bytes バイトで、幅は8の倍数。
+    通信用のシリアライズ形式: width_dots(2) height(4) の後にラスターデータが続く。
+    """
+    _HEADER = struct.Struct("!HI")
+
+    def __init__(self, width_dots: int, height: int, data):
+        if width_dots % 8 != 0:
+            raise ValueError(f"Raster width must be a multiple of 8: {width_dots}")
+        if len(data) != width_dots // 8 * height:
+            raise ValueError(f"Raster data length mismatch: expected {width_dots // 8 * height}, got {len(data)}")
+        self.width_dots = width_dots
+        self.height = height
+        self.data = data
+
+    @property
+    def width_bytes(self) -> int:
+        return self.width_dots // 8
+
+    @property
+    def nbytes(self) -> int:
+        """ラスターデータのバイト数"""
+        return len(self.data)
+
+    def to_buffers(self) -> list:
+        """送信用のバッファのリスト [ヘッダー, ラスターデータ] を返す (ラスターデータはコピーしない)"""
+        return [self._HEADER.pack(self.width_dots, self.height), self.data]
+
+    def to_bytes(self) -> bytes:
+        """シリアライズしたバイト列を返す"""
+        return b"".join(bytes(buf) for buf in self.to_buffers())
+
+    @classmethod
+    def from_buffer(cls, buffer) -> "RasterImage":
+        """
+        シリアライズされたバイト列 (bytes / memoryview) から RasterImage を復元する。
+        ラスターデータは元のバッファを参照するスライスになり、コピーは発生しない。
+        """
+        view = memoryview(buffer).cast('B')
+        if view.nbytes < cls._HEADER.size:
+            raise ValueError("Raster block is truncated.")
+        width_dots, height = cls._HEADER.unpack_from(view, 0)
+        return cls(width_dots, height, view[cls._HEADER.size:])
+
+    def to_pbm(self) -> bytes:
+        """
+        バイナリ PBM (P4) 形式のバイト列を返す。
+        PBM も1 = 黒の1ビットパック形式のため、ラスターデータをそのまま使える。
+        """
+        return f"P4\n{self.width_dots} {self.height}\n".encode("ascii") + bytes(self.data)
+
+    def to_image(self) -> Image.Image:
+        """印字イメージ (白背景・黒ドット) の1ビット PIL.Image に戻す"""
+        img = Image.frombytes("1", (self.width_dots, self.height), bytes(self.data))
+        return ImageOps.invert(img)
+
+def rasterize_image(img: Image.Image, paper_width_dots: int, alignment: int = 0) -> RasterImage:
+    """
+    PIL.Image をプリンターの紙幅に合わせて1ビットのラスターに変換する。
+    PrinterDriver.print_image と同じ処理 (透過の合成、リサイズ、BT.709 Luma + ガンマ補正、
+    Floyd-Steinberg ディザリング、反転、8の倍数へのパディング、アライメント) を行う。
+    :param img: 変換する画像
+    :param paper_width_dots: プリンターの紙幅 (ドット数)
+    :param alignment: 画像の水平アライメント (0: 左寄せ, 1: 中央寄せ, 2: 右寄せ)
+    :return: RasterImage
+    """
+    width, height = img.size
+
+    # 1. RGBA (透過) 画像の処理
+    if img.mode == "RGBA":
+        bg = Image.new("RGBA", (width, height), (255, 255, 255, 255))
+        img = Image.alpha_composite(bg, img)
+
+    # 2. リサイズ (プリンターの紙幅に合わせる)
+    if width > paper_width_dots:
+        img = img.resize((paper_width_dots, height * paper_width_dots // width), Image.Resampling.LANCZOS)
+        width, height = img.size
+
+    # 3. グレースケール変換 (BT.709 Luma + ガンマ補正)
+    #    ピクセルごとの Python ループではなく、変換行列とルックアップテーブルで処理する
+    if img.mode in ("RGB", "RGBA"):
+        img = img.convert("RGB").convert("L", _BT709_MATRIX).point(_GAMMA_LUT)
+    elif img.mode not in ("1", "L"):
+        img = img.convert("L")
+
+    # 4. モノクロ1ビット変換 (Floyd-Steinberg ディザリング)
+    if img.mode == "L":
+        img = img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
+    img = ImageOps.invert(img) # 反転後は 1 = 印字 (黒), 0 = 白
+
+    # 5. 幅を8の倍数にパディング (プリンター要件)
+    #    反転後のため、白は 0 で埋める
+    if width % 8 != 0:
+        padded_width = width + (8 - width % 8)
+        padded_img = Image.new("1", (padded_width, height), 0)
+        padded_img.paste(img, (0, 0))
+        img = padded_img
+        width, height = img.size
+
+    # 6. アライメント (余白を追加して位置調整)
+    if alignment == 1: # Center
+        padding_x = (paper_width_dots - width) // 2
+        padding_x -= padding_x % 8
+        if padding_x > 0:
+            img = ImageOps.expand(img, (padding_x, 0, 0, 0), fill=0)
+    elif alignment == 2: # Right
+        padding_x = paper_width_dots - width
+        padding_x -= padding_x % 8
+        if padding_x > 0:
+            img = ImageOps.expand(img, (padding_x, 0, 0, 0), fill=0)
+
+    width, height = img.size
+    return RasterImage(width, height, img.tobytes())
+
+def stack_rasters(rasters: list, separator_gap: int = 8) -> RasterImage:
+    """
+    複数のラスターを縦に連結して1つのラスターにする。
+    ラスターの間には、上下に separator_gap ドットの余白を挟んだ破線 (2ドット) の区切り線を入れる。
+    幅が異なるラスターは、最も広いラスターの幅に合わせて右側を白 (0) で埋める。
+    """
+    width_bytes = max(raster.width_bytes for raster in rasters)
+    separator = bytes(width_bytes * separator_gap) + b"\xF0" * (width_bytes * 2) + bytes(width_bytes * separator_gap)
+    separator_height = separator_gap * 2 + 2
+
+    parts = []
+    height = 0
+    for i, raster in enumerate(rasters):
+        if i > 0:
+            parts.append(separator)
+            height += separator_height
+        if raster.width_bytes == width_bytes:
+            parts.append(raster.data)
+        else:
+            # 行ごとに右側をパディングする
+            padding = bytes(width_bytes - raster.width_bytes)
+            data = memoryview(raster.data)
+            parts.append(b"".join(
+                bytes(data[y * raster.width_bytes:(y + 1) * raster.width_bytes]) + padding
+                for y in range(raster.height)
+            ))
+        height += raster.height
+    return RasterImage(width_bytes * 8, height, b"".join(parts))
@@ -0,0 +1,225 @@
+# receipt_renderer.py
+
+import time
+
+from PIL import Image
+
+from MCP31PRINT.config import PrinterConfig
+from MCP31PRINT.image_converter import ImageConverter
+from MCP31PRINT.print_document import NativeText, PrintDocument, encode_native_text
+from MCP31PRINT.qr_image_generator import QRImageGenerator
+from MCP31PRINT.raster import RasterImage, rasterize_image
+from MCP31PRINT.text_formatter import format_text_with_url_summary
+
+class ReceiptRenderer:
+    """
+    印刷ジョブ (ヘッダー、本文テキスト、本文画像、フッター) を1枚のレシート画像に組み立て、
+    プリンターにそのまま送れる1ビットのラスターに変換するクラス。
+    印刷サーバーのワーカーと、クライアント側での事前レンダリングの両方で同じ処理を使う。
+    """
+    def __init__(self, font_path: str = None, font_size: int = 30, paper_width_dots: int = None, native_text: bool = False):
+        """
+        :param font_path: 使用するフォントファイルのパス
+        :param font_size: フォントサイズ
+        :param paper_width_dots: プリンターの紙幅 (ドット数)。Noneの場合は PrinterConfig.PAPER_WIDTH_DOTS
+        :param native_text: Trueの場合、render_job はテキストをプリンター内蔵フォントで印刷する PrintDocument を返す
+                            (内蔵フォントで表せない文字を含む行と画像だけをラスターにする)
+        """
+        self.paper_width_dots = paper_width_dots or PrinterConfig.PAPER_WIDTH_DOTS
+        self.native_text = native_text
+        self.converter = ImageConverter(
+            font_path=font_path,
+            font_size=font_size,
+            default_width=self.paper_width_dots
+        )
+        # フッターの QRコード ({"type": "qr"}) はデータから直接描画する (画像ファイルを経由しない)
+        self.qr_generator = QRImageGenerator(font_path=font_path, font_size=20, default_width=self.paper_width_dots)
+
+    def set_paper_width(self, paper_width_dots: int):
+        """レンダリングする紙幅を変更する (サーバーから通知されたプリンターの紙幅に合わせる場合など)"""
+        if paper_width_dots and paper_width_dots != self.paper_width_dots:
+            print(f"Render: Paper width changed from {self.paper_width_dots} to {paper_width_dots} dots.")
+            self.paper_width_dots = paper_width_dots
+            self.converter.default_width = paper_width_dots
+            self.qr_generator.default_width = paper_width_dots
+
+    def _qr_to_image(self, entries: list) -> Image.Image | None:
+        """QRコードのデータと説明文のリスト [{"data", "caption"}] を、紙幅に格子状に並べた1ビット画像にする"""
+        return self.qr_generator.generate_qr_sheet(entries, width=self.paper_width_dots)
+
+    def _content_to_image(self, content_data, label: str) -> Image.Image | None:
+        """ヘッダー/フッターのコンテンツ ({"type", "content"} または文字列/バイト列) を画像に変換する"""
+        if isinstance(content_data, dict) and content_data.get("content"):
+            content_type = content_data.get("type")
+            if content_type == "text":
+                return self.converter.text_to_bitmap(text=content_data["content"])
+            elif content_type == "image":
+                return self.converter.image_from_bytes(content_data["content"])
+            elif content_type == "raster":
+                return RasterImage.from_buffer(content_data["content"]).to_image()
+            elif content_type == "qr":
+                return self._qr_to_image(content_data["content"])
+        elif isinstance(content_data, str):
+            return self.converter.text_to_bitmap(text=content_data)
+        elif isinstance(content_data, (bytes, memoryview)):
+            return self.converter.image_from_bytes(content_data)
+        print(f"Warning: Unexpected {label} format in renderer: {type(content_data)} - {content_data}")
+        return None
+
+    def compose(self, header_data=None, body_text=None, body_image_bytes_list=None, footer_data=None,
+                format_body: bool = True, timings: dict = None) -> Image.Image | None:
+        """
+        ジョブの各要素を画像に変換し、縦に結合した1枚の画像を返す。
+        :param format_body: Trueの場合、本文テキストを format_text_with_url_summary で整形する。
+                            送信側で整形済みの場合は False を指定し、URLタイトルの再取得を避ける。
+        :param timings: 辞書を渡すと、段階ごとの処理時間 (秒) を "format" と "compose" に記録する
+        :return: 結合された PIL.Image。印刷する内容がない場合は None
+        """
+        timings = {} if timings is None else timings
+        started_at = time.perf_counter()
+        if body_text and format_body:
+            body_text = format_text_with_url_summary(body_text, max_line_length=30, max_display_length=900, url_title_max_length=15)[0]
+        timings["format"] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        imglist = []
+
+        # ヘッダー処理
+        if header_data:
+            img = self._content_to_image(header_data, "header")
+            if img:
+                imglist.append(img)
+
+        # 本文テキスト処理
+        if body_text:
+            imglist.append(self.converter.text_to_bitmap(text=body_text))
+            print(f"Converting body text to image: {body_text[:50]}...") # 長すぎる場合は一部のみ表示
+
+        # 本文画像処理
+        if body_image_bytes_list:
+            for i, image_bytes in enumerate(body_image_bytes_list):
+                img = self.converter.image_from_bytes(image_bytes=image_bytes)
+                if img:
+                    imglist.append(img)
+                    print(f"Converting body image {i+1} to image.")
+
+        # フッター処理
+        if footer_data:
+            img = self._content_to_image(footer_data, "footer")
+            if img:
+                imglist.append(img)
+                print("Converting footer to image.")
+
+        printimg = self.converter.combine_images_vertically(images=imglist) if imglist else None
+        timings["compose"] = time.perf_counter() - started_at
+        return printimg
+
+    def render(self, header_data=None, body_text=None, body_image_bytes_list=None, footer_data=None,
+               format_body: bool = True, timings: dict = None) -> RasterImage | None:
+        """
+        ジョブをプリンターの紙幅の1ビットラスターまでレンダリングする。
+        引数は compose と同じ (timings には "rasterize" も記録する)。印刷する内容がない場合は None を返す。
+        """
+        timings = {} if timings is None else timings
+        printimg = self.compose(header_data, body_text, body_image_bytes_list, footer_data, format_body, timings)
+        if printimg is None:
+            return None
+        started_at = time.perf_counter()
+        raster = rasterize_image(printimg, self.paper_width_dots)
+        timings["rasterize"] = time.perf_counter() - started_at
+        return raster
+
+    def _text_segments(self, text: str, emphasis: bool = False) -> list:
+        """
+        テキストを NativeText のセグメントにする。
+        内蔵フォントで表せない文字を含む行だけは、その行を画像にしてラスターで印刷する。
+        """
+        segments = []
+        run = []
+        for line in text.rstrip("\n").split("\n"):
+            encoded = encode_native_text(line)
+            if encoded is not None:
+                run.append(encoded)
+                continue
+            if run:
+                segments.append(NativeText(run, emphasis=emphasis))
+                run = []
+            segments.append(rasterize_image(self.converter.text_to_bitmap(text=line), self.paper_width_dots))
+        if run:
+            segments.append(NativeText(run, emphasis=emphasis))
+        return segments
+
+    def _block_segments(self, content_data, label: str, emphasis: bool = False) -> list:
+        """ヘッダー/フッターのコンテンツをセグメントにする (テキストは内蔵フォント、それ以外はラスター)"""
+        if isinstance(content_data, dict) and content_data.get("type") == "text" and content_data.get("content"):
+            return self._text_segments(content_data["content"], emphasis)
+        if isinstance(content_data, str):
+            return self._text_segments(content_data, emphasis)
+        if isinstance(content_data, dict) and content_data.get("type") == "raster" and content_data.get("content"):
+            return [RasterImage.from_buffer(content_data["content"])]
+        img = self._content_to_image(content_data, label)
+        return [rasterize_image(img, self.paper_width_dots)] if img else []
+
+    def render_document(self, header_data=None, body_text=None, body_image_bytes_list=None, footer_data=None,
+                        format_body: bool = True, timings: dict = None) -> PrintDocument | None:
+        """
+        ジョブをネイティブテキストとラスターを並べた PrintDocument にレンダリングする。引数は render と同じ。
+        テキストは文字コードのまま送るため、テキストだけのジョブではレシート全体の画像化が不要になる。
+        timings には "format" と "compose" (セグメントの作成にかかった時間) を記録する。
+        """
+        timings = {} if timings is None else timings
+        started_at = time.perf_counter()
+        if body_text and format_body:
+            body_text = format_text_with_url_summary(body_text, max_line_length=30, max_display_length=900, url_title_max_length=15)[0]
+        timings["format"] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        segments = []
+        if header_data:
+            segments.extend(self._block_segments(header_data, "header", emphasis=True))
+        if body_text:
+            segments.extend(self._text_segments(body_text))
+        for image_bytes in body_image_bytes_list or []:
+            img = self.converter.image_from_bytes(image_bytes=image_bytes)
+            if img:
+                segments.append(rasterize_image(img, self.paper_width_dots))
+        if footer_data:
+            segments.extend(self._block_segments(footer_data, "footer"))
+        timings["compose"] = time.perf_counter() - started_at
+        if not segments:
+            return None
+        native = sum(1 for segment in segments if isinstance(segment, NativeText))
+        print(f"Render: Document with {native} native text and {len(segments) - native} raster segments.")
+        return PrintDocument(segments, self.paper_width_dots)
+
+    def render_job(self, job: dict, timings: dict = None, native_text: bool = None) -> RasterImage | PrintDocument | None:
+        """
+        デシリアライズした印刷ジョブ (network_utils.deserialize_job の返り値) をラスターにレンダリングする。
+        印刷サーバーのパイプラインとプレビューで共通の処理。
+        クライアント側でレンダリング済みのラスターを含むジョブは、再レンダリングせずにそのまま返す
+        (紙幅より広い場合のみ、画像に戻して紙幅に合わせ直す)。
+        送信側で整形済み (meta の body_preformatted) の本文は再整形しない。
+        :param native_text: Trueの場合はラスターの代わりに PrintDocument を返す。Noneの場合はコンストラクタの設定に従う
+        """
+        timings = {} if timings is None else timings
+        native_text = self.native_text if native_text is None else native_text
+        if job["raster"] is not None:
+            started_at = time.perf_counter()
+            raster = RasterImage.from_buffer(job["raster"])
+            print(f"Render: Received pre-rendered raster ({raster.width_dots}x{raster.height}).")
+            if raster.width_dots > self.paper_width_dots:
+                print(f"Render: Raster is wider than paper ({self.paper_width_dots}). Re-rasterizing.")
+                raster = rasterize_image(raster.to_image(), self.paper_width_dots)
+            timings["rasterize"] = time.perf_counter() - started_at
+            return raster
+        if native_text:
+            return self.render_document(
+                job["header"], job["body_text"], job["body_images"], job["footer"],
+                format_body=not job["meta"].get("body_preformatted", False),
+                timings=timings
+            )
+        return self.render(
+            job["header"], job["body_text"], job["body_images"], job["footer"],
+            format_body=not job["meta"].get("body_preformatted", False),
+            timings=timings
+        )
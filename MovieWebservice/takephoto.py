@@ -1,37 +1,205 @@
+import threading
+import time
+
 import cv2
-from flask import Flask, Response, render_template
+from flask import Flask, Response, render_template, request
 
 app = Flask(__name__)
 
-# カメラオブジェクトはグローバルに保持
-camera = None
-
-def generate_frames():
-    global camera
-    if camera is None:
-        camera = cv2.VideoCapture(0)
-        if not camera.isOpened():
-            print("Error: Could not open video stream.")
-            return
-
-    while True:
-        success, frame = camera.read()
-        if not success:
-            break
-        else:
-            # 画像を上下反転させる (flipCode=0)
-            frame_flipped_vertical = cv2.flip(frame, 0)
-            # 上下反転した画像を左右反転させる (flipCode=1)
-            frame_flipped_both = cv2.flip(frame_flipped_vertical, 1)
-
-            # JPEGにエンコード
-            ret, buffer = cv2.imencode('.jpg', frame_flipped_both, [int(cv2.IMWRITE_JPEG_QUALITY), 90]) # 品質を調整可能 (0-100)
-            if not ret:
-                continue
-
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+# 配信の品質の段階 (width: 横幅の上限 (None の場合はカメラの解像度のまま), quality: JPEG の品質 (0-100))
+# 視聴者は /video_feed?profile=high のように選ぶ。"auto" (既定) の場合は送信にかかる時間から自動で切り替える
+STREAM_PROFILES = {
+    "high": {"width": None, "quality": 90},
+    "medium": {"width": 640, "quality": 70},
+    "low": {"width": 320, "quality": 50},
+}
+PROFILE_ORDER = ["high", "medium", "low"] # 品質の高い順
+AUTO_START_PROFILE = "medium"
+
+# "auto" の切り替えの基準: 1フレームの送信にかかる時間 (秒、指数移動平均) が SLOW を超えたら1段下げ、
+# FAST 未満が UPGRADE_AFTER_FRAMES フレーム続いたら1段上げる
+SLOW_SEND_SECONDS = 0.15
+FAST_SEND_SECONDS = 0.02
+UPGRADE_AFTER_FRAMES = 50
+
+# 変化の検出: 縮小したグレースケール画像のいずれかの画素が CHANGE_THRESHOLD (0-255) 以上変わった場合のみエンコード・送信する。
+# 変化がなくても KEYFRAME_INTERVAL_SECONDS ごとには送る (ゆっくりした変化の取りこぼしと接続のタイムアウトを防ぐ)
+CHANGE_DETECTION_SIZE = (32, 24)
+CHANGE_THRESHOLD = 8
+KEYFRAME_INTERVAL_SECONDS = 5.0
+
+class ChangeDetector:
+    """
+    フレームが前回送ったフレームから変化したかどうかを判定する。
+    縮小した画像同士を比較するため、エンコードに比べて処理が軽く、カメラのノイズの影響も受けにくい。
+    """
+    def __init__(self, size=CHANGE_DETECTION_SIZE, threshold: int = CHANGE_THRESHOLD,
+                 keyframe_interval: float = KEYFRAME_INTERVAL_SECONDS):
+        self.size = size
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self._reference = None # 前回送ったフレームの縮小画像
+        self._reference_time = 0.0
+
+    def changed(self, frame) -> bool:
+        """変化していれば (または前回から keyframe_interval 秒経っていれば) True を返し、このフレームを比較の基準にする"""
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), self.size, interpolation=cv2.INTER_AREA)
+        now = time.monotonic()
+        if (self._reference is not None
+                and now - self._reference_time < self.keyframe_interval
+                and cv2.absdiff(small, self._reference).max() < self.threshold):
+            return False
+        self._reference = small
+        self._reference_time = now
+        return True
+
+def encode_frame(frame, profile: dict) -> bytes | None:
+    """フレームを品質の段階に合わせて縮小・JPEGエンコードし、multipart の1パートにする"""
+    width = profile["width"]
+    if width and frame.shape[1] > width:
+        height = round(frame.shape[0] * width / frame.shape[1])
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), profile["quality"]])
+    if not ret:
+        return None
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+
+class FrameBroadcaster:
+    """
+    カメラの読み込みと JPEG エンコードを1本のスレッドで行い、最新のフレームをすべての視聴者に配信する。
+    エンコードは視聴者のいる品質の段階ごとに1フレームにつき1回だけ行い、同じ段階の視聴者でバイト列を共有する。
+    前回送ったフレームから変化がない場合はエンコードも送信もしない。
+    視聴者は常に最新のフレームだけを受け取るため、送信が遅い視聴者ではフレームが間引かれ、他の視聴者は遅くならない。
+    視聴者がいない間は読み込みを止める (カメラは開いたままにして、次の視聴者ですぐに再開する)。
+    """
+    def __init__(self, device: int = 0):
+        """
+        :param device: cv2.VideoCapture に渡すカメラの番号
+        """
+        self.device = device
+        self._cond = threading.Condition()
+        self._thread = None # 読み込みスレッド (カメラを開けなかった場合や読み込みに失敗した場合は None に戻る)
+        self._subscribers = {name: 0 for name in STREAM_PROFILES}
+        self._frames = {} # 品質の段階 -> (フレームID, multipart の1パート)。視聴者のいる段階のみ
+        self._next_id = 1
+        self._closed = False
+
+    def _capture_loop(self):
+        camera = cv2.VideoCapture(self.device)
+        detector = ChangeDetector()
+        try:
+            if not camera.isOpened():
+                print("Error: Could not open video stream.")
+                return
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: any(self._subscribers.values()) or self._closed)
+                    if self._closed:
+                        return
+                success, frame = camera.read()
+                if not success:
+                    print("Error: Could not read a frame from the camera.")
+                    return
+                # 画像を上下左右に反転させる (180度回転, flipCode=-1)
+                frame = cv2.flip(frame, -1)
+
+                with self._cond:
+                    active = [name for name, count in self._subscribers.items() if count > 0]
+                    missing = [name for name in active if name not in self._frames]
+                # 変化がない場合も、新しく視聴者が来た段階のフレームはエンコードする
+                targets = active if detector.changed(frame) else missing
+                if not targets:
+                    continue
+                parts = {name: encode_frame(frame, STREAM_PROFILES[name]) for name in targets}
+                with self._cond:
+                    for name, part in parts.items():
+                        if part is not None and self._subscribers[name] > 0:
+                            self._frames[name] = (self._next_id, part)
+                            self._next_id += 1
+                    self._cond.notify_all()
+        finally:
+            # カメラを解放してからスレッドを終了したことにする (次の視聴者が開き直せるように)
+            camera.release()
+            with self._cond:
+                self._thread = None
+                self._frames.clear()
+                self._cond.notify_all()
+
+    def _subscribe(self, profile: str):
+        self._subscribers[profile] += 1
+
+    def _unsubscribe(self, profile: str):
+        self._subscribers[profile] -= 1
+        if self._subscribers[profile] == 0:
+            # 視聴者のいない段階の古いフレームは残さない
+            self._frames.pop(profile, None)
+
+    def frames(self, profile: str = "auto"):
+        """
+        視聴者1人分の MJPEG ストリームを返すジェネレーター。
+        新しいフレームができるまで待ち、前回送った後に複数のフレームができていた場合は最新のものだけを送る。
+        :param profile: STREAM_PROFILES のキー、または "auto" (送信にかかる時間から段階を自動で切り替える)
+        """
+        adaptive = profile not in STREAM_PROFILES
+        if adaptive:
+            profile = AUTO_START_PROFILE
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._capture_loop, daemon=True)
+                self._thread.start()
+            thread = self._thread
+            self._subscribe(profile)
+        try:
+            last_id = None
+            send_seconds = 0.0
+            fast_frames = 0
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._thread is not thread
+                                        or self._frames.get(profile, (last_id,))[0] != last_id)
+                    if self._thread is not thread:
+                        return # カメラを開けなかった、または読み込みに失敗した
+                    last_id, part = self._frames[profile]
+                started = time.monotonic()
+                yield part # 視聴者への書き込みが終わると再開する
+                if not adaptive:
+                    continue
+
+                send_seconds = 0.8 * send_seconds + 0.2 * (time.monotonic() - started)
+                fast_frames = fast_frames + 1 if send_seconds < FAST_SEND_SECONDS else 0
+                level = PROFILE_ORDER.index(profile)
+                if send_seconds > SLOW_SEND_SECONDS and level + 1 < len(PROFILE_ORDER):
+                    level += 1
+                elif fast_frames >= UPGRADE_AFTER_FRAMES and level > 0:
+                    level -= 1
+                else:
+                    continue
+                with self._cond:
+                    self._unsubscribe(profile)
+                    profile = PROFILE_ORDER[level]
+                    self._subscribe(profile)
+                last_id = None
+                send_seconds = 0.0
+                fast_frames = 0
+        finally:
+            with self._cond:
+                self._unsubscribe(profile)
+
+    def close(self):
+        """読み込みスレッドを止めてカメラを解放する"""
+        with self._cond:
+            self._closed = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join(timeout=5)
+
+# カメラと配信スレッドはグローバルに1つだけ保持し、全視聴者で共有する
+broadcaster = FrameBroadcaster()
+
+def generate_frames(profile: str = "auto"):
+    return broadcaster.frames(profile)
 
 @app.route('/')
 def index():
@@ -40,8 +208,11 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    # MJPEGストリームを返す
-    return Response(generate_frames(),
+    # MJPEGストリームを返す (?profile=high / medium / low / auto で品質を選ぶ)
+    profile = request.args.get('profile', 'auto')
+    if profile != 'auto' and profile not in STREAM_PROFILES:
+        return f"Unknown profile: {profile} (choose from auto, {', '.join(PROFILE_ORDER)})", 400
+    return Response(generate_frames(profile),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 if __name__ == '__main__':
@@ -50,5 +221,5 @@ if __name__ == '__main__':
         app.run(host='0.0.0.0', port=5569, debug=False, threaded=True)
     except KeyboardInterrupt:
         print("Server shutting down.")
-        if camera:
-            camera.release()
\ No newline at end of file
+    finally:
+        broadcaster.close()
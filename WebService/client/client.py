@@ -9,7 +9,11 @@ project_root = os.path.join(current_dir, '..')
 if project_root not in sys.path:
     sys.path.append(project_root)
 
-from common.network_utils import serialize_data 
+from common.network_utils import (
+    serialize_data, serialize_frame, serialize_raster_frame, send_buffers, encode_frame, FrameError,
+    LEGACY_TERMINATOR, MSG_STATUS
+)
+from .connection_pool import get_connection_pool
 #from client.config import ClientConfig # 必要であれば
 
 try:
@@ -21,23 +25,252 @@ except ImportError:
 
 
 class FileSenderClient:
-    def __init__(self):
+    def __init__(self, use_binary_protocol: bool = True, use_compression: bool = True, renderer=None, source: str = None):
+        """
+        :param use_binary_protocol: Trueの場合はバイナリフレーム形式で送信する。
+                                    Falseの場合は旧形式 (JSON + Base64 + 終端文字列) で送信する。
+        :param use_compression: Trueの場合、サーバーとネゴシエーションしたコーデックでブロックを圧縮する。
+        :param renderer: MCP31PRINT.receipt_renderer.ReceiptRenderer。指定された場合はクライアント側で
+                         ジョブを1ビットラスターまでレンダリングして送信し、サーバーの描画負荷を減らす。
+                         紙幅はサーバーが HELLO で通知するプリンターの紙幅に合わせて自動的に変更される。
+        :param source: 送信元のタグ (例: "discord", "google_forms")。サーバーはこのタグごとに
+                       レート制限と公平なキューイングを行う。Noneの場合はクライアントの IP アドレスで区別される。
+        """
         self.server_ip = ActualClientConfig().SERVER_IP
         self.server_port = ActualClientConfig().SERVER_PORT
+        self.use_binary_protocol = use_binary_protocol
+        self.use_compression = use_compression
+        self.renderer = renderer
+        self.source = source
+        # バイナリ形式では永続接続を共有プールから取得し、複数のジョブを同じ接続で送信する
+        self.pool = get_connection_pool((self.server_ip, self.server_port), use_compression=use_compression)
+        # サーバーがテキストをプリンター内蔵フォントで印刷する場合 (HELLO の features に "native_text")、
+        # ラスターにすると送信量が増えるだけなので、クライアント側ではレンダリングしない
+        self.server_native_text = False
 
-    def send_data(self, header_data=None, body_text_message=None, body_image_bytes_list=None, footer_data=None):
-        # ★★★ ここが重要！ serialize_data に渡す引数が正しいか確認
+    def _serialize(self, header_data=None, body_text_message=None, body_image_bytes_list=None, footer_data=None,
+                   body_preformatted=False, idempotency_key=None, codecs=None, meta=None, prerender=True):
+        """
+        送信するバッファのリストを返す。
+        prerender が False の場合や、サーバーがテキストを内蔵フォントで印刷する場合は、
+        renderer が指定されていてもクライアント側でレンダリングしない。
+        """
+        if self.use_binary_protocol:
+            meta = dict(meta or {})
+            if self.source:
+                meta["source"] = self.source
+            if idempotency_key:
+                meta["idempotency_key"] = idempotency_key
+            if self.renderer is not None and prerender and not self.server_native_text:
+                raster = self.renderer.render(header_data, body_text_message, body_image_bytes_list, footer_data,
+                                              format_body=not body_preformatted)
+                if raster is None:
+                    return None
+                print(f"クライアント側でレンダリングしました ({raster.width_dots}x{raster.height})。")
+                return serialize_raster_frame(raster.to_bytes(), meta=meta, codecs=codecs)
+            if body_preformatted:
+                meta["body_preformatted"] = True
+            return serialize_frame(
+                header=header_data,
+                body_text=body_text_message,
+                body_image_bytes_list=body_image_bytes_list,
+                footer=footer_data,
+                meta=meta,
+                codecs=codecs
+            )
         serialized_data = serialize_data(
             header=header_data, # header_data は bot.py から辞書で渡される
             body_text=body_text_message,
             body_image_bytes_list=body_image_bytes_list,
             footer=footer_data
         )
+        return [serialized_data, LEGACY_TERMINATOR]
 
+    def printer_capabilities(self) -> dict:
+        """
+        サーバーが HELLO で通知したプリンターの情報を返す。
+        接続プールにキャッシュがあればそれを使い、なければサーバーに接続して取得する。
+        :return: {"paper_width_dots": 紙幅 (ドット), "dpi": 解像度, "features": [...], ...}。
+                 旧形式で送信する場合や、サーバーに接続できない場合は空の辞書
+        """
+        if not self.use_binary_protocol:
+            return {}
+        if not self.pool.capabilities:
+            try:
+                self.pool.release(self.pool.acquire())
+            except (socket.error, FrameError) as e:
+                print(f"サーバーの機能を取得できませんでした: {e}")
+                return {}
+        return self.pool.capabilities
+
+    def paper_width_dots(self, default: int = None) -> int:
+        """プリンターの紙幅 (ドット) を返す。サーバーから取得できない場合は default"""
+        return self.printer_capabilities().get("paper_width_dots") or default
+
+    def _submit(self, builders):
+        """
+        ジョブを1本の永続接続でパイプライン送信し、それぞれの ACK を返す。
+        builders: builder(codecs, meta) -> 送信バッファのリスト (送信しない場合は None) のリスト
+        返り値: builders と同じ順序の ACK メタデータのリスト (送信しなかったジョブは None)
+        再利用した接続がサーバー側で閉じられていた場合は、新しい接続で一度だけやり直す。
+        """
+        for attempt in range(2):
+            conn = self.pool.acquire()
+            self.server_native_text = "native_text" in conn.capabilities.get("features", [])
+            if self.renderer is not None:
+                # クライアント側のレンダリングはプリンターの紙幅で行い、サーバーでの縮小を避ける
+                self.renderer.set_paper_width(conn.capabilities.get("paper_width_dots"))
+            try:
+                seqs = []
+                for build in builders:
+                    seq = conn.next_seq()
+                    buffers = build(conn.codecs, {"seq": seq})
+                    if buffers is None:
+                        seqs.append(None)
+                        continue
+                    conn.send(seq, buffers)
+                    seqs.append(seq)
+                acks = [conn.wait_for(seq) if seq is not None else None for seq in seqs]
+                self.pool.release(conn)
+                return acks
+            except (socket.error, FrameError) as e:
+                self.pool.discard(conn)
+                if attempt == 0 and conn.reused:
+                    print(f"再利用した接続が使用できませんでした。新しい接続で再送します: {e}")
+                    continue
+                raise
+
+    def send_data(self, header_data=None, body_text_message=None, body_image_bytes_list=None, footer_data=None,
+                  body_preformatted=False, idempotency_key=None):
+        """
+        印刷ジョブをサーバーに送信する。
+        :param body_preformatted: 本文テキストが format_text_with_url_summary で整形済みの場合は True。
+                                  サーバー (またはクライアント側レンダラー) での再整形を省略する。
+        :param idempotency_key: ジョブを識別するキー。同じキーのジョブを一定時間内に再送しても、
+                                サーバーは最初のジョブとして扱い二重に印刷しない。
+        :return: サーバーがジョブを受け付けた場合は True
+        """
+        return self.send_job(
+            header_data=header_data,
+            body_text_message=body_text_message,
+            body_image_bytes_list=body_image_bytes_list,
+            footer_data=footer_data,
+            body_preformatted=body_preformatted,
+            idempotency_key=idempotency_key
+        )["status"] == "accepted"
+
+    def send_data_many(self, jobs: list[dict]) -> list[bool]:
+        """
+        複数の印刷ジョブを1本の接続でまとめて送信する (ACK を待たずに続けて送信するパイプライン)。
+        :param jobs: send_data のキーワード引数の辞書のリスト
+        :return: ジョブごとに、サーバーが受け付けたかどうかのリスト
+        """
+        return [ack["status"] == "accepted" for ack in self.send_jobs(jobs)]
+
+    def send_job(self, **job) -> dict:
+        """
+        印刷ジョブを1件送信し、サーバーの ACK を返す。引数は send_data と同じ。
+        :return: {"status": "accepted", "job_id": ...} / {"status": "rejected", "error": ...} /
+                 サーバーが混雑している場合は {"status": "busy", "retry_after": 再送までの秒数} /
+                 送信自体に失敗した場合は {"status": "error", "error": ...}
+        """
+        return self.send_jobs([job])[0]
+
+    def send_jobs(self, jobs: list[dict]) -> list[dict]:
+        """
+        複数の印刷ジョブを1本の接続でパイプライン送信し、ジョブごとの ACK を返す。
+        :param jobs: send_data のキーワード引数の辞書のリスト
+        :return: send_job と同じ形式の辞書のリスト (jobs と同じ順序)
+        """
+        if not self.use_binary_protocol:
+            # 旧形式ではサーバーから応答がないため、送信できた時点で受け付けられたものとみなす
+            return [
+                {"status": "accepted", "job_id": None} if self._transmit_legacy(self._serialize(**job))
+                else {"status": "error", "error": "transmission failed"}
+                for job in jobs
+            ]
+
+        builders = [
+            lambda codecs, meta, job=job: self._serialize(codecs=codecs, meta=meta, **job)
+            for job in jobs
+        ]
+        return self._submit_and_report(builders)
+
+    def send_raster(self, raster) -> bool:
+        """
+        レンダリング済みのラスター (MCP31PRINT.raster.RasterImage) をそのまま印刷ジョブとして送信する。
+        :return: サーバーがジョブを受け付けた場合は True
+        """
+        return self._submit_and_report([
+            lambda codecs, meta: serialize_raster_frame(raster.to_bytes(), meta=meta, codecs=codecs)
+        ])[0]["status"] == "accepted"
+
+    def preview_job(self, image_format: str = "png", **job) -> dict:
+        """
+        印刷ジョブをサーバーで印刷せずにレンダリングし、結果の画像を返す。引数は send_data と同じ。
+        サーバーは実際の印刷と同じ整形・合成・ラスター化を行うため、紙を使わずに仕上がりと処理時間を確認できる。
+        :param image_format: "png" または "pbm"
+        :return: {"status": "preview", "image": 画像のバイト列 (内容がない場合は None), "width", "height",
+                  "timings": 段階ごとの処理時間 (秒)} / 失敗した場合は {"status": "rejected" / "error", "error": ...}
+        """
+        # プレビューはサーバーのレンダリング結果を見るためのものなので、クライアント側では描画しない
+        build = lambda codecs, meta: self._serialize(codecs=codecs, meta=dict(meta, preview=image_format), prerender=False, **job)
+        try:
+            ack = self._submit([build])[0]
+        except Exception as e:
+            print(f"プレビューの取得に失敗しました: {e}")
+            return {"status": "error", "error": str(e)}
+        blocks = ack.pop("blocks", None)
+        ack["image"] = bytes(blocks[0]) if blocks else None
+        return ack
+
+    def query_status(self, job_ids: list[str]) -> dict:
+        """
+        ジョブの状態をサーバーに問い合わせる。
+        :return: {job_id: {"state": "queued" / "rendering" / "printing" / "done" / "failed" / "unknown",
+                           "position": キュー内の位置 (queued の場合), "error": エラー内容}}
+        """
+        acks = self._submit([
+            lambda codecs, meta: encode_frame(MSG_STATUS, meta=dict(meta, job_ids=list(job_ids)))
+        ])
+        return acks[0].get("jobs", {})
+
+    def _submit_and_report(self, builders) -> list[dict]:
+        """_submit を呼び出し、結果を表示して ACK のリストを返す"""
+        try:
+            acks = self._submit(builders)
+        except socket.error as e:
+            print(f"ソケットエラーが発生しました: {e}")
+            return [{"status": "error", "error": str(e)} for _ in builders]
+        except Exception as e:
+            print(f"データ送信中に予期せぬエラーが発生しました: {e}")
+            return [{"status": "error", "error": str(e)} for _ in builders]
+
+        results = []
+        for ack in acks:
+            if ack is None:
+                print("印刷する内容がないため、送信しませんでした。")
+                results.append({"status": "error", "error": "nothing to print"})
+            elif ack.get("status") == "accepted" and ack.get("duplicate"):
+                print(f"同じジョブが既に受け付けられています。ジョブID: {ack.get('job_id')}")
+                results.append(ack)
+            elif ack.get("status") == "accepted":
+                print(f"データが正常に送信されました。ジョブID: {ack.get('job_id')}")
+                results.append(ack)
+            elif ack.get("status") == "busy":
+                print(f"サーバーが混雑しています。{ack.get('retry_after')}秒後に再送してください。")
+                results.append(ack)
+            else:
+                print(f"サーバーがジョブを受け付けませんでした: {ack.get('error')}")
+                results.append(ack)
+        return results
+
+    def _transmit_legacy(self, buffers):
+        """旧形式のデータを1接続1ジョブで送信する (サーバーからの応答はない)"""
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.connect((self.server_ip, self.server_port))
-                s.sendall(serialized_data + b"<END_OF_TRANSMISSION>")
+                send_buffers(s, buffers)
             print("データが正常に送信されました。")
             return True
         except socket.error as e:
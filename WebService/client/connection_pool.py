@@ -0,0 +1,171 @@
+# client/connection_pool.py
+
+import socket
+import threading
+import time
+from collections import deque
+
+from common.network_utils import (
+    send_buffers, recv_message, encode_frame, decode_frame, is_binary_frame, negotiate_codecs,
+    FrameError, MSG_HELLO, MSG_ACK, MSG_STATUS_REPLY, SUPPORTED_CODECS
+)
+
+class ServerConnection:
+    """
+    印刷サーバーとの永続的な TCP 接続。
+    接続時に HELLO で圧縮コーデックを合意してサーバーの機能 (プリンターの紙幅など) を取得し、
+    その後は複数のジョブを同じ接続で送信する。
+    ACK を待たずに最大 max_in_flight 件までジョブを送信できる (パイプライン)。
+    ACK とステータス問い合わせの応答は、どちらもシーケンス番号 (meta の "seq") で対応付ける。
+    """
+    def __init__(self, address, use_compression: bool = True, timeout: float = 10.0, max_in_flight: int = 8):
+        """
+        :param address: (サーバーIP, ポート)
+        :param use_compression: Trueの場合、HELLO でサーバーと圧縮コーデックを合意する (Falseの場合は圧縮しない)
+        :param timeout: 接続・送受信のタイムアウト (秒)
+        :param max_in_flight: ACK を待たずに送信できるジョブの最大数
+        """
+        self.address = address
+        self.max_in_flight = max_in_flight
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.codecs = []
+        self.capabilities = {} # HELLO 応答のメタデータ (paper_width_dots, dpi, features など)
+        self.last_used = time.monotonic()
+        self.reused = False # プールから再利用された接続かどうか
+        self._next_seq = 1
+        self._in_flight = deque()
+        self._acks = {}
+        self._hello(SUPPORTED_CODECS if use_compression else [])
+
+    def _hello(self, codecs: list):
+        """HELLO を交換してサーバーの機能を取得し、共通の圧縮コーデックを決める"""
+        send_buffers(self.sock, encode_frame(MSG_HELLO, meta={"codecs": codecs}))
+        reply = recv_message(self.sock)
+        if reply is None or not is_binary_frame(reply):
+            raise FrameError("Server did not answer HELLO.")
+        msg_type, _, meta, _ = decode_frame(reply)
+        if msg_type != MSG_HELLO:
+            raise FrameError(f"Unexpected reply to HELLO: {msg_type}")
+        self.capabilities = meta
+        self.codecs = negotiate_codecs(meta.get("codecs"))
+        print(f"サーバーと合意した圧縮コーデック: {self.codecs}")
+
+    def next_seq(self) -> int:
+        """この接続で次に送信するメッセージのシーケンス番号を払い出す"""
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def send(self, seq: int, buffers):
+        """
+        シーケンス番号 seq のジョブを送信する。
+        ACK 待ちのジョブが max_in_flight 件に達している場合は、ACK を1件受信してから送信する。
+        """
+        while len(self._in_flight) >= self.max_in_flight:
+            self._read_reply()
+        send_buffers(self.sock, buffers)
+        self._in_flight.append(seq)
+        self.last_used = time.monotonic()
+
+    def _read_reply(self):
+        """ACK またはステータス応答を1件受信して保持する"""
+        reply = recv_message(self.sock)
+        if reply is None:
+            raise ConnectionError("Server closed the connection while jobs were in flight.")
+        msg_type, _, meta, blocks = decode_frame(reply)
+        if msg_type not in (MSG_ACK, MSG_STATUS_REPLY):
+            raise FrameError(f"Unexpected message while waiting for a reply: {msg_type}")
+        if blocks:
+            # プレビューの画像など、応答に含まれるブロック (受信バッファは使い回さないためコピーしない)
+            meta["blocks"] = [payload for _, _, _, payload in blocks]
+        seq = meta.get("seq")
+        if seq in self._in_flight:
+            self._in_flight.remove(seq)
+        self._acks[seq] = meta
+
+    def wait_for(self, seq: int) -> dict:
+        """シーケンス番号 seq の応答を受信するまで待ち、応答のメタデータを返す"""
+        while seq not in self._acks:
+            self._read_reply()
+        self.last_used = time.monotonic()
+        return self._acks.pop(seq)
+
+    @property
+    def idle(self) -> bool:
+        """ACK 待ちのジョブがなく、プールに戻せる状態かどうか"""
+        return not self._in_flight and not self._acks
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    """
+    ServerConnection のプール。使い終わった接続を idle_timeout 秒まで保持し、次のジョブで再利用する。
+    サーバー側のアイドルタイムアウトより短い idle_timeout を設定すること。
+    """
+    def __init__(self, address, max_idle: int = 2, idle_timeout: float = 30.0, **connection_options):
+        """
+        :param address: (サーバーIP, ポート)
+        :param max_idle: 保持するアイドル接続の最大数
+        :param idle_timeout: アイドル接続を保持する時間 (秒)
+        :param connection_options: ServerConnection に渡すオプション
+        """
+        self.address = address
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connection_options = connection_options
+        self._idle = []
+        self._lock = threading.Lock()
+        # 最後に確立した接続の HELLO 応答 (プリンターの紙幅などを接続せずに参照するためのキャッシュ)
+        self.capabilities = {}
+
+    def acquire(self) -> ServerConnection:
+        """アイドル接続があれば再利用し、なければ新しく接続する"""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if now - conn.last_used < self.idle_timeout:
+                    conn.reused = True
+                    return conn
+                conn.close()
+        conn = ServerConnection(self.address, **self.connection_options)
+        self.capabilities = conn.capabilities
+        return conn
+
+    def release(self, conn: ServerConnection):
+        """接続をプールに戻す。ACK 待ちが残っている接続やプールが満杯の場合は閉じる。"""
+        with self._lock:
+            if conn.idle and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn: ServerConnection):
+        """エラーが発生した接続を破棄する"""
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_connection_pool(address, **options) -> ConnectionPool:
+    """
+    接続先とオプションごとに共有される ConnectionPool を返す。
+    FileSenderClient をジョブごとに生成する呼び出し元 (Discordボットなど) でも接続が再利用される。
+    """
+    key = (tuple(address), tuple(sorted(options.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(address, **options)
+        return pool
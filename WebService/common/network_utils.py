@@ -3,10 +3,98 @@
 import json
 import base64
 import os # _process_content でのパス存在チェックに使用
+import struct
+import mmap
+import tempfile
+import zlib
+
+try:
+    import zstandard # 任意依存: インストールされていれば zstd 圧縮を利用する
+except ImportError:
+    zstandard = None
+
+# =================================================================
+# バイナリフレーム形式 (v1)
+# =================================================================
+# [フレームヘッダー][ブロックテーブル][メタデータ(JSON)][ブロック本体...]
+#   フレームヘッダー: magic(4) version(1) msg_type(1) flags(2) block_count(2) meta_len(4)
+#   ブロックテーブル: block_count 個の role(1) kind(1) hints(2) length(4)
+# ブロック本体は Base64 を介さず生のバイト列をそのまま連結する。
+# 長さはすべて事前に分かるため、終端文字列の探索は不要。
+FRAME_MAGIC = b"MCPF"
+PROTOCOL_VERSION = 1
+
+# メッセージ種別
+MSG_JOB = 1
+MSG_HELLO = 2 # 機能ネゴシエーション (クライアント → サーバー、サーバー → クライアントの両方向)
+MSG_ACK = 3   # ジョブの受付結果 (サーバー → クライアント)。meta: seq, job_id, status ("accepted" / "rejected" / "busy" / "preview"), error
+              # meta に "preview" ("png" / "pbm") を指定したジョブは印刷せず、ROLE_PREVIEW のブロックでレンダリング結果を返す
+MSG_STATUS = 4        # ジョブの状態の問い合わせ (クライアント → サーバー)。meta: seq, job_ids
+MSG_STATUS_REPLY = 5  # 問い合わせへの応答 (サーバー → クライアント)。meta: seq, jobs ({job_id: {state, position, error}}), dedup (重複判定のカウンター)
+
+# フレームフラグ
+FLAG_COMPRESSED = 0x0001 # 圧縮されたブロックを含む
+
+# ブロックの役割
+ROLE_HEADER = 1
+ROLE_BODY_TEXT = 2
+ROLE_BODY_IMAGE = 3
+ROLE_FOOTER = 4
+ROLE_RASTER = 5 # クライアント側でレンダリング済みのレシート全体
+ROLE_PREVIEW = 6 # プレビューの応答 (MSG_ACK) に含まれるレンダリング結果の画像 (PBM / PNG)
+
+# ブロックの内容種別
+KIND_TEXT = 1
+KIND_IMAGE = 2
+KIND_RASTER = 3 # 1ビットにパック済みのラスター (MCP31PRINT.raster.RasterImage のシリアライズ形式)
+KIND_QR = 4     # QRコードのデータと説明文のリスト (UTF-8 の JSON)。画像にせずに送り、受信側で直接ラスター化する
+
+# ブロックヒント: 下位4ビットは圧縮コーデック
+HINT_CODEC_MASK = 0x000F
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+_CODEC_IDS = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+# このプロセスで利用可能なコーデック (優先度の高い順)
+SUPPORTED_CODECS = (["zstd"] if zstandard else []) + ["zlib"]
+
+# 圧縮の判定に使う閾値
+COMPRESSION_MIN_SIZE = 512           # これより小さいブロックは圧縮しない
+COMPRESSION_SAMPLE_SIZE = 16 * 1024  # 圧縮率を見積もるサンプルのサイズ
+COMPRESSION_MAX_RATIO = 0.9          # サンプルの圧縮率がこれを上回る場合は圧縮しない
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+# 既に圧縮済みで、再圧縮しても効果がない画像形式のシグネチャ
+_COMPRESSED_IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",   # JPEG
+    b"GIF87a", b"GIF89a",
+    b"RIFF",            # WebP
+)
+
+_FRAME_HEADER = struct.Struct("!4sBBHHI")
+_BLOCK_ENTRY = struct.Struct("!BBHI")
+FRAME_HEADER_SIZE = _FRAME_HEADER.size
+BLOCK_ENTRY_SIZE = _BLOCK_ENTRY.size
+
+# 旧形式 (JSON) の終端文字列
+LEGACY_TERMINATOR = b"<END_OF_TRANSMISSION>"
+
+# 受信時の作業バッファサイズと、一時ファイルへ退避するペイロードサイズの閾値
+RECV_CHUNK_SIZE = 64 * 1024
+SPILL_THRESHOLD_BYTES = 8 * 1024 * 1024
+
+_KIND_BY_TYPE = {"text": KIND_TEXT, "image": KIND_IMAGE, "raster": KIND_RASTER, "qr": KIND_QR}
+_TYPE_BY_KIND = {kind: content_type for content_type, kind in _KIND_BY_TYPE.items()}
+
+
+class FrameError(ValueError):
+    """バイナリフレームの形式が不正な場合に送出される例外"""
+    pass
 
 def _process_content(content_type, content_data):
     """ヘッダー/フッターのコンテンツを処理し、JSONに含める形式に変換するヘルパー関数"""
-    if content_type == "text":
+    if content_type in ("text", "qr"):
         return content_data
     elif content_type == "image":
         # content_data が既にバイトデータであることを想定
@@ -28,7 +116,7 @@ def _process_content(content_type, content_data):
 
 def _deprocess_content(content_type, encoded_content):
     """JSONからデコードされたコンテンツを元の形式に戻すヘルパー関数"""
-    if content_type == "text":
+    if content_type in ("text", "qr"):
         return encoded_content
     elif content_type == "image":
         if encoded_content:
@@ -40,6 +128,7 @@ def serialize_data(header=None, body_text=None, body_image_bytes_list=None, foot
     """
     ヘッダー、本文（テキストと画像バイトリスト）、フッターをJSON形式でシリアライズします。
     header/footer: {"type": "text" or "image", "content": "文字列" or "画像ファイルパス"}
+                   または {"type": "qr", "content": [{"data": QRコードのデータ, "caption": 説明文}, ...]}
     body_image_bytes_list: [画像バイトデータ1, 画像バイトデータ2, ...]
     """
     
@@ -110,4 +199,415 @@ def deserialize_data(json_data_bytes):
             "content": _deprocess_content(data["footer"].get("type"), data["footer"].get("content"))
         }
             
-    return header_data, body_text, body_image_bytes_list, footer_data
\ No newline at end of file
+    return header_data, body_text, body_image_bytes_list, footer_data
+
+
+# =================================================================
+# バイナリフレームのエンコード / デコード
+# =================================================================
+def _content_to_buffer(content_type, content_data):
+    """ヘッダー/フッターのコンテンツをブロック本体のバイト列に変換するヘルパー関数"""
+    if content_type == "text":
+        if isinstance(content_data, str):
+            return content_data.encode('utf-8')
+    elif content_type == "qr":
+        if isinstance(content_data, list):
+            return json.dumps(content_data, ensure_ascii=False).encode('utf-8')
+    elif content_type == "raster":
+        if isinstance(content_data, (bytes, bytearray, memoryview)):
+            return content_data
+    elif content_type == "image":
+        if isinstance(content_data, (bytes, bytearray, memoryview)):
+            return content_data
+        # パスが渡された場合の互換処理 (_process_content と同じ扱い)
+        elif isinstance(content_data, str) and os.path.exists(content_data):
+            try:
+                with open(content_data, "rb") as f:
+                    return f.read()
+            except IOError as e:
+                print(f"Error reading image file '{content_data}': {e}")
+                return None
+    print(f"Warning: Invalid content data for type '{content_type}': {type(content_data)}")
+    return None
+
+def negotiate_codecs(offered):
+    """相手が提示したコーデックのうち、このプロセスでも利用可能なものを優先度順に返します。"""
+    return [codec for codec in SUPPORTED_CODECS if codec in (offered or [])]
+
+def choose_codec(kind, payload, codecs):
+    """
+    ブロックの内容種別とサイズから圧縮コーデックを選びます。圧縮しない場合は CODEC_NONE を返します。
+    - 小さすぎるブロックは圧縮しない
+    - JPEG / GIF / WebP など圧縮済みの画像形式は圧縮しない
+    - それ以外は先頭のサンプルを軽く圧縮してみて、効果がある場合のみ圧縮する
+    """
+    if not codecs or payload.nbytes < COMPRESSION_MIN_SIZE:
+        return CODEC_NONE
+    if kind == KIND_IMAGE and bytes(payload[:8]).startswith(_COMPRESSED_IMAGE_SIGNATURES):
+        return CODEC_NONE
+    if kind != KIND_TEXT:
+        sample = payload[:COMPRESSION_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > sample.nbytes * COMPRESSION_MAX_RATIO:
+            return CODEC_NONE
+    return _CODEC_IDS[codecs[0]]
+
+def compress_block(codec, payload):
+    """指定されたコーデックでブロック本体を圧縮します。"""
+    if codec == CODEC_ZLIB:
+        return zlib.compress(payload, 6)
+    elif codec == CODEC_ZSTD and zstandard:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    raise FrameError(f"Unsupported codec: {codec}")
+
+def decompress_block(codec, payload, max_size=MAX_DECOMPRESSED_SIZE):
+    """
+    圧縮されたブロック本体を展開します。
+    展開後のサイズが max_size を超える場合 (圧縮爆弾対策)、圧縮データが壊れている場合や途中で切れている場合は
+    FrameError を送出します。
+    """
+    if codec == CODEC_ZLIB:
+        try:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(payload, max_size)
+            # ちょうど max_size で止まった場合は、残りが終端 (チェックサム) だけかどうかを1バイトだけ展開して確かめる
+            if decompressor.unconsumed_tail and decompressor.decompress(decompressor.unconsumed_tail, 1):
+                raise FrameError(f"Decompressed block exceeds {max_size} bytes.")
+        except zlib.error as e:
+            raise FrameError(f"Failed to decompress zlib block: {e}")
+        if not decompressor.eof:
+            raise FrameError("Compressed zlib block is truncated.")
+        return data
+    elif codec == CODEC_ZSTD and zstandard:
+        try:
+            # decompress() の max_output_size はフレームヘッダーに展開後のサイズがある場合は無視されるため、
+            # ヘッダーのサイズを確認したうえで、ストリームで max_size までしか展開しない
+            content_size = zstandard.frame_content_size(payload)
+            if content_size > max_size:
+                raise FrameError(f"Decompressed block exceeds {max_size} bytes.")
+            chunks = []
+            total = 0
+            with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+                while True:
+                    chunk = reader.read(min(RECV_CHUNK_SIZE, max_size + 1 - total))
+                    if not chunk:
+                        break
+                    total += len(chunk)
+                    if total > max_size:
+                        raise FrameError(f"Decompressed block exceeds {max_size} bytes.")
+                    chunks.append(chunk)
+            # stream_reader は途中で切れたフレームでもエラーにせず、展開できた分だけを返すため、完全性を確かめる
+            if content_size >= 0:
+                complete = total == content_size
+            else:
+                # ヘッダーにサイズがない場合は展開し直して終端を確認する (サイズは上で max_size 以下と分かっている)
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+                decompressor.decompress(payload)
+                complete = decompressor.eof
+            if not complete:
+                raise FrameError("Compressed zstd block is truncated.")
+            return b"".join(chunks)
+        except zstandard.ZstdError as e:
+            raise FrameError(f"Failed to decompress zstd block: {e}")
+    raise FrameError(f"Unsupported codec: {codec}")
+
+def encode_frame(msg_type, blocks=(), meta=None, flags=0, codecs=None):
+    """
+    バイナリフレームを組み立てます。
+    blocks: [(role, kind, hints, バイト列), ...]
+    codecs: 相手と合意済みの圧縮コーデックのリスト。指定された場合はブロックごとに圧縮の要否を判定する。
+    返り値: 送信するバッファのリスト [ヘッダー+テーブル+メタ, ブロック本体1, ...]
+    ブロック本体はコピーせずにそのまま返すため、呼び出し側は順に sendall するだけでよい。
+    """
+    meta_bytes = json.dumps(meta).encode('utf-8') if meta else b""
+    table = bytearray()
+    payloads = []
+    for role, kind, hints, payload in blocks:
+        payload = memoryview(payload).cast('B')
+        codec = choose_codec(kind, payload, codecs)
+        if codec != CODEC_NONE:
+            compressed = compress_block(codec, payload)
+            if len(compressed) < payload.nbytes:
+                payload = memoryview(compressed)
+                hints = (hints & ~HINT_CODEC_MASK) | codec
+                flags |= FLAG_COMPRESSED
+        table += _BLOCK_ENTRY.pack(role, kind, hints, payload.nbytes)
+        payloads.append(payload)
+    header = _FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, msg_type, flags, len(blocks), len(meta_bytes))
+    return [header + bytes(table) + meta_bytes] + payloads
+
+def serialize_frame(header=None, body_text=None, body_image_bytes_list=None, footer=None, meta=None, codecs=None):
+    """
+    serialize_data と同じ引数を受け取り、バイナリフレーム (送信バッファのリスト) を返します。
+    画像は Base64 化せず生のバイト列のままブロックに格納されます。
+    codecs: サーバーと合意済みの圧縮コーデック (Noneの場合は圧縮しない)
+    """
+    blocks = []
+
+    if header and "type" in header and "content" in header and header["type"] in _KIND_BY_TYPE:
+        buf = _content_to_buffer(header["type"], header["content"])
+        if buf is not None:
+            blocks.append((ROLE_HEADER, _KIND_BY_TYPE[header["type"]], 0, buf))
+
+    if body_text:
+        blocks.append((ROLE_BODY_TEXT, KIND_TEXT, 0, body_text.encode('utf-8')))
+
+    if body_image_bytes_list:
+        for img_bytes in body_image_bytes_list:
+            if isinstance(img_bytes, (bytes, bytearray, memoryview)):
+                blocks.append((ROLE_BODY_IMAGE, KIND_IMAGE, 0, img_bytes))
+            else:
+                print(f"Warning: Expected bytes for body image, but got {type(img_bytes)}. Skipping.")
+
+    if footer and "type" in footer and "content" in footer and footer["type"] in _KIND_BY_TYPE:
+        buf = _content_to_buffer(footer["type"], footer["content"])
+        if buf is not None:
+            blocks.append((ROLE_FOOTER, _KIND_BY_TYPE[footer["type"]], 0, buf))
+
+    return encode_frame(MSG_JOB, blocks, meta=meta, codecs=codecs)
+
+def serialize_raster_frame(raster_bytes, meta=None, codecs=None):
+    """
+    クライアント側でレンダリング済みのラスター (RasterImage.to_bytes() の結果) を1ブロックだけ持つ
+    ジョブのフレームを返します。サーバーは再レンダリングせずにそのままプリンターへ送信します。
+    """
+    return encode_frame(MSG_JOB, [(ROLE_RASTER, KIND_RASTER, 0, raster_bytes)], meta=meta, codecs=codecs)
+
+def is_binary_frame(data):
+    """受信データの先頭がバイナリフレームのマジックかどうかを返します。"""
+    return bytes(data[:len(FRAME_MAGIC)]) == FRAME_MAGIC
+
+def parse_frame_header(data):
+    """
+    フレームヘッダーを解析します。
+    返り値: (msg_type, flags, block_count, meta_len)
+    """
+    if len(data) < FRAME_HEADER_SIZE:
+        raise FrameError("Frame header is truncated.")
+    magic, version, msg_type, flags, block_count, meta_len = _FRAME_HEADER.unpack_from(data, 0)
+    if magic != FRAME_MAGIC:
+        raise FrameError("Invalid frame magic.")
+    if version != PROTOCOL_VERSION:
+        raise FrameError(f"Unsupported protocol version: {version}")
+    return msg_type, flags, block_count, meta_len
+
+def parse_block_table(data, block_count, offset=FRAME_HEADER_SIZE):
+    """ブロックテーブルを解析し、[(role, kind, hints, length), ...] を返します。"""
+    if len(data) < offset + block_count * BLOCK_ENTRY_SIZE:
+        raise FrameError("Block table is truncated.")
+    return [_BLOCK_ENTRY.unpack_from(data, offset + i * BLOCK_ENTRY_SIZE) for i in range(block_count)]
+
+def _parse_meta(view, offset, meta_len):
+    """メタデータ (JSON のオブジェクト) を解析します。形式が不正な場合は FrameError を送出します。"""
+    if view.nbytes < offset + meta_len:
+        raise FrameError("Frame metadata is truncated.")
+    try:
+        meta = json.loads(bytes(view[offset:offset + meta_len]).decode('utf-8')) if meta_len else {}
+    except ValueError as e: # JSONDecodeError / UnicodeDecodeError
+        raise FrameError(f"Invalid frame metadata: {e}")
+    if not isinstance(meta, dict):
+        raise FrameError("Frame metadata must be a JSON object.")
+    return meta
+
+def decode_frame_meta(data):
+    """
+    バイナリフレームのヘッダーとメタデータだけを解析します (ブロック本体は読まず、展開もしません)。
+    返り値: (msg_type, flags, meta)
+    """
+    view = memoryview(data).cast('B')
+    msg_type, flags, block_count, meta_len = parse_frame_header(view)
+    parse_block_table(view, block_count)
+    return msg_type, flags, _parse_meta(view, FRAME_HEADER_SIZE + block_count * BLOCK_ENTRY_SIZE, meta_len)
+
+def decode_frame(data):
+    """
+    バイナリフレームをデコードします。
+    返り値: (msg_type, flags, meta, blocks)
+    blocks: [(role, kind, hints, memoryview), ...]  ※元のバッファを参照するスライスでコピーは発生しない
+    圧縮されたブロックは展開して返し、hints のコーデック部分は CODEC_NONE に戻します。
+    """
+    view = memoryview(data).cast('B')
+    msg_type, flags, block_count, meta_len = parse_frame_header(view)
+    table = parse_block_table(view, block_count)
+
+    offset = FRAME_HEADER_SIZE + block_count * BLOCK_ENTRY_SIZE
+    meta = _parse_meta(view, offset, meta_len)
+    offset += meta_len
+
+    blocks = []
+    for role, kind, hints, length in table:
+        if offset + length > view.nbytes:
+            raise FrameError("Block payload is truncated.")
+        payload = view[offset:offset + length]
+        codec = hints & HINT_CODEC_MASK
+        if codec != CODEC_NONE:
+            payload = memoryview(decompress_block(codec, payload))
+            hints &= ~HINT_CODEC_MASK
+        blocks.append((role, kind, hints, payload))
+        offset += length
+    return msg_type, flags, meta, blocks
+
+def _block_to_content(kind, payload):
+    """ブロック本体を header/footer 形式の {"type", "content"} に戻すヘルパー関数"""
+    content_type = _TYPE_BY_KIND.get(kind)
+    if content_type == "text":
+        return {"type": "text", "content": str(payload, 'utf-8')}
+    elif content_type == "qr":
+        return {"type": "qr", "content": json.loads(str(payload, 'utf-8'))}
+    elif content_type in ("image", "raster"):
+        return {"type": content_type, "content": payload}
+    print(f"Warning: Unknown block kind {kind}. Skipping.")
+    return None
+
+def deserialize_job(data):
+    """
+    受信データ (バイナリフレーム / 旧JSON) を印刷ジョブの辞書にデシリアライズします。
+    返り値: {"header", "body_text", "body_images", "footer", "raster", "meta"}
+      header/footer: {"type": "text" / "image" / "raster" / "qr", "content": ...} または None
+      raster: レンダリング済みのレシート全体 (ROLE_RASTER) の memoryview または None
+      meta: ジョブのメタデータ (旧JSON形式の場合は空の辞書)
+    画像やラスターのバイトデータは受信バッファを参照する memoryview として返されます。
+    """
+    job = {"header": None, "body_text": "", "body_images": [], "footer": None, "raster": None, "meta": {}}
+    if not is_binary_frame(data):
+        # json.loads は bytes / bytearray をそのまま受け付けるため、memoryview の場合のみ変換する
+        header_data, body_text, body_image_bytes_list, footer_data = deserialize_data(
+            data if isinstance(data, (bytes, bytearray)) else bytes(data))
+        job.update(header=header_data, body_text=body_text, body_images=body_image_bytes_list, footer=footer_data)
+        return job
+
+    msg_type, _, meta, blocks = decode_frame(data)
+    if msg_type != MSG_JOB:
+        raise FrameError(f"Unexpected message type for a print job: {msg_type}")
+    job["meta"] = meta
+    for role, kind, _, payload in blocks:
+        if role == ROLE_HEADER:
+            job["header"] = _block_to_content(kind, payload)
+        elif role == ROLE_BODY_TEXT:
+            job["body_text"] = str(payload, 'utf-8')
+        elif role == ROLE_BODY_IMAGE:
+            job["body_images"].append(payload)
+        elif role == ROLE_FOOTER:
+            job["footer"] = _block_to_content(kind, payload)
+        elif role == ROLE_RASTER and kind == KIND_RASTER:
+            job["raster"] = payload
+    return job
+
+def deserialize_payload(data):
+    """
+    受信データの形式 (バイナリフレーム / 旧JSON) を判別してデシリアライズします。
+    返り値は deserialize_data と同じ形式です (レンダリング済みラスターとメタデータは含まれません)。
+    """
+    job = deserialize_job(data)
+    return job["header"], job["body_text"], job["body_images"], job["footer"]
+
+
+# =================================================================
+# ソケット送受信ヘルパー
+# =================================================================
+def send_buffers(sock, buffers):
+    """encode_frame が返したバッファのリストを、結合せずに順番に送信します。"""
+    for buf in buffers:
+        sock.sendall(buf)
+
+def recv_into_exact(sock, view):
+    """memoryview の領域がすべて埋まるまで recv_into で受信します。途中で切断された場合は ConnectionError を送出します。"""
+    filled = 0
+    total = view.nbytes
+    while filled < total:
+        n = sock.recv_into(view[filled:], total - filled)
+        if n == 0:
+            raise ConnectionError(f"Connection closed with {total - filled} bytes remaining.")
+        filled += n
+
+def recv_exact(sock, size):
+    """ちょうど size バイト受信して bytearray で返します。"""
+    buf = bytearray(size)
+    recv_into_exact(sock, memoryview(buf))
+    return buf
+
+def _recv_into_file(sock, f, size, chunk_size=RECV_CHUNK_SIZE):
+    """size バイトを固定長の作業バッファ経由でファイルに書き出します (メモリ使用量は chunk_size で一定)。"""
+    chunk = bytearray(min(chunk_size, max(size, 1)))
+    chunk_view = memoryview(chunk)
+    remaining = size
+    while remaining > 0:
+        n = sock.recv_into(chunk_view, min(remaining, len(chunk)))
+        if n == 0:
+            raise ConnectionError(f"Connection closed with {remaining} bytes remaining.")
+        f.write(chunk_view[:n])
+        remaining -= n
+
+class PayloadTooLargeError(FrameError):
+    """メッセージが許容サイズを超えている場合に送出される例外"""
+    pass
+
+def frame_total_length(prefix, block_count, meta_len):
+    """フレームヘッダーとブロックテーブル (prefix) から、フレーム全体のバイト数を求めます。"""
+    table = parse_block_table(prefix, block_count)
+    return len(prefix) + meta_len + sum(length for _, _, _, length in table)
+
+def recv_message(sock, spill_threshold=SPILL_THRESHOLD_BYTES, spill_dir=None, max_size=None):
+    """
+    1メッセージ分を受信して返します (バイナリフレーム / 旧JSON形式の両方に対応)。
+    バイナリフレームは長さ情報から全体サイズを求め、事前確保したバッファに recv_into で直接受信します。
+    全体サイズが spill_threshold を超える場合は一時ファイルに書き出して mmap した memoryview を返すため、
+    大きな画像ジョブでもメモリ使用量は一定に保たれます。
+    旧形式は LEGACY_TERMINATOR を受信するまで読み込み、終端文字列を取り除いた bytearray を返します。
+    max_size を超えるメッセージは受信せずに PayloadTooLargeError を送出します。
+    接続が何も送らずに閉じられた場合は None を返します。
+    """
+    magic = bytearray(len(FRAME_MAGIC))
+    n = sock.recv_into(magic)
+    if n == 0:
+        return None
+    if n < len(magic):
+        recv_into_exact(sock, memoryview(magic)[n:])
+    if magic != FRAME_MAGIC:
+        return _recv_legacy(sock, magic, max_size)
+
+    header = magic + recv_exact(sock, FRAME_HEADER_SIZE - len(magic))
+    _, _, block_count, meta_len = parse_frame_header(header)
+    prefix = header + recv_exact(sock, block_count * BLOCK_ENTRY_SIZE)
+    total = frame_total_length(prefix, block_count, meta_len)
+    if max_size is not None and total > max_size:
+        raise PayloadTooLargeError(f"Message of {total} bytes exceeds the limit of {max_size} bytes.")
+    body_len = total - len(prefix)
+
+    if total <= spill_threshold:
+        buf = bytearray(total)
+        view = memoryview(buf)
+        view[:len(prefix)] = prefix
+        recv_into_exact(sock, view[len(prefix):])
+        return view
+
+    # 大きなペイロードは一時ファイルへ書き出して mmap する
+    with tempfile.TemporaryFile(dir=spill_dir) as f:
+        f.write(prefix)
+        _recv_into_file(sock, f, body_len)
+        f.flush()
+        mapped = mmap.mmap(f.fileno(), total, access=mmap.ACCESS_READ)
+    return memoryview(mapped)
+
+def _recv_legacy(sock, initial, max_size=None):
+    """
+    旧JSON形式を終端文字列まで受信します。
+    伸長する bytearray に recv_into で直接受信し、終端の探索は新しく届いた部分の周辺だけを対象にします。
+    """
+    buf = bytearray(max(len(initial) * 2, RECV_CHUNK_SIZE))
+    buf[:len(initial)] = initial
+    size = len(initial)
+    end = buf.find(LEGACY_TERMINATOR, 0, size)
+    while end < 0:
+        if max_size is not None and size > max_size:
+            raise PayloadTooLargeError(f"Legacy message exceeds the limit of {max_size} bytes.")
+        if size == len(buf):
+            buf.extend(bytes(len(buf))) # 容量を倍にする (償却で線形)
+        with memoryview(buf) as view:
+            n = sock.recv_into(view[size:])
+        if n == 0:
+            break
+        # 終端文字列がチャンクの境界をまたぐ場合に備え、直前の末尾を少しだけ含めて探索する
+        end = buf.find(LEGACY_TERMINATOR, max(0, size - len(LEGACY_TERMINATOR) + 1), size + n)
+        size += n
+    del buf[end if end >= 0 else size:]
+    return buf
@@ -0,0 +1,158 @@
+# server/admission.py
+
+import heapq
+import itertools
+import threading
+import time
+
+class TokenBucket:
+    """
+    送信元ごとのレート制限に使うトークンバケット。
+    rate 件/秒でトークンが補充され、最大 burst 件まで貯まる。ジョブ1件でトークンを1つ消費する。
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def try_take(self) -> float:
+        """
+        トークンを1つ消費する。
+        返り値: 消費できた場合は 0。トークンが足りない場合は、次のトークンが貯まるまでの秒数
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class FairJobQueue:
+    """
+    送信元ごとの重み付き公平キュー (Weighted Fair Queuing)。
+    プリントキュー (queue.Queue) と同じ put / get / task_done / qsize で使える。
+    各ジョブに「送信元の前のジョブの終了時刻と現在の仮想時刻の遅い方 + 1 / 重み」の仮想終了時刻を付け、
+    その小さい順に取り出す。大量に送る送信元のジョブは後ろに並ぶため、
+    ジョブの少ない送信元の待ち時間は他の送信元の量に関係なく抑えられる。同じ送信元のジョブは受付順に取り出される。
+    """
+    def __init__(self, weights: dict = None):
+        """
+        :param weights: 送信元 -> 重み の辞書。指定のない送信元の重みは 1
+        """
+        self.weights = weights or {}
+        self._heap = []                  # (仮想終了時刻, 受付番号, 送信元, ジョブ)
+        self._counter = itertools.count()
+        self._last_finish = {}           # 送信元 -> 最後に追加したジョブの仮想終了時刻
+        self._virtual_time = 0.0         # 最後に取り出したジョブの仮想終了時刻
+        self._unfinished = 0
+        self._cond = threading.Condition()
+
+    def put(self, job: dict, source: str = None):
+        with self._cond:
+            start = max(self._virtual_time, self._last_finish.get(source, 0.0))
+            finish = start + 1.0 / self.weights.get(source, 1)
+            self._last_finish[source] = finish
+            heapq.heappush(self._heap, (finish, next(self._counter), source, job))
+            self._unfinished += 1
+            self._cond.notify()
+
+    def get(self) -> dict:
+        with self._cond:
+            while not self._heap:
+                self._cond.wait()
+            finish, _, source, job = heapq.heappop(self._heap)
+            self._virtual_time = finish
+            if not any(entry[2] == source for entry in self._heap):
+                # キューに残っていない送信元の記録は消す (後から来ても現在の仮想時刻から並ぶ)
+                self._last_finish.pop(source, None)
+            return job
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def position(self, job_id: str) -> int | None:
+        """キュー内のジョブの位置 (1 = 次に取り出される) を返す。キューにない場合は None"""
+        with self._cond:
+            for i, entry in enumerate(sorted(self._heap, key=lambda entry: entry[:2]), start=1):
+                if entry[3]["job_id"] == job_id:
+                    return i
+        return None
+
+class AdmissionController:
+    """
+    ジョブの受付可否を判断するクラス。
+    - プリントキューの件数 (受付処理中のジョブを含む) が max_depth に達している場合
+    - 送信元のトークンバケットが空の場合
+    のどちらかに当てはまるジョブは受け付けず、何秒後に再送すればよいかを返す。
+    トークンバケットは接続元のアドレスと送信元のタグの組ごとに持ち、さらに接続元のアドレスごとの合計も
+    その peer_sources 倍までに制限する (タグはクライアントが自由に指定できるため、タグを変えるだけでは制限を回避できないようにする)。
+    満杯まで補充された (しばらく使われていない) バケットは新しく作るのと同じなので、定期的に捨てる。
+    受け付けたジョブは、プリントキューに入れた (または受付を取り消した) 後に settle を呼ぶこと。
+    """
+    def __init__(self, job_queue: FairJobQueue, max_depth: int, rate: float, burst: int, busy_retry_after: float,
+                 peer_sources: int = 4):
+        """
+        :param job_queue: プリントキュー
+        :param max_depth: プリントキューに置けるジョブの最大数
+        :param rate: 送信元ごとに受け付けるジョブの平均レート (件/秒)
+        :param burst: 送信元ごとに連続して受け付けるジョブの最大数
+        :param busy_retry_after: キューが満杯の場合に返す再送までの秒数
+        :param peer_sources: 接続元のアドレスごとの合計のレートと連続数 (rate / burst の何倍か)
+        """
+        self.job_queue = job_queue
+        self.max_depth = max_depth
+        self.rate = rate
+        self.burst = burst
+        self.busy_retry_after = busy_retry_after
+        self.peer_sources = peer_sources
+        self._buckets = {} # (接続元のアドレス, 送信元) -> TokenBucket。接続元ごとの合計は (接続元のアドレス, None)
+        self._idle_seconds = burst / rate # 空のバケットが満杯に戻るまでの時間
+        self._last_sweep = time.monotonic()
+        self._reserved = 0 # admit で受け付けて、まだプリントキューに入っていないジョブの数
+        self._lock = threading.Lock()
+
+    def _evict_idle(self, now: float):
+        """満杯まで補充されたバケットを捨てる (_idle_seconds ごとに1回)"""
+        if now - self._last_sweep < self._idle_seconds:
+            return
+        self._last_sweep = now
+        for key in [key for key, bucket in self._buckets.items() if now - bucket.updated_at >= self._idle_seconds]:
+            del self._buckets[key]
+
+    def admit(self, source: str, peer: str = None) -> float:
+        """
+        送信元 source のジョブを1件受け付けられるかを判断する。
+        :param peer: 接続元のアドレス (レート制限は peer と source の組ごとに行う)
+        返り値: 受け付ける場合は 0。受け付けない場合は再送までの秒数
+        """
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            # 複数の接続で同時に受付処理をしても max_depth を超えないよう、受付処理中のジョブも数える
+            if self.job_queue.qsize() + self._reserved >= self.max_depth:
+                return self.busy_retry_after
+            peer_bucket = self._buckets.get((peer, None))
+            if peer_bucket is None:
+                peer_bucket = self._buckets[(peer, None)] = TokenBucket(self.rate * self.peer_sources, self.burst * self.peer_sources)
+            bucket = self._buckets.get((peer, source))
+            if bucket is None:
+                bucket = self._buckets[(peer, source)] = TokenBucket(self.rate, self.burst)
+            retry_after = peer_bucket.try_take()
+            if not retry_after:
+                retry_after = bucket.try_take()
+                if retry_after:
+                    peer_bucket.tokens += 1 # 受け付けなかったジョブの分を戻す
+            if not retry_after:
+                self._reserved += 1
+            return retry_after
+
+    def settle(self):
+        """admit で受け付けたジョブをプリントキューに入れた (または受付を取り消した) ことを記録する"""
+        with self._lock:
+            self._reserved -= 1
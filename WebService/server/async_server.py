@@ -0,0 +1,155 @@
+# server/async_server.py
+
+import asyncio
+import mmap
+import tempfile
+import time
+
+from common.network_utils import (
+    is_binary_frame, parse_frame_header, frame_total_length, PayloadTooLargeError, FRAME_MAGIC, FRAME_HEADER_SIZE,
+    BLOCK_ENTRY_SIZE, LEGACY_TERMINATOR, RECV_CHUNK_SIZE, SPILL_THRESHOLD_BYTES
+)
+from .server import FileReceiverServer
+
+class AsyncFileReceiverServer(FileReceiverServer):
+    """
+    asyncio.start_server で接続を処理する FileReceiverServer。
+    接続ごとにスレッドを作らないため、アイドル接続や低速な接続が大量にあってもほとんどコストがかからない。
+    - 同時接続数の上限 (MAX_CONNECTIONS) を超えた接続は即座に閉じる
+    - 1メッセージの受信に READ_TIMEOUT_SECONDS 以上かかる接続
+      (または CONNECTION_IDLE_TIMEOUT_SECONDS 以上何も送らない接続) は切断する
+    - MAX_PAYLOAD_BYTES を超えるメッセージは受信せずに切断する
+    - メッセージの処理 (デコード・プレビューのレンダリング・重複判定・スプールへの書き込み) は別スレッドで行い、
+      イベントループを止めない
+    - プリントキューが MAX_QUEUE_DEPTH に達している場合は "busy" の ACK と再送までの秒数を返す (背圧)
+    プリンターワーカーやジョブ管理は FileReceiverServer のものをそのまま使う。
+    """
+    def __init__(self):
+        super().__init__()
+        self.active_connections = 0
+
+    async def _read_body(self, reader, prefix, total):
+        """
+        フレームの残り (total - len(prefix) バイト) を受信し、フレーム全体を返す。
+        SPILL_THRESHOLD_BYTES を超える場合は一時ファイルに書き出して mmap した memoryview を返す。
+        """
+        remaining = total - len(prefix)
+        if total <= SPILL_THRESHOLD_BYTES:
+            buf = bytearray(total)
+            view = memoryview(buf)
+            view[:len(prefix)] = prefix
+            pos = len(prefix)
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, RECV_CHUNK_SIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(bytes(view[:pos]), total)
+                view[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+                remaining -= len(chunk)
+            return view
+
+        with tempfile.TemporaryFile(dir=self.output_dir) as f:
+            f.write(prefix)
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, RECV_CHUNK_SIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", total)
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), total, access=mmap.ACCESS_READ)
+        return memoryview(mapped)
+
+    async def _read_legacy(self, reader, initial):
+        """旧JSON形式を終端文字列まで受信する (終端の探索は新しく届いた部分の周辺だけを対象にする)"""
+        max_size = self.config.MAX_PAYLOAD_BYTES
+        buf = bytearray(initial)
+        end = buf.find(LEGACY_TERMINATOR)
+        while end < 0:
+            if len(buf) > max_size:
+                raise PayloadTooLargeError(f"Legacy message exceeds the limit of {max_size} bytes.")
+            chunk = await reader.read(RECV_CHUNK_SIZE)
+            if not chunk:
+                break
+            start = max(0, len(buf) - len(LEGACY_TERMINATOR) + 1)
+            buf += chunk
+            end = buf.find(LEGACY_TERMINATOR, start)
+        del buf[end if end >= 0 else len(buf):]
+        return buf
+
+    async def _read_message(self, reader):
+        """
+        1メッセージ分を受信して返す (network_utils.recv_message の asyncio 版)。
+        次のメッセージの先頭を待つ間は CONNECTION_IDLE_TIMEOUT_SECONDS、
+        先頭が届いてからメッセージ全体を受信し終えるまでは READ_TIMEOUT_SECONDS で打ち切る。
+        接続が何も送らずに閉じられた場合は None を返す。
+        """
+        try:
+            magic = await asyncio.wait_for(reader.readexactly(len(FRAME_MAGIC)), self.config.CONNECTION_IDLE_TIMEOUT_SECONDS)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        started_at = time.monotonic()
+        data_buffer = await asyncio.wait_for(self._read_rest(reader, magic), self.config.READ_TIMEOUT_SECONDS)
+        self.metrics.observe("stage_duration_seconds", time.monotonic() - started_at, stage="receive")
+        return data_buffer
+
+    async def _read_rest(self, reader, magic):
+        """先頭4バイトに続くメッセージの残りを受信する"""
+        if magic != FRAME_MAGIC:
+            return await self._read_legacy(reader, magic)
+
+        header = magic + await reader.readexactly(FRAME_HEADER_SIZE - len(magic))
+        _, _, block_count, meta_len = parse_frame_header(header)
+        prefix = header + await reader.readexactly(block_count * BLOCK_ENTRY_SIZE)
+        total = frame_total_length(prefix, block_count, meta_len)
+        if total > self.config.MAX_PAYLOAD_BYTES:
+            raise PayloadTooLargeError(f"Message of {total} bytes exceeds the limit of {self.config.MAX_PAYLOAD_BYTES} bytes.")
+        return await self._read_body(reader, prefix, total)
+
+    async def _handle_connection(self, reader, writer):
+        """1つの接続で届くメッセージをループで処理する (FileReceiverServer._handle_client の asyncio 版)"""
+        addr = writer.get_extra_info("peername")
+        if self.active_connections >= self.config.MAX_CONNECTIONS:
+            print(f"Too many connections ({self.active_connections}). Closing connection from {addr}.")
+            writer.close()
+            return
+
+        self.active_connections += 1
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data_buffer = await self._read_message(reader)
+                if data_buffer is None:
+                    break
+
+                # 受付とレンダリングはイベントループを止めないよう別スレッドで行う
+                if not is_binary_frame(data_buffer):
+                    await loop.run_in_executor(None, self._accept_job, data_buffer, addr)
+                    break
+
+                reply = await loop.run_in_executor(None, self._handle_message, data_buffer, addr)
+                writer.writelines(reply)
+                await writer.drain()
+
+        except asyncio.TimeoutError:
+            print(f"Connection with {addr} timed out.")
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f"Connection with {addr} was closed unexpectedly: {e}")
+        except Exception as e:
+            print(f"Error handling client {addr}: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            self.active_connections -= 1
+            writer.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port, reuse_address=True)
+        print(f"Async server listening on {self.host}:{self.port} (max connections: {self.config.MAX_CONNECTIONS})")
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        asyncio.run(self._serve())
@@ -12,6 +12,99 @@ class BaseServerConfig(ABC):
     def SERVER_PORT(self):
         pass
 
+    # 以下は任意の設定項目。必要に応じて継承したファイルで上書きする。
+    @property
+    def CONNECTION_IDLE_TIMEOUT_SECONDS(self):
+        return 60 # 永続接続でメッセージが届かない場合に切断するまでの秒数
+
+    @property
+    def SERVER_MODE(self):
+        return "thread" # "thread": 接続ごとにスレッド / "asyncio": asyncio.start_server による単一スレッド
+
+    @property
+    def MAX_CONNECTIONS(self):
+        return 256 # asyncio モードで同時に受け付ける接続数の上限
+
+    @property
+    def READ_TIMEOUT_SECONDS(self):
+        return 30 # asyncio モードで1メッセージの受信にかけられる最大秒数
+
+    @property
+    def MAX_PAYLOAD_BYTES(self):
+        return 64 * 1024 * 1024 # 1メッセージの最大サイズ
+
+    @property
+    def RENDER_WORKERS(self):
+        return 2 # ジョブを並行してレンダリングするワーカー数
+
+    @property
+    def RENDER_LOOKAHEAD(self):
+        return 2 # 印刷中に先にレンダリングしておくジョブの最大数
+
+    @property
+    def MAX_QUEUE_DEPTH(self):
+        return 100 # プリントキューに置けるジョブの最大数 (超えた場合は "busy" を返す)
+
+    @property
+    def SOURCE_RATE_PER_SECOND(self):
+        return 0.5 # 送信元ごとに受け付けるジョブの平均レート (件/秒)
+
+    @property
+    def SOURCE_BURST(self):
+        return 10 # 送信元ごとに連続して受け付けるジョブの最大数
+
+    @property
+    def SOURCES_PER_PEER(self):
+        return 4 # 接続元のアドレスごとの合計のレートと連続数 (SOURCE_RATE_PER_SECOND / SOURCE_BURST の何倍か)
+
+    @property
+    def BUSY_RETRY_AFTER_SECONDS(self):
+        return 10 # キューが満杯の場合にクライアントへ返す再送までの秒数
+
+    @property
+    def SOURCE_WEIGHTS(self):
+        return {} # 送信元 -> 公平キューでの重み (指定のない送信元は 1)。例: {"google_forms": 2}
+
+    @property
+    def COALESCE_JOBS(self):
+        return False # True の場合、続けて待っている短いジョブをまとめて1回で印刷する
+
+    @property
+    def COALESCE_WINDOW_SECONDS(self):
+        return 0.5 # まとめる際に次のジョブのレンダリング完了を待つ最大秒数
+
+    @property
+    def COALESCE_MAX_JOB_HEIGHT(self):
+        return 800 # まとめる対象にするジョブの最大の長さ (ドット)
+
+    @property
+    def COALESCE_MAX_HEIGHT(self):
+        return 4000 # まとめて印刷する長さの上限 (ドット)
+
+    @property
+    def COALESCE_PARTIAL_CUT(self):
+        return False # True の場合はジョブの間でパーシャルカットし、False の場合は区切り線を挟んで連結する
+
+    @property
+    def DEDUP_WINDOW_SECONDS(self):
+        return 300 # 同じ内容のジョブを重複とみなす時間 (秒)
+
+    @property
+    def METRICS_PORT(self):
+        return 9108 # Prometheus 形式のメトリクスを公開する HTTP ポート (None の場合は公開しない)
+
+    @property
+    def METRICS_HOST(self):
+        return "127.0.0.1" # メトリクスを公開するアドレス (他のホストから収集する場合は SERVER_IP などに変更する)
+
+    @property
+    def NATIVE_TEXT(self):
+        return False # True の場合、テキストはラスターにせずプリンター内蔵の漢字フォントで印刷する (表せない文字を含む行と画像はラスター)
+
+    @property
+    def HTTP_INGEST_PORT(self):
+        return None # HTTP (POST /jobs) でジョブを受け付けるポート (例: 8080。認証がないため信頼できるネットワークでのみ有効にする)
+
 class ServerConfig(BaseServerConfig):
     # このファイルはGitHubにアップロードされます
     # 実際の値はここで直接記述せず、継承したファイルで指定します。
@@ -0,0 +1,119 @@
+# server/dedup.py
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# ハッシュに含めないメタデータ (送信ごとに変わる値や、内容に影響しない値)。送信元はキーで区別する (DuplicateFilter.key_for)
+VOLATILE_META_FIELDS = ("seq", "source", "idempotency_key", "sent_at")
+
+# DuplicateFilter.reserve の返り値: 同じキーのジョブが別の接続で受付処理中
+IN_PROGRESS = "in_progress"
+
+def job_content_key(job: dict) -> str:
+    """
+    デシリアライズしたジョブの内容から重複判定用のキーを計算する。
+    ヘッダー、本文テキスト、本文画像、フッター、ラスターと、VOLATILE_META_FIELDS 以外のメタデータをハッシュする。
+    """
+    h = hashlib.blake2b(digest_size=16)
+
+    def update(tag: bytes, payload):
+        # 要素の境界が曖昧にならないよう、種類と長さを先に入れる
+        if not isinstance(payload, (str, bytes, bytearray, memoryview)):
+            # "qr" の内容 ([{"data", "caption"}, ...]) など、構造を持つ内容は正規化した JSON にする
+            payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        payload = payload.encode("utf-8") if isinstance(payload, str) else payload
+        h.update(tag + len(payload).to_bytes(8, "big"))
+        h.update(payload)
+
+    for tag, content in ((b"H", job["header"]), (b"F", job["footer"])):
+        if isinstance(content, dict):
+            update(tag + str(content.get("type")).encode("utf-8"), content.get("content") or b"")
+        elif content is not None:
+            update(tag, content)
+    update(b"T", job["body_text"] or "")
+    for image in job["body_images"]:
+        update(b"I", image)
+    if job["raster"] is not None:
+        update(b"R", job["raster"])
+    stable_meta = {k: v for k, v in job["meta"].items() if k not in VOLATILE_META_FIELDS}
+    update(b"M", json.dumps(stable_meta, sort_keys=True))
+    return h.hexdigest()
+
+class DuplicateFilter:
+    """
+    一定時間内に届いた同じジョブを検出するクラス。
+    Discord のメッセージ編集、クライアントの再送、Google Forms の行の再読み込みなどで
+    同じレシートが二重に印刷されることを防ぐ。
+    送信元が meta の "idempotency_key" を指定した場合はそのキーで、指定しない場合は内容のハッシュで判定する。
+    受付処理の間は reserve でキーを予約しておき、同時に届いた再送が二重に受け付けられないようにする。
+    """
+    def __init__(self, window_seconds: float = 300, max_entries: int = 10000):
+        """
+        :param window_seconds: 同じジョブとみなす時間 (秒)
+        :param max_entries: 記録するジョブの最大数
+        """
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._seen = OrderedDict() # キー -> (ジョブ ID (予約中は None), 受付時刻) (古い順)
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def key_for(job: dict, source: str) -> str:
+        """ジョブの重複判定用のキーを返す (idempotency_key も内容のハッシュも送信元ごとに区別する)"""
+        idempotency_key = job["meta"].get("idempotency_key")
+        if idempotency_key:
+            return f"key:{source}:{idempotency_key}"
+        return f"hash:{source}:{job_content_key(job)}"
+
+    def _expire(self, now: float):
+        while self._seen:
+            _, (_, seen_at) = next(iter(self._seen.items()))
+            if now - seen_at <= self.window_seconds and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def reserve(self, key: str, still_valid=None) -> str | None:
+        """
+        キーが時間内に受け付けたジョブと同じであれば、そのジョブ ID を返す。
+        同じキーのジョブが受付処理中であれば IN_PROGRESS を返す。
+        どちらでもなければキーを予約して None を返す (受付後に commit、受付できなかった場合は release を呼ぶこと)。
+        :param still_valid: ジョブ ID を受け取り、そのジョブを重複の対象とするかを返す関数。
+                            False を返した場合 (印刷に失敗したジョブなど) は記録を消して新しく予約する。
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self.checked += 1
+            entry = self._seen.get(key)
+            if entry is not None and entry[0] is None:
+                self.duplicates += 1
+                return IN_PROGRESS
+            if entry is not None and (still_valid is None or still_valid(entry[0])):
+                self.duplicates += 1
+                return entry[0]
+            self._seen[key] = (None, now)
+            self._seen.move_to_end(key)
+            return None
+
+    def commit(self, key: str, job_id: str):
+        """予約したキーに受け付けたジョブを記録する"""
+        with self._lock:
+            self._seen[key] = (job_id, time.monotonic())
+            self._seen.move_to_end(key)
+            self._expire(time.monotonic())
+
+    def release(self, key: str):
+        """受け付けなかったジョブの予約を取り消す"""
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and entry[0] is None:
+                del self._seen[key]
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {"checked": self.checked, "duplicates": self.duplicates, "tracked": len(self._seen)}
@@ -0,0 +1,267 @@
+# server/http_ingest.py
+
+import json
+import mmap
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from common.network_utils import serialize_frame, RECV_CHUNK_SIZE
+
+class RequestTooLargeError(ValueError):
+    """リクエストボディが上限を超えた場合に送出される例外"""
+    pass
+
+# クエリ文字列 (または同名のフォームフィールド) でジョブのメタデータに設定できる項目
+_META_FIELDS = ("source", "idempotency_key")
+
+# ACK の status -> HTTP ステータスコード
+_HTTP_STATUS = {"accepted": 202, "busy": 503, "rejected": 400}
+
+_PART_NAME = re.compile(r'\bname="([^"]*)"', re.IGNORECASE)
+_PART_FILENAME = re.compile(r'\bfilename="([^"]*)"', re.IGNORECASE)
+
+def _parse_multipart(mapped, boundary: bytes) -> list:
+    """
+    mmap した multipart/form-data のボディをパートに分割する。
+    返り値: [(name, filename, 内容の memoryview)]。内容は mmap を参照し、コピーしない。
+    """
+    view = memoryview(mapped)
+    delimiter = b"--" + boundary
+    parts = []
+    pos = mapped.find(delimiter)
+    while pos >= 0:
+        pos += len(delimiter)
+        if mapped[pos:pos + 2] == b"--":
+            break # 終端
+        pos = mapped.find(b"\r\n", pos) + 2
+        header_end = mapped.find(b"\r\n\r\n", pos)
+        if header_end < 0:
+            raise ValueError("Malformed multipart part headers.")
+        headers = bytes(view[pos:header_end]).decode("utf-8", "replace")
+        data_start = header_end + 4
+        data_end = mapped.find(b"\r\n" + delimiter, data_start)
+        if data_end < 0:
+            raise ValueError("Multipart body is not terminated.")
+        name = _PART_NAME.search(headers)
+        filename = _PART_FILENAME.search(headers)
+        parts.append((name.group(1) if name else "", filename.group(1) if filename else None, view[data_start:data_end]))
+        pos = data_end + 2
+    return parts
+
+def _form_to_frame_buffers(parts: list, meta: dict) -> list:
+    """
+    フォームのパートから印刷ジョブのフレームを組み立てる。
+    使用するフィールド: header / footer (テキスト), header_image / footer_image (画像),
+                      body (本文テキスト), image (本文画像、複数可)
+    """
+    fields = {}
+    images = []
+    for name, _, data in parts:
+        if name == "image":
+            images.append(data)
+        else:
+            fields[name] = data
+
+    def text(name):
+        return str(fields[name], "utf-8") if name in fields else None
+
+    def content(name):
+        if f"{name}_image" in fields:
+            return {"type": "image", "content": fields[f"{name}_image"]}
+        if name in fields:
+            return {"type": "text", "content": text(name)}
+        return None
+
+    return serialize_frame(
+        header=content("header"),
+        body_text=text("body"),
+        body_image_bytes_list=images,
+        footer=content("footer"),
+        meta=meta
+    )
+
+def _content_length(headers) -> int:
+    """Content-Length を返す (ない場合は 0)。数値でない場合や負の場合は ValueError"""
+    value = headers.get("Content-Length") or "0"
+    if not value.strip().isdigit():
+        raise ValueError(f"Invalid Content-Length: {value}")
+    return int(value)
+
+def _response_status(acks: list) -> int:
+    """
+    ACK のリストから HTTP ステータスコードを決める。
+    すべて同じ結果ならその結果のコード (新しく受け付けたジョブと重複のジョブだけなら 202)、
+    受け付けたジョブと受け付けられなかったジョブが混在する場合は 207 (ジョブごとの結果はボディの ACK を見る)。
+    """
+    if not acks:
+        return 400
+    statuses = {200 if ack.get("duplicate") else _HTTP_STATUS.get(ack["status"], 400) for ack in acks}
+    if len(statuses) == 1:
+        return statuses.pop()
+    if statuses <= {200, 202}:
+        return 202
+    return 207
+
+class _IngestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs   印刷ジョブを受け付ける。ボディは次のいずれか:
+                   - application/octet-stream: シリアライズ済みのジョブ (バイナリフレーム / 旧JSON) 1件
+                   - multipart/form-data: "job" パート (シリアライズ済みのジョブ、複数可)、
+                     またはフォームのフィールド (header, body, image, footer など) から組み立てる1件
+                 クエリ文字列 (または同名のフォームフィールド) の source / idempotency_key をメタデータに使う。
+                 返り値: {"jobs": [ACK, ...]} (ACK は TCP の MSG_ACK と同じ形式)
+                         受け付けたジョブと受け付けられなかったジョブが混在する場合は 207
+    GET /jobs/<job_id>   ジョブの状態を返す
+    """
+    protocol_version = "HTTP/1.1" # keep-alive
+    server_app = None # FileReceiverServer
+
+    def log_message(self, format, *args):
+        print(f"HTTP {self.address_string()} - {format % args}")
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _copy(self, f, size: int, buf: memoryview):
+        """rfile から size バイトを f にコピーする"""
+        while size > 0:
+            n = self.rfile.readinto(buf[:min(size, len(buf))])
+            if not n:
+                raise ConnectionError("Client closed the connection while sending the body.")
+            f.write(buf[:n])
+            size -= n
+
+    def _stream_body(self, f, max_size: int) -> int:
+        """リクエストボディ (Content-Length / chunked) をメモリに溜めずにファイルへ書き込み、バイト数を返す"""
+        buf = memoryview(bytearray(RECV_CHUNK_SIZE))
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            total = 0
+            while True:
+                size = int(self.rfile.readline(1024).split(b";", 1)[0].strip() or b"0", 16)
+                if size < 0:
+                    raise ValueError("Invalid chunk size.")
+                if size == 0:
+                    # トレーラーを読み飛ばす
+                    while self.rfile.readline(65536) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return total
+                total += size
+                if total > max_size:
+                    raise RequestTooLargeError(f"Request body exceeds the limit of {max_size} bytes.")
+                self._copy(f, size, buf)
+                self.rfile.readline(1024) # チャンク末尾の CRLF
+        length = _content_length(self.headers)
+        if length > max_size:
+            raise RequestTooLargeError(f"Request body of {length} bytes exceeds the limit of {max_size} bytes.")
+        self._copy(f, length, buf)
+        return length
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip("/")
+        if not path.startswith("/jobs/"):
+            self._send_json(404, {"error": "not found"})
+            return
+        job_id = path[len("/jobs/"):]
+        status = self.server_app._handle_status({"job_ids": [job_id]})["jobs"][job_id]
+        self._send_json(404 if status["state"] == "unknown" else 200, dict(status, job_id=job_id))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            self.close_connection = True # ボディを読まないため、接続は使い回さない
+            self._send_json(404, {"error": "not found"})
+            return
+
+        app = self.server_app
+        spool = app.spool
+        upload_path = spool.upload_path()
+        try:
+            with open(upload_path, "w+b") as f:
+                size = self._stream_body(f, app.config.MAX_PAYLOAD_BYTES)
+                f.flush()
+                mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            if mapped is None:
+                self._send_json(400, {"error": "empty body"})
+                return
+
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            meta = {name: query[name] for name in _META_FIELDS if query.get(name)}
+            content_type = self.headers.get("Content-Type", "application/octet-stream")
+            if content_type.lower().startswith("multipart/form-data"):
+                acks = self._accept_multipart(mapped, content_type, meta)
+            else:
+                # ボディ全体が1件のシリアライズ済みジョブ。受信したファイルをそのままスプールに取り込む
+                acks = [self._accept(memoryview(mapped), meta, upload_path)]
+        except RequestTooLargeError as e:
+            self.close_connection = True
+            self._send_json(413, {"error": str(e)})
+            return
+        except (ConnectionError, ValueError) as e:
+            self.close_connection = True
+            self._send_json(400, {"error": str(e)})
+            return
+        finally:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
+
+        status = _response_status(acks)
+        headers = {}
+        if any(ack["status"] == "busy" for ack in acks):
+            headers["Retry-After"] = str(max(1, round(max(ack.get("retry_after", 0) for ack in acks))))
+        self._send_json(status, {"jobs": acks}, headers)
+
+    def _accept(self, data, meta: dict, upload_path: str = None) -> dict:
+        """ジョブを1件受け付け、TCP と同じプリントキューに追加して ACK を返す (meta でジョブのメタデータを上書きする)"""
+        ack = self.server_app._accept_job(data, self.client_address, upload_path, meta)
+        ack.pop("seq", None)
+        return ack
+
+    def _accept_multipart(self, mapped, content_type: str, meta: dict) -> list:
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            raise ValueError("multipart boundary is missing.")
+        parts = _parse_multipart(mapped, match.group(1).encode("latin-1"))
+
+        # 同名のフォームフィールドはクエリ文字列より優先する
+        meta = dict(meta)
+        for part_name, _, data in parts:
+            if part_name in _META_FIELDS and len(data):
+                meta[part_name] = str(data, "utf-8")
+
+        jobs = [data for name, _, data in parts if name == "job"]
+        if len(jobs) > 1 and "idempotency_key" in meta:
+            # 複数のジョブが互いに重複と判定されないよう、キーにジョブの順番を付ける
+            return [self._accept(data, dict(meta, idempotency_key=f"{meta['idempotency_key']}:{i}")) for i, data in enumerate(jobs)]
+        if jobs:
+            return [self._accept(data, meta) for data in jobs]
+        # フォームから組み立てたフレームは、スプールの一時ファイルに書き出してから取り込む
+        upload_path = self.server_app.spool.upload_path()
+        try:
+            with open(upload_path, "w+b") as f:
+                for buf in _form_to_frame_buffers(parts, meta):
+                    f.write(buf)
+                f.flush()
+                frame = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return [self._accept(memoryview(frame), meta, upload_path)]
+        finally:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
+
+def start_ingest_server(server_app, host: str, port: int) -> ThreadingHTTPServer:
+    """HTTP でジョブを受け付けるサーバーをバックグラウンドスレッドで起動する"""
+    handler = type("IngestHandler", (_IngestHandler,), {"server_app": server_app})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"HTTP ingestion endpoint listening on http://{host}:{port}/jobs")
+    return httpd
@@ -0,0 +1,140 @@
+# server/job_spool.py
+
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# スプール上のジョブの状態 (JobTracker の状態のうち、再起動後の再印刷の判断に必要なものだけを記録する)
+SPOOL_QUEUED = "queued"
+SPOOL_DONE = "done"
+SPOOL_FAILED = "failed"
+
+class JobSpool:
+    """
+    受け付けたジョブをディスクに保存するスプール。
+    - ジョブの一覧と状態は SQLite (WAL モード) のジャーナル spool.db に記録する
+    - 受信したペイロード (バイナリフレーム / 旧JSON) はジョブごとに blobs/<job_id>.job として保存する
+    メモリ上のキューにはジョブのメタデータだけを置き、ペイロードは印刷直前に mmap で読み込む。
+    サーバーの再起動時は replay() で未完了のジョブを受付順に取り出して再投入し、
+    compact() で完了済みのジョブをジャーナルから削除する。
+    """
+    def __init__(self, directory: str):
+        """
+        :param directory: スプールを置くディレクトリ (サーバーの received_files)
+        """
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "spool.db"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " job_id TEXT UNIQUE NOT NULL,"
+            " source TEXT,"
+            " meta TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " accepted_at REAL NOT NULL,"
+            " error TEXT)"
+        )
+
+    def _blob_path(self, job_id: str) -> str:
+        return os.path.join(self.blob_dir, f"{job_id}.job")
+
+    def upload_path(self) -> str:
+        """
+        受信中のペイロードを直接書き込むための一時ファイルのパスを返す。
+        書き込み後に append(..., from_path=パス) を呼ぶと、コピーせずにそのままスプールに取り込まれる。
+        取り込まれなかった一時ファイルは compact() で削除される。
+        """
+        return os.path.join(self.blob_dir, f"upload-{uuid.uuid4().hex}.tmp")
+
+    def append(self, job_id: str, data_buffer, source: str = None, meta: dict = None, from_path: str = None):
+        """
+        ジョブのペイロードを保存し、ジャーナルに queued として追記する。
+        ペイロードは一時ファイルに書き込んで fsync してから名前を変更するため、
+        ジャーナルに記録されたジョブのペイロードが途中までしか書かれていないことはない。
+        from_path を指定した場合は data_buffer を書き込まず、upload_path() のファイルをそのまま取り込む。
+        """
+        path = self._blob_path(job_id)
+        if from_path is None:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data_buffer)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            tmp_path = from_path
+            with open(tmp_path, "rb+") as f:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (job_id, source, meta, state, accepted_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, source, json.dumps(meta or {}), SPOOL_QUEUED, time.time())
+            )
+
+    def load(self, job_id: str) -> memoryview:
+        """
+        ジョブのペイロードを mmap して memoryview で返す。
+        返した memoryview (とそれを参照するデシリアライズ結果) が使われている間、マッピングは維持される。
+        """
+        with open(self._blob_path(job_id), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ))
+
+    def finish(self, job_id: str, state: str, error: str = None):
+        """ジョブを完了 (done) または失敗 (failed) として記録し、ペイロードを削除する"""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state = ?, error = ? WHERE job_id = ?", (state, error, job_id))
+        try:
+            os.remove(self._blob_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def replay(self) -> list:
+        """
+        未完了のジョブを受付順に返す。返り値: [{"job_id", "source", "meta"}]
+        ペイロードが失われているジョブは failed として記録し、返り値に含めない。
+        印刷中に停止したジョブも未完了として扱うため、再起動後にもう一度印刷される。
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT job_id, source, meta FROM jobs WHERE state = ? ORDER BY id", (SPOOL_QUEUED,)
+            ).fetchall()
+        jobs = []
+        for job_id, source, meta in rows:
+            if not os.path.exists(self._blob_path(job_id)):
+                print(f"Spool: Payload of job {job_id} is missing. Marking it as failed.")
+                self.finish(job_id, SPOOL_FAILED, error="Spooled payload is missing.")
+                continue
+            jobs.append({"job_id": job_id, "source": source, "meta": json.loads(meta)})
+        return jobs
+
+    def compact(self):
+        """
+        完了・失敗したジョブをジャーナルから削除し、ジャーナルに記録のないペイロードファイルを削除する。
+        その後 WAL をチェックポイントしてファイルを切り詰める。
+        """
+        with self._lock:
+            removed = self._db.execute("DELETE FROM jobs WHERE state != ?", (SPOOL_QUEUED,)).rowcount
+            pending = {row[0] for row in self._db.execute("SELECT job_id FROM jobs")}
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        orphans = 0
+        for name in os.listdir(self.blob_dir):
+            if name.rsplit(".", 1)[0] not in pending or name.endswith(".tmp"):
+                os.remove(os.path.join(self.blob_dir, name))
+                orphans += 1
+        print(f"Spool: Compacted {removed} finished jobs and {orphans} orphaned payload files. Pending jobs: {len(pending)}")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,84 @@
+# server/job_tracker.py
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RENDERING = "rendering"
+JOB_PRINTING = "printing"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+_FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+
+class JobTracker:
+    """
+    受け付けたジョブの ID と状態を管理するクラス。
+    ステータス問い合わせ (MSG_STATUS) に対して、キュー内の位置や処理状況を返すために使う。
+    完了・失敗したジョブは最新の max_finished 件だけ保持する。
+    """
+    def __init__(self, max_finished: int = 1000):
+        self.max_finished = max_finished
+        self._jobs = {}                 # job_id -> 状態の辞書
+        self._queued = OrderedDict()    # キュー待ちのジョブ ID (受付順)
+        self._finished = OrderedDict()  # 完了・失敗したジョブ ID (古い順)
+        self._lock = threading.Lock()
+
+    def register(self, source: str = None, job_id: str = None) -> str:
+        """
+        新しいジョブを queued 状態で登録し、ジョブ ID を返す。
+        job_id を指定した場合 (スプールから再投入したジョブなど) はその ID で登録する。
+        """
+        job_id = job_id or uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {"state": JOB_QUEUED, "source": source, "accepted_at": time.time(), "error": None}
+            self._queued[job_id] = None
+        return job_id
+
+    def set_state(self, job_id: str, state: str, error: str = None):
+        """ジョブの状態を更新する"""
+        with self._lock:
+            info = self._jobs.get(job_id)
+            if info is None:
+                return
+            info["state"] = state
+            info["updated_at"] = time.time()
+            if error is not None:
+                info["error"] = error
+            if state != JOB_QUEUED:
+                self._queued.pop(job_id, None)
+            if state in _FINISHED_STATES:
+                self._finished[job_id] = None
+                while len(self._finished) > self.max_finished:
+                    old_id, _ = self._finished.popitem(last=False)
+                    self._jobs.pop(old_id, None)
+
+    def status(self, job_id: str) -> dict:
+        """
+        ジョブの状態を返す。
+        返り値: {"state", "position", "error"}
+          position: queued の場合のキュー内の位置 (1 = 次に処理される)。それ以外は None
+          不明なジョブ ID の場合は state が "unknown" になる
+        """
+        with self._lock:
+            info = self._jobs.get(job_id)
+            if info is None:
+                return {"state": "unknown", "position": None, "error": None}
+            position = None
+            if info["state"] == JOB_QUEUED:
+                for i, queued_id in enumerate(self._queued, start=1):
+                    if queued_id == job_id:
+                        position = i
+                        break
+            return {"state": info["state"], "position": position, "error": info["error"]}
+
+    def counts(self) -> dict:
+        """状態ごとのジョブ数を返す"""
+        with self._lock:
+            counts = {}
+            for info in self._jobs.values():
+                counts[info["state"]] = counts.get(info["state"], 0) + 1
+            return counts
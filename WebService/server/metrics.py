@@ -0,0 +1,148 @@
+# server/metrics.py
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# レイテンシのヒストグラムのバケット (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels) + "}"
+
+def _format_value(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metrics:
+    """
+    印刷サーバーのメトリクスを集計し、Prometheus のテキスト形式で出力するクラス。
+    カウンターとヒストグラムはラベルの組み合わせごとに値を持つ。
+    ゲージは出力時に関数を呼び出して現在の値を取得する (キューの長さなど、既存の状態をそのまま使うため)。
+    """
+    def __init__(self, prefix: str = "mcp31_"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._types = {}      # 名前 -> (種類, 説明)
+        self._counters = {}   # 名前 -> {ラベル: 値}
+        self._histograms = {} # 名前 -> {ラベル: [バケットごとの件数, 合計, 件数]}
+        self._buckets = {}    # 名前 -> バケットの上限のタプル
+        self._gauges = {}     # 名前 -> 値 (またはラベルと値の辞書) を返す関数
+
+    def counter(self, name: str, help_text: str):
+        self._types[name] = ("counter", help_text)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self._types[name] = ("histogram", help_text)
+        self._histograms[name] = {}
+        self._buckets[name] = tuple(buckets)
+
+    def gauge(self, name: str, help_text: str, func, metric_type: str = "gauge"):
+        """
+        :param func: 値を返す関数。ラベル付きの場合は {(("label", "value"), ...): 値} の辞書を返す
+        :param metric_type: 他のクラスが数えている累積値を出力する場合は "counter"
+        """
+        self._types[name] = (metric_type, help_text)
+        self._gauges[name] = func
+
+    def inc(self, name: str, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self._buckets[name]
+        with self._lock:
+            series = self._histograms[name].get(key)
+            if series is None:
+                series = self._histograms[name][key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式 (version 0.0.4) で全メトリクスを出力する"""
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in self._types.items():
+                full_name = self.prefix + name
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                if name in self._gauges:
+                    value = self._gauges[name]()
+                    series = value.items() if isinstance(value, dict) else [((), value)]
+                    for labels, v in series:
+                        lines.append(f"{full_name}{_format_labels(labels)} {_format_value(v)}")
+                elif metric_type == "counter":
+                    for labels, value in self._counters[name].items():
+                        lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+                elif metric_type == "histogram":
+                    buckets = self._buckets[name]
+                    for labels, (counts, total, count) in self._histograms[name].items():
+                        cumulative = 0
+                        for upper, n in zip(buckets, counts):
+                            cumulative += n
+                            lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', _format_value(upper)),))} {cumulative}")
+                        lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                        lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(total)}")
+                        lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def create_server_metrics(server) -> Metrics:
+    """FileReceiverServer のメトリクスを定義する"""
+    metrics = Metrics()
+    metrics.counter("jobs_accepted_total", "Jobs accepted into the print queue.")
+    metrics.counter("jobs_rejected_total", "Jobs not queued, by reason (invalid, busy).")
+    metrics.counter("jobs_duplicate_total", "Jobs acknowledged as accepted without being queued again (duplicates of an earlier job).")
+    metrics.counter("jobs_completed_total", "Jobs that left the printer stage, by result (done, failed).")
+    metrics.counter("bytes_received_total", "Bytes of messages received from clients.")
+    metrics.counter("raster_bytes_sent_total", "Bytes of raster data and native text sent to the printer.")
+    metrics.histogram("stage_duration_seconds", "Time spent per job in each stage (receive, decode, render, transmit).")
+    metrics.gauge("queue_depth", "Jobs waiting in the print queue.", lambda: server.print_queue.qsize())
+    metrics.gauge("printer_connected", "1 while a connection to the printer is open.",
+                  lambda: int(server.print_pipeline.driver.printer is not None))
+    metrics.gauge("printer_up", "1 if the last connection attempt to the printer succeeded.",
+                  lambda: int(server.print_pipeline.driver.last_connect_ok))
+    metrics.gauge("printer_connects_total", "Connections opened to the printer.",
+                  lambda: server.print_pipeline.driver.connect_count, metric_type="counter")
+    metrics.gauge("printer_connect_failures_total", "Failed connection attempts to the printer.",
+                  lambda: server.print_pipeline.driver.connect_failures, metric_type="counter")
+    metrics.gauge("dedup_checked_total", "Jobs checked by the duplicate filter.",
+                  lambda: server.dedup.counters()["checked"], metric_type="counter")
+    metrics.gauge("dedup_tracked", "Jobs remembered by the duplicate filter.",
+                  lambda: server.dedup.counters()["tracked"])
+    return metrics
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # スクレイプごとのアクセスログは出力しない
+
+def start_metrics_server(metrics: Metrics, host: str, port: int) -> ThreadingHTTPServer:
+    """/metrics でメトリクスを返す HTTP サーバーをバックグラウンドスレッドで起動する"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"metrics": metrics})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return httpd
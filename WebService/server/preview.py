@@ -0,0 +1,118 @@
+# server/preview.py
+"""
+印刷せずにジョブをレンダリングだけ行うプレビュー。
+印刷サーバーと同じ整形・合成・ラスター化の処理を通し、最終的な1ビット画像を PBM / PNG で返す。
+
+コマンドラインからの使い方 (リポジトリのルートで実行):
+    python -m WebService.server.preview job1.job job2.job --format png --out-dir previews
+    python -m WebService.server.preview WebService/server/received_files/blobs --format pbm
+ディレクトリを指定した場合は、中のシリアライズ済みジョブ (バイナリフレーム / 旧JSON) をすべてレンダリングし、
+段階ごとの処理時間と全体のスループットを表示する (プリンターや紙を使わずにレンダリング性能を測定できる)。
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.join(current_dir, '..')
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from common.network_utils import deserialize_job
+
+from MCP31PRINT.config import PrinterConfig
+from MCP31PRINT.raster import RasterImage
+from MCP31PRINT.receipt_renderer import ReceiptRenderer
+
+PREVIEW_FORMATS = ("png", "pbm")
+
+def encode_preview(raster: RasterImage, image_format: str = "png") -> bytes:
+    """ラスターを PBM (P4) または PNG (1ビット) のバイト列にする"""
+    if image_format == "pbm":
+        return raster.to_pbm()
+    if image_format == "png":
+        buf = io.BytesIO()
+        raster.to_image().save(buf, format="PNG", optimize=False)
+        return buf.getvalue()
+    raise ValueError(f"Unsupported preview format: {image_format}")
+
+def render_preview(renderer: ReceiptRenderer, data, image_format: str = "png"):
+    """
+    受信データ (バイナリフレーム / 旧JSON) を印刷サーバーと同じ処理でレンダリングし、プレビュー画像を返す。
+    返り値: (画像のバイト列 (印刷する内容がない場合は None), ラスター (または None), 段階ごとの処理時間 (秒) の辞書)
+      処理時間のキー: decode, format, compose, rasterize, encode, total
+    """
+    timings = {}
+    started_at = time.perf_counter()
+    job = deserialize_job(data)
+    timings["decode"] = time.perf_counter() - started_at
+
+    # プレビューは画像で返すため、ネイティブテキストを使う設定でもレシート全体をラスターにする
+    raster = renderer.render_job(job, timings=timings, native_text=False)
+
+    image = None
+    if raster is not None:
+        encode_started_at = time.perf_counter()
+        image = encode_preview(raster, image_format)
+        timings["encode"] = time.perf_counter() - encode_started_at
+    timings["total"] = time.perf_counter() - started_at
+    return image, raster, timings
+
+def _iter_job_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                file_path = os.path.join(path, name)
+                if os.path.isfile(file_path) and not name.endswith(".tmp"):
+                    yield file_path
+        else:
+            yield path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="印刷せずにジョブをレンダリングし、PBM / PNG のプレビューと処理時間を出力する")
+    parser.add_argument("paths", nargs="+", help="シリアライズ済みジョブのファイル、またはそれを含むディレクトリ")
+    parser.add_argument("--format", choices=PREVIEW_FORMATS, default="png", help="出力形式")
+    parser.add_argument("--out-dir", help="プレビュー画像の出力先 (省略した場合は画像を保存せず、処理時間だけを表示する)")
+    parser.add_argument("--font-path", default='/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc')
+    parser.add_argument("--font-size", type=int, default=30)
+    parser.add_argument("--paper-width", type=int, default=PrinterConfig.PAPER_WIDTH_DOTS, help="紙幅 (ドット)")
+    args = parser.parse_args(argv)
+
+    renderer = ReceiptRenderer(font_path=args.font_path, font_size=args.font_size, paper_width_dots=args.paper_width)
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    totals = {}
+    count = 0
+    started_at = time.perf_counter()
+    for file_path in _iter_job_files(args.paths):
+        with open(file_path, "rb") as f:
+            data = f.read()
+        try:
+            image, raster, timings = render_preview(renderer, data, args.format)
+        except Exception as e:
+            print(f"{file_path}: レンダリングに失敗しました: {e}")
+            continue
+        count += 1
+        for stage, seconds in timings.items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        stages = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items())
+        size = f"{raster.width_dots}x{raster.height}" if raster else "empty"
+        print(f"{file_path}: {size} {stages}")
+        if image is not None and args.out_dir:
+            out_name = os.path.splitext(os.path.basename(file_path))[0] + "." + args.format
+            with open(os.path.join(args.out_dir, out_name), "wb") as f:
+                f.write(image)
+
+    elapsed = time.perf_counter() - started_at
+    if count:
+        averages = " ".join(f"{stage}={seconds / count * 1000:.1f}ms" for stage, seconds in totals.items())
+        print(f"--- {count} jobs in {elapsed:.2f}s ({count / elapsed:.1f} jobs/s) average: {averages}")
+    else:
+        print("レンダリングしたジョブはありません。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# server/print_pipeline.py
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.network_utils import deserialize_job
+from .job_spool import SPOOL_DONE, SPOOL_FAILED
+from .preview import render_preview
+from .job_tracker import JOB_RENDERING, JOB_PRINTING, JOB_DONE, JOB_FAILED
+
+from MCP31PRINT.print_document import PrintDocument, stack_documents
+from MCP31PRINT.printer_driver import PrinterDriver
+from MCP31PRINT.raster import RasterImage
+from MCP31PRINT.receipt_renderer import ReceiptRenderer
+
+class PrintPipeline:
+    """
+    プリントキューのジョブを「レンダリング」と「印刷」の2段に分けて処理するパイプライン。
+    - レンダリング段: render_workers 個のワーカーがジョブをラスターに変換する
+    - 印刷段: 専用スレッドがレンダリング済みのラスターをプリンターに送信するだけを行う
+    プリンターがジョブ N を印刷している間にジョブ N+1 以降 (最大 lookahead 件) をレンダリングしておくため、
+    連続したジョブの印刷間隔がプリンターの印字速度に近づく。
+    ジョブは必ずプリントキューから取り出された順に印刷される。
+
+    coalesce を有効にすると、短いジョブが続けて待っている場合にそれらをまとめて1回で印刷する
+    (区切り線を挟んで1つのラスターに連結するか、ジョブの間でパーシャルカットする)。
+    ジョブごとの初期化・紙送り・フルカットの時間が省けるため、短いジョブが集中したときの処理量が上がる。
+    待っているジョブがない場合は待たずにすぐ印刷するため、単独のジョブの待ち時間は変わらない。
+    """
+    def __init__(self, print_queue: queue.Queue, job_tracker, spool, font_path: str = None, font_size: int = 30,
+                 render_workers: int = 2, lookahead: int = 2, coalesce: dict = None, metrics=None,
+                 native_text: bool = False):
+        """
+        :param print_queue: 受け付けたジョブのメタデータ ({"job_id", "source_addr", "meta"}) が入るキュー
+        :param job_tracker: ジョブの状態を記録する JobTracker
+        :param spool: ジョブのペイロードを保存している JobSpool
+        :param font_path: レンダリングに使用するフォントファイルのパス
+        :param font_size: フォントサイズ
+        :param render_workers: レンダリングを並行して行うワーカー数
+        :param lookahead: 印刷待ちのレンダリング済み (またはレンダリング中) ジョブの最大数
+        :param coalesce: ジョブをまとめて印刷する設定。None の場合はまとめない。
+            {"window": 次のジョブのレンダリング完了を待つ最大秒数,
+             "max_job_height": まとめる対象にするジョブの最大の長さ (ドット),
+             "max_height": まとめて印刷する長さの上限 (ドット),
+             "partial_cut": True の場合はジョブの間でパーシャルカットする}
+        :param metrics: レンダリング・送信の時間などを記録する Metrics (None の場合は記録しない)
+        :param native_text: Trueの場合、テキストはラスターにせずプリンター内蔵フォントで印刷する
+                            (クライアント側でレンダリング済みのジョブはラスターのまま印刷する)
+        """
+        self.print_queue = print_queue
+        self.job_tracker = job_tracker
+        self.spool = spool
+        self.font_path = font_path
+        self.font_size = font_size
+        self.driver = PrinterDriver()
+        self._render_pool = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="render")
+        # 投入順の (record, future) を保持する。上限により先読みしすぎてメモリを使うことを防ぐ
+        self._ready = queue.Queue(maxsize=lookahead)
+        # レンダリングに渡す前に枠を確保し、印刷の段が取り出したら返す
+        # (レンダリング中と印刷待ちのジョブの合計が lookahead を超えないようにする)
+        self._lookahead_slots = threading.Semaphore(lookahead)
+        # フォントを保持する ImageConverter はスレッド間で共有しない
+        self._local = threading.local()
+        self.coalesce = coalesce
+        self.metrics = metrics
+        self.native_text = native_text
+        self._carry = None # まとめられなかったため次の印刷に回す (record, raster, error)
+
+    def start(self):
+        threading.Thread(target=self._feed_renderers, daemon=True).start()
+        threading.Thread(target=self._printer_stage, daemon=True).start()
+        print("Print pipeline started.")
+
+    def _renderer(self) -> ReceiptRenderer:
+        """スレッドごとの ReceiptRenderer を返す"""
+        renderer = getattr(self._local, "renderer", None)
+        if renderer is None:
+            renderer = self._local.renderer = ReceiptRenderer(
+                font_path=self.font_path,
+                font_size=self.font_size,
+                paper_width_dots=self.driver.paper_width_dots,
+                native_text=self.native_text
+            )
+        return renderer
+
+    def _render(self, record: dict) -> RasterImage | PrintDocument | None:
+        """
+        ジョブのペイロードをスプールから読み込み、ラスター (native_text の場合は PrintDocument) に
+        レンダリングする (レンダリングワーカーで実行)
+        """
+        self.job_tracker.set_state(record["job_id"], JOB_RENDERING)
+        started_at = time.monotonic()
+        try:
+            return self._renderer().render_job(deserialize_job(self.spool.load(record["job_id"])))
+        finally:
+            if self.metrics:
+                self.metrics.observe("stage_duration_seconds", time.monotonic() - started_at, stage="render")
+
+    def preview(self, data_buffer, image_format: str = "png"):
+        """
+        ジョブを印刷せずにレンダリングし、プレビュー画像を返す (呼び出し元のスレッドで実行)。
+        返り値は preview.render_preview と同じ。
+        """
+        return render_preview(self._renderer(), data_buffer, image_format)
+
+    def _feed_renderers(self):
+        """プリントキューからジョブを取り出してレンダリングワーカーに渡す (先読み数の上限に達したら待つ)"""
+        while True:
+            self._lookahead_slots.acquire()
+            record = self.print_queue.get()
+            future = self._render_pool.submit(self._render, record)
+            self._ready.put((record, future))
+
+    def _next_rendered(self, timeout: float = None):
+        """
+        投入順で次のジョブのレンダリング結果を返す。返り値: (record, raster, error)
+        timeout 秒以内にジョブが届かない場合は queue.Empty を送出する。
+        """
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        record, future = self._ready.get(timeout=timeout)
+        self._lookahead_slots.release()
+        try:
+            return record, future.result(), None
+        except Exception as e:
+            return record, None, e
+
+    def _collect_batch(self, first) -> list:
+        """
+        first に続けてまとめて印刷できるジョブを集める。
+        後続のジョブがキューにある間だけ、最大 window 秒ずつレンダリングの完了を待つ。
+        """
+        _, raster, error = first
+        if error or raster is None or raster.height > self.coalesce["max_job_height"]:
+            return [first]
+        batch = [first]
+        total_height = raster.height
+        while self.print_queue.qsize() or not self._ready.empty():
+            try:
+                item = self._next_rendered(timeout=self.coalesce["window"])
+            except queue.Empty:
+                break
+            _, raster, error = item
+            if (error or raster is None or raster.height > self.coalesce["max_job_height"]
+                    or total_height + raster.height > self.coalesce["max_height"]):
+                self._carry = item
+                break
+            batch.append(item)
+            total_height += raster.height
+        return batch
+
+    def _printer_stage(self):
+        """レンダリング結果を投入順に受け取り、プリンターに送信する"""
+        while True:
+            first = self._next_rendered()
+            batch = self._collect_batch(first) if self.coalesce else [first]
+            try:
+                self._print_batch(batch)
+            finally:
+                for _ in batch:
+                    # ジョブ処理が完了したことをキューに通知
+                    self.print_queue.task_done()
+                print(f"Job finished. Remaining in queue: {self.print_queue.qsize()}")
+
+    def _print_batch(self, batch: list):
+        """1件またはまとめた複数件のジョブを印刷し、ジョブごとの状態を記録する"""
+        printable = []
+        for record, raster, error in batch:
+            job_id = record["job_id"]
+            if error is not None:
+                self._fail(job_id, error)
+            elif raster is None:
+                print(f"Job {job_id}: No content to print.")
+                self._finish(job_id)
+            else:
+                self.job_tracker.set_state(job_id, JOB_PRINTING)
+                printable.append((job_id, raster))
+        if not printable:
+            return
+
+        rasters = [raster for _, raster in printable]
+        started_at = time.monotonic()
+        try:
+            if len(rasters) == 1:
+                ok = self.driver.print_job(rasters[0], feed_lines=5, cut_mode='full')
+            elif self.coalesce["partial_cut"]:
+                ok = self.driver.print_batch(rasters, feed_lines=5)
+            else:
+                ok = self.driver.print_job(stack_documents(rasters), feed_lines=5, cut_mode='full')
+            if not ok:
+                raise RuntimeError("Failed to send raster to the printer.")
+            if self.metrics:
+                self.metrics.observe("stage_duration_seconds", time.monotonic() - started_at, stage="transmit")
+                self.metrics.inc("raster_bytes_sent_total", sum(raster.nbytes for raster in rasters))
+        except Exception as e:
+            for job_id, _ in printable:
+                self._fail(job_id, e)
+            return
+        for job_id, _ in printable:
+            print(f"Job {job_id} completed successfully.")
+            self._finish(job_id)
+        if len(printable) > 1:
+            print(f"Printed {len(printable)} jobs in one run.")
+
+    def _finish(self, job_id: str):
+        self.job_tracker.set_state(job_id, JOB_DONE)
+        self.spool.finish(job_id, SPOOL_DONE)
+        if self.metrics:
+            self.metrics.inc("jobs_completed_total", result="done")
+
+    def _fail(self, job_id: str, error: Exception):
+        print(f"Error processing print job {job_id}: {error}")
+        self.job_tracker.set_state(job_id, JOB_FAILED, error=str(error))
+        self.spool.finish(job_id, SPOOL_FAILED, error=str(error))
+        if self.metrics:
+            self.metrics.inc("jobs_completed_total", result="failed")
+        import traceback
+        traceback.print_exception(error)
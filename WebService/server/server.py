@@ -2,19 +2,26 @@ import socket
 import threading
 import os
 import sys
-import queue # queueモジュールをインポート
+import time
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.join(current_dir, '..')
 sys.path.append(project_root)
 
-from datetime import datetime
-from common.network_utils import deserialize_data
+from common.network_utils import (
+    deserialize_job, recv_message, send_buffers, encode_frame, is_binary_frame,
+    decode_frame_meta, negotiate_codecs, SUPPORTED_CODECS, MSG_JOB, MSG_HELLO, MSG_ACK, MSG_STATUS, MSG_STATUS_REPLY,
+    PROTOCOL_VERSION, ROLE_PREVIEW, KIND_IMAGE
+)
+from .admission import AdmissionController, FairJobQueue
 from .config import BaseServerConfig
+from .dedup import DuplicateFilter, IN_PROGRESS
+from .http_ingest import start_ingest_server
+from .job_spool import JobSpool
+from .job_tracker import JobTracker, JOB_FAILED
+from .metrics import create_server_metrics, start_metrics_server
+from .print_pipeline import PrintPipeline
 
-from MCP31PRINT.printer_driver import PrinterDriver
-from MCP31PRINT.image_converter import ImageConverter
-from MCP31PRINT.text_formatter import format_text_with_url_summary
 FONT_PATH='/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc'
 
 try:
@@ -24,129 +31,260 @@ except ImportError:
     print("Please copy ServerConfig.py.template to MyActualServerConfig.py and set actual values.")
     exit(1)
 
+def _frame_seq(data_buffer):
+    """
+    不正なメッセージへの ACK に付ける seq を返す。
+    ブロックは展開せずにメタデータだけを読み、メタデータも読めない場合は None を返す。
+    """
+    try:
+        return decode_frame_meta(data_buffer)[2].get("seq") if is_binary_frame(data_buffer) else None
+    except Exception:
+        return None
+
 class FileReceiverServer:
     def __init__(self):
-        self.host = ActualServerConfig().SERVER_IP
-        self.port = ActualServerConfig().SERVER_PORT
+        self.config = ActualServerConfig()
+        self.host = self.config.SERVER_IP
+        self.port = self.config.SERVER_PORT
         self.output_dir = os.path.join(current_dir, "received_files") # output_dir は相対パスのままでOK
                                                                         # os.path.join は絶対パスと結合すると絶対パスになる
         os.makedirs(self.output_dir, exist_ok=True)
 
         # ★追加: プリントジョブキューを初期化
-        self.print_queue = queue.Queue()
-        # ★追加: ワーカースレッドを起動
-        self.printer_worker_thread = threading.Thread(target=self._printer_worker, daemon=True)
-        self.printer_worker_thread.start()
-        print("Printer worker thread started.")
-
-    def _printer_worker(self):
-        """
-        プリントキューからジョブを取り出し、順次プリンターに送信するワーカースレッド。
-        """
-        driver = PrinterDriver()
-        converter = ImageConverter(
+        # キューにはジョブのメタデータだけを入れ、ペイロードはスプール (received_files) に置く
+        # 送信元ごとの重み付き公平キューのため、大量に送る送信元があっても他の送信元のジョブは待たされにくい
+        self.print_queue = FairJobQueue(weights=self.config.SOURCE_WEIGHTS)
+        # キューの上限と送信元ごとのレート制限 (超えた場合は "busy" と再送までの秒数を返す)
+        self.admission = AdmissionController(
+            self.print_queue,
+            max_depth=self.config.MAX_QUEUE_DEPTH,
+            rate=self.config.SOURCE_RATE_PER_SECOND,
+            burst=self.config.SOURCE_BURST,
+            busy_retry_after=self.config.BUSY_RETRY_AFTER_SECONDS,
+            peer_sources=self.config.SOURCES_PER_PEER
+        )
+        # ジョブ ID と状態の管理 (ACK とステータス問い合わせに使用)
+        self.job_tracker = JobTracker()
+        self.spool = JobSpool(self.output_dir)
+        # Prometheus 形式のメトリクス (METRICS_PORT の /metrics で公開)
+        self.metrics = create_server_metrics(self)
+        # 一定時間内に届いた同じ内容 (または同じ idempotency_key) のジョブは印刷しない
+        self.dedup = DuplicateFilter(window_seconds=self.config.DEDUP_WINDOW_SECONDS)
+        self._replay_spool()
+        # レンダリングと印刷を別の段で並行して処理するパイプラインを起動
+        self.print_pipeline = PrintPipeline(
+            self.print_queue, self.job_tracker, self.spool,
             font_path=FONT_PATH,
             font_size=30,
-            default_width=driver.paper_width_dots
+            render_workers=self.config.RENDER_WORKERS,
+            lookahead=self.config.RENDER_LOOKAHEAD,
+            coalesce={
+                "window": self.config.COALESCE_WINDOW_SECONDS,
+                "max_job_height": self.config.COALESCE_MAX_JOB_HEIGHT,
+                "max_height": self.config.COALESCE_MAX_HEIGHT,
+                "partial_cut": self.config.COALESCE_PARTIAL_CUT,
+            } if self.config.COALESCE_JOBS else None,
+            metrics=self.metrics,
+            native_text=self.config.NATIVE_TEXT
         )
-        
-        while True:
-            # キューからジョブを取得。キューが空の場合は、ジョブが来るまでここで待機する。
-            job_data = self.print_queue.get() 
-            print(f"Processing print job from queue. Queue size: {self.print_queue.qsize()}")
-
-            try:
-                # job_data は deserialize_data の返り値（header_data, body_text, body_image_bytes_list, footer_data）
-                header_data, body_text, body_image_bytes_list, footer_data = job_data
-
-                imglist = []
-                
-                # ヘッダー処理
-                if header_data:
-                    if isinstance(header_data, dict) and header_data.get("type") == "text" and header_data.get("content"):
-                        imglist.append(converter.text_to_bitmap(text=header_data["content"]))
-                    elif isinstance(header_data, dict) and header_data.get("type") == "image" and header_data.get("content"):
-                        imglist.append(converter.image_from_bytes(header_data["content"]))
-                    elif isinstance(header_data, str):
-                        imglist.append(converter.text_to_bitmap(text=header_data))
-                    else:
-                        print(f"Warning: Unexpected header_data format in worker: {type(header_data)} - {header_data}")
-
-                # 本文テキスト処理
-                if body_text:
-                    formatted_body_text = format_text_with_url_summary(body_text, max_line_length=30, max_display_length=900, url_title_max_length=15)[0]
-                    imglist.append(converter.text_to_bitmap(text=formatted_body_text))
-                    print(f"Converting body text to image in worker: {body_text[:50]}...") # 長すぎる場合は一部のみ表示
-
-                # 本文画像処理
-                if body_image_bytes_list:
-                    for i, image_bytes in enumerate(body_image_bytes_list):
-                        imglist.append(converter.image_from_bytes(image_bytes=image_bytes))
-                        print(f"Converting body image {i+1} to image in worker.")
-
-                # フッター処理
-                if footer_data:
-                    if isinstance(footer_data, dict) and footer_data.get("type") == "image" and footer_data.get("content"):
-                        imglist.append(converter.image_from_bytes(footer_data["content"]))
-                        print("Converting footer QR image to image in worker.")
-                    elif isinstance(footer_data, dict) and footer_data.get("type") == "text" and footer_data.get("content"):
-                        imglist.append(converter.text_to_bitmap(text=footer_data["content"]))
-                        print("Converting footer text to image in worker.")
-                    elif isinstance(footer_data, bytes):
-                        imglist.append(converter.image_from_bytes(footer_data))
-                        print("Converting raw footer image bytes to image in worker.")
-                    else:
-                        print(f"Warning: Unexpected footer_data format in worker: {type(footer_data)} - {footer_data}")
-
-                # すべての画像を結合して印刷
-                if imglist:
-                    printimg = converter.combine_images_vertically(images=imglist)
-                    if printimg:
-                        driver.print_image(printimg)
-                        driver.print_empty_lines(5)
-                        print("\n--- 紙をカット ---")
-                        driver.cut_paper(mode='full')
-                        print(f"Job completed successfully. Remaining in queue: {self.print_queue.qsize()}")
-                    else:
-                        print("Worker: No combined image to print.")
-                else:
-                    print("Worker: No content to print for this job.")
-
-            except Exception as e:
-                print(f"Error processing print job in worker: {e}")
-                import traceback
-                traceback.print_exc()
-            finally:
-                # ジョブ処理が完了したことをキューに通知
-                self.print_queue.task_done()
-                print(f"Job finished. Remaining in queue: {self.print_queue.qsize()}")
+        self.print_pipeline.start()
+        if self.config.METRICS_PORT:
+            start_metrics_server(self.metrics, self.config.METRICS_HOST, self.config.METRICS_PORT)
+        # TCP のプロトコルを実装していないクライアント向けに、HTTP でもジョブを受け付ける
+        if self.config.HTTP_INGEST_PORT:
+            start_ingest_server(self, self.host, self.config.HTTP_INGEST_PORT)
+
+    def _replay_spool(self):
+        """前回の停止時に未完了だったジョブをスプールから受付順にプリントキューへ戻す"""
+        self.spool.compact()
+        for record in self.spool.replay():
+            self.job_tracker.register(source=record["source"], job_id=record["job_id"])
+            self.print_queue.put(
+                {"job_id": record["job_id"], "source": record["source"], "source_addr": None, "meta": record["meta"]},
+                record["source"]
+            )
+        if self.print_queue.qsize():
+            print(f"Replayed {self.print_queue.qsize()} pending jobs from the spool.")
+
+    def _capabilities(self) -> dict:
+        """
+        HELLO 応答でクライアントに通知するサーバーの機能。
+        プリンターの紙幅 (ドット) と解像度も通知し、クライアントが最初からプリンターの紙幅で
+        レンダリングできるようにする (サーバー側での縮小・再ラスター化を避けるため)。
+        """
+        driver = self.print_pipeline.driver
+        return {
+            "protocol_version": PROTOCOL_VERSION,
+            "codecs": SUPPORTED_CODECS,
+            "content_types": ["text", "image", "raster", "qr"],
+            "paper_width_dots": driver.paper_width_dots,
+            "dpi": driver.dpi,
+            "features": ["status", "preview", "dedup", "partial_cut"] + (["native_text"] if self.config.NATIVE_TEXT else []),
+        }
+
+    def _hello_reply(self, meta: dict) -> dict:
+        """
+        クライアントの HELLO に対する応答のメタデータを返す。
+        クライアントが提示したコーデックとサーバーのコーデックの共通部分を返すため、
+        HELLO を送らない旧クライアントには圧縮が一切使われない。
+        """
+        capabilities = self._capabilities()
+        capabilities["codecs"] = negotiate_codecs(meta.get("codecs"))
+        print(f"Negotiated capabilities: {capabilities}")
+        return capabilities
+
+    def _accept_job(self, data_buffer, addr, upload_path: str = None, meta: dict = None):
+        """
+        受信したジョブを検証してジョブ ID を割り当て、ペイロードをスプールに保存してプリントキューに追加する。
+        デコード・ハッシュ計算・スプールへの書き込みを行うため、イベントループからは別スレッドで呼び出すこと。
+        upload_path: data_buffer の内容を書き込み済みのスプールの一時ファイル (JobSpool.upload_path)。
+                     指定した場合はペイロードをコピーせずにそのファイルを取り込む。
+        meta: ジョブのメタデータを上書きする値 (HTTP のクエリ文字列で指定された source / idempotency_key など)
+        返り値: ACK のメタデータ
+             {"seq", "job_id", "status": "accepted"} / {"seq", "status": "rejected", "error"} /
+             {"seq", "job_id" (既存のジョブ), "status": "accepted", "duplicate": True} /
+             {"seq", "status": "busy", "retry_after"}
+        """
+        self.metrics.inc("bytes_received_total", len(data_buffer))
+        started_at = time.monotonic()
+        try:
+            job = deserialize_job(data_buffer)
+        except Exception as e:
+            print(f"Rejected invalid job from {addr}: {e}")
+            self.metrics.inc("jobs_rejected_total", reason="invalid")
+            return {"seq": _frame_seq(data_buffer), "status": "rejected", "error": str(e)}
+        finally:
+            self.metrics.observe("stage_duration_seconds", time.monotonic() - started_at, stage="decode")
+        if meta:
+            job["meta"].update(meta)
+
+        # 送信元はクライアントが meta で指定したタグ (例: "discord", "google_forms")。なければ IP アドレス
+        source = str(job["meta"].get("source") or addr[0])
+        dedup_key = self.dedup.key_for(job, source)
+        # 印刷に失敗したジョブと同じ内容の再送は受け付ける
+        duplicate_of = self.dedup.reserve(dedup_key, lambda job_id: self.job_tracker.status(job_id)["state"] != JOB_FAILED)
+        if duplicate_of == IN_PROGRESS:
+            # 同じジョブを別の接続で受付中 (再送が元の送信と競合した場合)。結果が決まってから再送してもらう
+            print(f"Same job from {source} ({addr}) is being accepted on another connection.")
+            self.metrics.inc("jobs_rejected_total", reason="busy")
+            return {"seq": job["meta"].get("seq"), "status": "busy", "retry_after": 1.0}
+        if duplicate_of:
+            print(f"Duplicate of job {duplicate_of} from {source} ({addr}). Not queued again.")
+            # クライアントには "accepted" を返すため、拒否とは別に数える
+            self.metrics.inc("jobs_duplicate_total")
+            return {"seq": job["meta"].get("seq"), "job_id": duplicate_of, "status": "accepted", "duplicate": True}
 
+        retry_after = self.admission.admit(source, peer=addr[0] if addr else None)
+        if retry_after:
+            self.dedup.release(dedup_key)
+            print(f"Server busy. Rejected job from {source} ({addr}), retry after {retry_after:.1f}s.")
+            self.metrics.inc("jobs_rejected_total", reason="busy")
+            return {"seq": job["meta"].get("seq"), "status": "busy", "retry_after": round(retry_after, 1)}
+
+        try:
+            job_id = self.job_tracker.register(source=source)
+            self.spool.append(job_id, data_buffer, source=source, meta=job["meta"], from_path=upload_path)
+            self._enqueue_job({"job_id": job_id, "source": source, "source_addr": addr, "meta": job["meta"]})
+        except Exception:
+            self.dedup.release(dedup_key)
+            raise
+        finally:
+            self.admission.settle()
+        self.dedup.commit(dedup_key, job_id)
+        self.metrics.inc("jobs_accepted_total")
+        return {"seq": job["meta"].get("seq"), "job_id": job_id, "status": "accepted"}
+
+    def _enqueue_job(self, job: dict):
+        """受け付けたジョブをプリントキューに追加する"""
+        self.print_queue.put(job, job["source"])
+        print(f"Received job {job['job_id']} from {job['source']} {job['source_addr']} and added to print queue. Current queue size: {self.print_queue.qsize()}")
+
+    def _handle_status(self, meta: dict) -> dict:
+        """ステータス問い合わせに応答するメタデータを返す"""
+        jobs = {}
+        for job_id in meta.get("job_ids", []):
+            status = self.job_tracker.status(job_id)
+            if status["position"] is not None:
+                # 公平キューでは受付順と取り出し順が異なるため、キュー内の実際の位置を返す
+                status["position"] = self.print_queue.position(job_id) or status["position"]
+            jobs[job_id] = status
+        return {"seq": meta.get("seq"), "jobs": jobs, "dedup": self.dedup.counters()}
+
+    def _handle_preview(self, data_buffer, meta: dict):
+        """プレビューのジョブをレンダリングし、画像を含む ACK の返信バッファを返す"""
+        image_format = meta.get("preview") if meta.get("preview") in ("png", "pbm") else "png"
+        try:
+            image, raster, timings = self.print_pipeline.preview(data_buffer, image_format)
+        except Exception as e:
+            print(f"Preview failed: {e}")
+            return encode_frame(MSG_ACK, meta={"seq": meta.get("seq"), "status": "rejected", "error": str(e)})
+        reply = {"seq": meta.get("seq"), "status": "preview", "format": image_format, "timings": timings}
+        if raster is None:
+            return encode_frame(MSG_ACK, meta=reply)
+        reply.update(width=raster.width_dots, height=raster.height)
+        return encode_frame(MSG_ACK, blocks=[(ROLE_PREVIEW, KIND_IMAGE, 0, image)], meta=reply)
+
+    def _handle_control(self, data_buffer):
+        """
+        キューに入れないメッセージ (HELLO / ステータス問い合わせ / プレビュー) を処理し、返信バッファを返す。
+        印刷するジョブの場合は None を返す。
+        種別の判定にはヘッダーとメタデータだけを読み、ブロックは展開しない。
+        フレームが不正な場合は "rejected" の ACK を返す (接続は閉じず、同じ接続の後続のジョブはそのまま処理する)。
+        """
+        try:
+            msg_type, _, meta = decode_frame_meta(data_buffer)
+        except Exception as e:
+            print(f"Rejected invalid message: {e}")
+            self.metrics.inc("jobs_rejected_total", reason="invalid")
+            return encode_frame(MSG_ACK, meta={"seq": _frame_seq(data_buffer), "status": "rejected", "error": str(e)})
+        if msg_type == MSG_HELLO:
+            return encode_frame(MSG_HELLO, meta=self._hello_reply(meta))
+        elif msg_type == MSG_STATUS:
+            return encode_frame(MSG_STATUS_REPLY, meta=self._handle_status(meta))
+        elif msg_type == MSG_JOB and meta.get("preview"):
+            return self._handle_preview(data_buffer, meta)
+        return None
+
+    def _handle_message(self, data_buffer, addr):
+        """
+        バイナリフレーム1件を処理し、返信バッファを返す。
+        プレビューのレンダリングやジョブの受付 (デコード・スプールへの書き込み) を行うため、
+        イベントループからは別スレッドで呼び出すこと。
+        """
+        reply = self._handle_control(data_buffer)
+        if reply is None:
+            reply = encode_frame(MSG_ACK, meta=self._accept_job(data_buffer, addr))
+        return reply
 
     def _handle_client(self, conn, addr):
+        """
+        1つの接続で届くメッセージをループで処理する。
+        バイナリ形式のクライアントは同じ接続で複数のジョブを続けて送信でき、ジョブごとに ACK を返す。
+        旧JSON形式は1接続1ジョブのため、1件処理したら接続を閉じる。
+        """
         print(f"Connected by {addr}")
+        conn.settimeout(self.config.CONNECTION_IDLE_TIMEOUT_SECONDS)
         try:
-            data_buffer = b""
             while True:
-                chunk = conn.recv(4096)
-                if not chunk:
+                # バイナリフレームは長さ情報に従って事前確保したバッファへ、旧形式は終端文字列まで受信する
+                # 大きなペイロードは received_files 内の一時ファイルに退避される
+                # 次のメッセージの先頭が届くまで (アイドル時間) は受信時間に含めない
+                if not conn.recv(1, socket.MSG_PEEK):
                     break
-                data_buffer += chunk
-                if b"<END_OF_TRANSMISSION>" in data_buffer:
-                    data_buffer = data_buffer.replace(b"<END_OF_TRANSMISSION>", b"")
+                started_at = time.monotonic()
+                data_buffer = recv_message(conn, spill_dir=self.output_dir, max_size=self.config.MAX_PAYLOAD_BYTES)
+                if data_buffer is None:
                     break
+                self.metrics.observe("stage_duration_seconds", time.monotonic() - started_at, stage="receive")
 
-            # 受信したデータをキューに追加するだけに変更
-            header_data, body_text, body_image_bytes_list, footer_data = deserialize_data(data_buffer)
-            
-            # 受信時刻と送信元IPは、ファイル保存などのデバッグ用途で残しておく
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            sender_ip = addr[0].replace('.', '_')
+                if not is_binary_frame(data_buffer):
+                    self._accept_job(data_buffer, addr)
+                    break
 
-            # ジョブデータをタプルとしてキューに入れる
-            job_tuple = (header_data, body_text, body_image_bytes_list, footer_data)
-            self.print_queue.put(job_tuple)
-            print(f"Received data from {addr} and added to print queue. Current queue size: {self.print_queue.qsize()}")
+                send_buffers(conn, self._handle_message(data_buffer, addr))
 
+        except socket.timeout:
+            print(f"Connection with {addr} timed out after being idle.")
         except Exception as e:
             print(f"Error handling client {addr}: {e}")
             import traceback
@@ -167,5 +305,9 @@ class FileReceiverServer:
                 thread.start()
 
 if __name__ == "__main__":
-    server = FileReceiverServer()
+    if ActualServerConfig().SERVER_MODE == "asyncio":
+        from .async_server import AsyncFileReceiverServer
+        server = AsyncFileReceiverServer()
+    else:
+        server = FileReceiverServer()
     server.start()
\ No newline at end of file
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import queue
 import time
 import sys
 from google.oauth2 import service_account
@@ -16,6 +17,9 @@ import json
 #    local_config.py をインポートできるようにするため
 sys.path.append(os.path.dirname(__file__))
 from local_config import AppConfig
+from row_state import RowStateStore
+from sheet_poller import SheetPoller, range_start_row
+from webhook import start_webhook_server
 
 # 2. MCP31PrinterBOT のルートパスをシステムパスに追加
 #    'WebService' パッケージを認識させるため
@@ -39,25 +43,28 @@ SPREADSHEET_ID = config.SPREADSHEET_ID
 RANGE_NAME = config.RANGE_NAME
 CREDENTIALS_FILE = config.CREDENTIALS_FILE
 POLLING_INTERVAL_SECONDS = config.POLLING_INTERVAL_SECONDS
-PRINTED_ROWS_FILE = config.PRINTED_ROWS_FILE
+PRINTED_ROWS_FILE = config.PRINTED_ROWS_FILE # 以前の形式の印刷済み行ファイル (状態ファイルがない場合に取り込む)
+# 行の状態 (処理済みの行と送信中の行) の保存先と、ポーリング間隔の範囲 (local_config.py で上書き可能)
+ROW_STATE_FILE = getattr(config, 'ROW_STATE_FILE', PRINTED_ROWS_FILE + '.state.json')
+# 以前の形式のカーソルファイル (local_config.py の CURSOR_FILE で場所を変えていた場合はそちらを取り込む)
+LEGACY_CURSOR_FILE = getattr(config, 'CURSOR_FILE', PRINTED_ROWS_FILE + '.cursor')
+POLLING_MIN_INTERVAL_SECONDS = getattr(config, 'POLLING_MIN_INTERVAL_SECONDS', max(1, POLLING_INTERVAL_SECONDS / 4))
+POLLING_MAX_INTERVAL_SECONDS = getattr(config, 'POLLING_MAX_INTERVAL_SECONDS', POLLING_INTERVAL_SECONDS * 4)
+# 1回の送信でまとめて送る行数の上限 (印刷サーバーの送信元ごとの連続受付数 SOURCE_BURST に合わせる)
+PRINT_BATCH_SIZE = getattr(config, 'PRINT_BATCH_SIZE', 10)
+# 1回のポーリングで送信に使う時間の上限 (秒)。印刷サーバーが混雑 ("busy") を返した後は retry_after 秒おきに送るため、
+# 溜まった行が多い場合は上限で打ち切り、残りは次回のポーリングで送る (ポーリングのループを長時間止めない)
+PRINT_MAX_SECONDS_PER_POLL = getattr(config, 'PRINT_MAX_SECONDS_PER_POLL', 30)
+# プッシュモード: WEBHOOK_PORT を設定すると、フォーム送信トリガーからの Webhook で新しい回答を受け取る。
+# ポーリングは取りこぼし (トリガーの失敗や停止中の回答) を拾うための照合として RECONCILE_INTERVAL_SECONDS ごとに行う
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', None)
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+RECONCILE_INTERVAL_SECONDS = getattr(config, 'RECONCILE_INTERVAL_SECONDS', 300)
 
 # --- グローバル変数 ---
-last_processed_row_count = 0
 printer_client = None
 
-# --- 印刷済み行の管理 ---
-def load_printed_row_indices():
-    """印刷済み行のインデックスをファイルから読み込む"""
-    if os.path.exists(PRINTED_ROWS_FILE):
-        with open(PRINTED_ROWS_FILE, 'r') as f:
-            return set(int(line.strip()) for line in f if line.strip().isdigit())
-    return set()
-
-def save_printed_row_index(row_index):
-    """印刷済み行のインデックスをファイルに保存する"""
-    with open(PRINTED_ROWS_FILE, 'a') as f:
-        f.write(f"{row_index}\n")
-
 # --- Google Sheets API クライアントの初期化 ---
 def get_sheets_service():
     """Google Sheets API サービスオブジェクトを返す"""
@@ -68,67 +75,215 @@ def get_sheets_service():
     service = build('sheets', 'v4', credentials=creds)
     return service
 
-# --- スプレッドシートからのデータ取得 ---
-def get_spreadsheet_data(service, spreadsheet_id, range_name):
-    """スプレッドシートから指定範囲のデータを取得する"""
-    sheet = service.spreadsheets()
-    result = sheet.values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-    values = result.get('values', [])
-    return values
-
 # --- 印刷処理 ---
-def print_answer(row_data_list, row_index, printed_row_indices_set):
+def build_print_job(row_data_list, row_index):
     """
-    B列に新規で追加されたメッセージ内容を印刷モジュールを使って印刷サーバーに送信する。
+    B列に新規で追加されたメッセージ内容から、印刷サーバーに送信するジョブ (send_jobs の引数の辞書) を作る。
     row_data_list: スプレッドシートの1行分のデータ（リスト）。RANGE_NAMEがB列のみの場合、このリストは要素を1つ含む。
     row_index: スプレッドシートの行番号 (1から始まる)
-    printed_row_indices_set: 印刷済み行のセット
     """
-    global printer_client
-    if printer_client is None:
-        printer_client = FileSenderClient()
-
     # B列のメッセージ内容を取得 (row_data_listは ['メッセージ内容'] の形式で来るはず)
     message_content = row_data_list[0] if row_data_list else "メッセージがありません"
 
-    print(f"--- 新規メッセージ印刷ジョブを送信中 (行番号: {row_index}) ---")
-
     # ヘッダー: タイムスタンプは取得できないので、シンプルに「新規メッセージ」とする
     header_data = {"type": "text", "content": "--- 新規メッセージ ---"}
 
-    # ボディテキスト: B列のメッセージ内容を直接設定
-    body_text_message = message_content
-
-    body_image_bytes_list = [] # 今回の要件では画像添付がないため、空リスト
-
     # フッター: 行番号と受付日時（これはスプレッドシートのA列にある想定なので、取得できない場合は省略）
     # もしA列のタイムスタンプも必要なら、RANGE_NAMEを 'シート1!A:B' などと変更し、
     # row_data_list[0]をタイムスタンプ、row_data_list[1]をメッセージとして利用する
     footer_data = {"type": "text", "content": f"受付: 行 {row_index}"}
 
+    return {
+        "header_data": header_data,
+        "body_text_message": message_content, # ボディテキスト: B列のメッセージ内容を直接設定
+        "body_image_bytes_list": [], # 今回の要件では画像添付がないため、空リスト
+        "footer_data": footer_data,
+        # 再起動後に同じ行を読み直して再送しても、サーバー側で二重に印刷されないようにする
+        "idempotency_key": f"{SPREADSHEET_ID}:{row_index}",
+    }
+
+def print_answers(rows, row_state):
+    """
+    複数の行をまとめて印刷サーバーに送信する (1本の接続でパイプライン送信し、ACK をまとめて受け取る)。
+    rows: [(行番号, 行のデータのリスト), ...]
+    row_state: 行の状態ストア (RowStateStore)。送信前に送信中、受け付け後に処理済みとして、それぞれ1回ずつ保存する
+    返り値: (印刷サーバーがジョブを受け付けた行数, 混雑のため受け付けられなかった行のリスト, 再送までの秒数 (混雑していない場合は None),
+             送信に失敗した行数)
+    """
+    global printer_client
+    if printer_client is None:
+        printer_client = FileSenderClient(source="google_forms")
+
+    row_indices = [row_index for row_index, _ in rows]
+    print(f"--- 新規メッセージ印刷ジョブを送信中 ({len(rows)}件, 行番号: {row_indices[0]} 〜 {row_indices[-1]}) ---")
+
+    # 送信中であることを先に保存する (ACK を受け取る前に停止した場合、再起動後に同じキーで再送される)
+    row_state.mark_sent(row_indices)
+    row_state.save()
     try:
-        printer_client.send_data(
-            header_data=header_data,
-            body_text_message=body_text_message,
-            body_image_bytes_list=body_image_bytes_list,
-            footer_data=footer_data
-        )
-        print(f"新規メッセージを印刷ジョブ送信しました (行番号: {row_index})")
-        save_printed_row_index(row_index)
-        printed_row_indices_set.add(row_index)
+        acks = printer_client.send_jobs([build_print_job(row_data_list, row_index) for row_index, row_data_list in rows])
     except Exception as e:
-        print(f"印刷ジョブの送信に失敗しました (行番号: {row_index}): {e}")
+        print(f"印刷ジョブの送信に失敗しました (行番号: {row_indices[0]} 〜 {row_indices[-1]}): {e}")
+        return 0, [], None, len(rows)
+
+    # サーバーがジョブを受け付けた行のみ印刷済みとして記録する (失敗した行は次回再送される)
+    # 拒否された行 (ジョブの内容が不正など、再送しても受け付けられない行) は印刷せずに処理済みとする
+    accepted = []
+    rejected = []
+    busy = []
+    retry_after = None
+    failed = 0
+    for row, ack in zip(rows, acks):
+        row_index = row[0]
+        if ack["status"] == "accepted":
+            accepted.append(row_index)
+        elif ack["status"] == "busy":
+            busy.append(row)
+            retry_after = max(retry_after or 0, ack.get("retry_after") or 0)
+        elif ack["status"] == "rejected":
+            print(f"印刷サーバーがジョブを拒否しました。この行は印刷しません (行番号: {row_index}): {ack.get('error')}")
+            rejected.append(row_index)
+        else:
+            print(f"印刷ジョブの送信に失敗しました (行番号: {row_index}): {ack.get('error')}")
+            failed += 1
+    row_state.mark_acknowledged(accepted)
+    row_state.mark_rejected(rejected)
+    row_state.save()
+    print(f"新規メッセージを印刷ジョブ送信しました ({len(accepted)}/{len(rows)}件)")
+    return len(accepted), busy, retry_after, failed
+
+def process_rows(rows, row_state):
+    """
+    行のうち未処理のものを PRINT_BATCH_SIZE 件ずつまとめて印刷する (同じ行が複数回含まれていても1回だけ送る)。
+    印刷サーバーが混雑を返した後は、受け付けられた件数ずつ retry_after 秒おきに送る
+    (レート制限で断られるジョブを何度も送らないようにする)。
+    送信に使う時間は PRINT_MAX_SECONDS_PER_POLL までとし、残りの行は次回に送る。
+    送信に失敗した場合は残りの行を送らずに ConnectionError を送出する (呼び出し元で間隔を空けて再試行する)。
+    rows: [(行番号, 行のデータのリスト), ...]
+    返り値: 新しく処理済みになった行があった場合は True
+    """
+    progressed = False
+    pending = []
+    queued = set()
+    for row_index, row_data_list in rows:
+        if row_state.is_done(row_index) or row_index in queued:
+            # カーソルより後の処理済みの行 (途中の行の送信に失敗した場合に残る) は、ポーリングのたびに取得されるため表示しない
+            continue
+        elif not (row_data_list and row_data_list[0]): # データが存在し、かつ空でないことを確認
+            print(f"行 {row_index} は空またはメッセージがありません。スキップします。")
+            row_state.mark_skipped([row_index])
+            progressed = True
+        else:
+            pending.append((row_index, row_data_list))
+            queued.add(row_index)
+    batch_size = PRINT_BATCH_SIZE
+    pace = None # 混雑を返された後の送信間隔 (秒)
+    deadline = time.monotonic() + PRINT_MAX_SECONDS_PER_POLL
+    while pending:
+        batch, pending = pending[:batch_size], pending[batch_size:]
+        accepted, busy, retry_after, failed = print_answers(batch, row_state)
+        if accepted:
+            progressed = True
+        if failed:
+            row_state.save()
+            raise ConnectionError(f"{failed}件の印刷ジョブの送信に失敗しました。残りの {len(busy) + len(pending)}件は送信しません。")
+        if busy:
+            # retry_after は 0.1秒単位に丸められているため、少し余分に待つ
+            pace = retry_after + 0.1
+            pending = busy + pending
+            batch_size = max(1, accepted)
+        if pending and pace:
+            if time.monotonic() + pace > deadline:
+                print(f"印刷サーバーが混雑しています。残りの {len(pending)}件は次回送信します。")
+                break
+            print(f"印刷サーバーが混雑しています。{pace:.1f}秒後に {min(batch_size, len(pending))}件を送信します。")
+            time.sleep(pace)
+    row_state.save()
+    return progressed
+
+def process_new_rows(poller, row_state):
+    """
+    カーソル (処理済みの行の high_water_mark) より後の行を取得し、未処理の行を印刷する。
+    送信に失敗した行があれば、カーソルはその手前で止まる (次回のポーリングでその行から再取得する)。
+    返り値: 新しく処理済みになった行があった場合は True
+    """
+    new_rows = poller.fetch_new_rows()
+    if not new_rows:
+        print(f"新しいメッセージはありません。処理済みの行: {poller.cursor}")
+        return False
+
+    print(f"新しい行を取得しました: {len(new_rows)}件 (行 {new_rows[0][0]} 〜 {new_rows[-1][0]})")
+    return process_rows(new_rows, row_state)
+
+def run_polling(poller, row_state):
+    """ポーリングで新しい行を監視する"""
+    print("--- 定期ポーリングを開始します ---")
+    while True:
+        try:
+            poller.record_poll(process_new_rows(poller, row_state))
+        except Exception as e:
+            poller.record_error()
+            print(f"エラー発生: {e}")
+            print(f"{poller.interval:.1f}秒後に再試行します。")
+
+        time.sleep(poller.interval)
+
+def run_push(poller, row_state):
+    """
+    Webhook で受け取った行をすぐに印刷し、poller.interval ごとにポーリングで取りこぼしを照合する。
+    行の状態ストアはこのスレッドだけが更新する (受信スレッドからはキューで受け渡す)。
+    """
+    received = queue.Queue()
+    retry_at = 0 # 送信に失敗した後は、この時刻まで Webhook の行を送らずに照合のポーリングに任せる
+    start_webhook_server(
+        WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET,
+        on_row=lambda row_index, row_data_list: received.put((row_index, row_data_list)),
+        is_done=row_state.is_done
+    )
+    print("--- Webhook の受信を開始します (起動時と定期的にポーリングで照合します) ---")
+    next_reconcile = time.monotonic()
+    while True:
+        try:
+            rows = [received.get(timeout=max(0, next_reconcile - time.monotonic()))]
+        except queue.Empty:
+            try:
+                poller.record_poll(process_new_rows(poller, row_state))
+            except Exception as e:
+                poller.record_error()
+                retry_at = time.monotonic() + poller.interval
+                print(f"照合のポーリングでエラー発生: {e}")
+            next_reconcile = time.monotonic() + poller.interval
+            continue
+        # 同時に届いた行はまとめて送信する
+        while not received.empty():
+            rows.append(received.get_nowait())
+        print(f"Webhook で新しい行を受け取りました: {[row_index for row_index, _ in rows]}")
+        if time.monotonic() < retry_at:
+            print("直前に送信に失敗したため、次回の照合で送信します。")
+            continue
+        try:
+            process_rows(rows, row_state)
+        except Exception as e:
+            poller.record_error()
+            retry_at = time.monotonic() + poller.interval
+            next_reconcile = min(next_reconcile, retry_at)
+            print(f"エラー発生: {e} ({poller.interval:.1f}秒後の照合で再送します)")
 
 # --- メイン処理 ---
 def main():
-    global last_processed_row_count
-
     if SPREADSHEET_ID == 'YOUR_SPREADSHEET_ID_HERE':
         print("エラー: local_config.py の SPREADSHEET_ID を GoogleスプレッドシートのIDに置き換えてください。")
         return
 
+    if WEBHOOK_PORT and not WEBHOOK_SECRET:
+        print("エラー: プッシュモード (WEBHOOK_PORT) を使う場合は local_config.py に WEBHOOK_SECRET を設定してください。")
+        return
+
     print("Googleフォーム新規メッセージ印刷アプリケーションを開始します。")
-    print(f"ポーリング間隔: {POLLING_INTERVAL_SECONDS}秒")
+    if WEBHOOK_PORT:
+        print(f"プッシュモード: 照合のポーリング間隔 {RECONCILE_INTERVAL_SECONDS}秒")
+    else:
+        print(f"ポーリング間隔: {POLLING_MIN_INTERVAL_SECONDS}〜{POLLING_MAX_INTERVAL_SECONDS}秒")
     print(f"スプレッドシートID: {SPREADSHEET_ID}")
     print(f"監視レンジ: {RANGE_NAME}")
 
@@ -139,53 +294,32 @@ def main():
         print(f"Google Sheets API の認証に失敗しました。認証情報ファイルを確認してください: {e}")
         return
 
-    printed_row_indices = load_printed_row_indices()
-    print(f"これまでに印刷済みの行: {sorted(list(printed_row_indices))}")
-
-    print("初回データ取得と未印刷メッセージの確認を開始します...")
-    all_rows = get_spreadsheet_data(sheets_service, SPREADSHEET_ID, RANGE_NAME)
-    if all_rows:
-        for i, row_data_list in enumerate(all_rows):
-            current_row_index = i + 1
-            if current_row_index not in printed_row_indices:
-                if row_data_list and row_data_list[0]: # データが存在し、かつ空でないことを確認
-                    print(f"未印刷の新規メッセージを検知しました (行番号: {current_row_index})")
-                    print_answer(row_data_list, current_row_index, printed_row_indices)
-                else:
-                    print(f"行 {current_row_index} は空またはメッセージがありません。スキップします。")
-            else:
-                print(f"行 {current_row_index} は既に印刷済みです。")
-        last_processed_row_count = len(all_rows)
-    else:
-        print("スプレッドシートにデータがありません。")
-
-    print("--- 定期ポーリングを開始します ---")
-    while True:
-        try:
-            current_rows = get_spreadsheet_data(sheets_service, SPREADSHEET_ID, RANGE_NAME)
-            current_row_count = len(current_rows)
-
-            if current_row_count > last_processed_row_count:
-                print(f"新しいメッセージを検知しました: {current_row_count - last_processed_row_count}件")
-                for i in range(last_processed_row_count, current_row_count):
-                    row_data_list = current_rows[i]
-                    current_row_index = i + 1
-                    if current_row_index not in printed_row_indices:
-                        if row_data_list and row_data_list[0]: # データが存在し、かつ空でないことを確認
-                            print_answer(row_data_list, current_row_index, printed_row_indices)
-                        else:
-                            print(f"行 {current_row_index} は空またはメッセージがありません。スキップします。")
-                    else:
-                        print(f"重複検知: 行 {current_row_index} は既に印刷済みとして記録されています。")
-                last_processed_row_count = current_row_count
-            else:
-                print(f"新しいメッセージはありません。現在の回答数: {current_row_count}")
+    row_state = RowStateStore(
+        ROW_STATE_FILE, legacy_rows_file=PRINTED_ROWS_FILE, legacy_cursor_file=LEGACY_CURSOR_FILE,
+        first_row=range_start_row(RANGE_NAME)
+    )
+    if row_state.sent:
+        print(f"前回 ACK を受け取れなかった行: {sorted(row_state.sent)} (再送します)")
 
-        except Exception as e:
-            print(f"エラー発生: {e}")
-            print("次のポーリングで再試行します。")
+    if WEBHOOK_PORT:
+        # 照合は一定間隔で行う (エラー時のみバックオフで間隔が変わる)
+        poller = SheetPoller(
+            sheets_service, SPREADSHEET_ID, RANGE_NAME, row_state,
+            min_interval=RECONCILE_INTERVAL_SECONDS,
+            max_interval=RECONCILE_INTERVAL_SECONDS
+        )
+    else:
+        poller = SheetPoller(
+            sheets_service, SPREADSHEET_ID, RANGE_NAME, row_state,
+            min_interval=POLLING_MIN_INTERVAL_SECONDS,
+            max_interval=POLLING_MAX_INTERVAL_SECONDS
+        )
+    print(f"処理済みの行: {poller.cursor} (行 {poller.cursor + 1} 以降を監視します)")
 
-        time.sleep(POLLING_INTERVAL_SECONDS)
+    if WEBHOOK_PORT:
+        run_push(poller, row_state)
+    else:
+        run_polling(poller, row_state)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+STATE_VERSION = 1
+
+def _to_runs(rows) -> list:
+    """行番号の集合を連続区間のリスト [[開始, 終了], ...] にする"""
+    runs = []
+    for row in sorted(rows):
+        if runs and row == runs[-1][1] + 1:
+            runs[-1][1] = row
+        else:
+            runs.append([row, row])
+    return runs
+
+def _from_runs(runs) -> set:
+    return {row for start, end in runs for row in range(start, end + 1)}
+
+class RowStateStore:
+    """
+    スプレッドシートの行ごとの印刷状態を保存するストア。
+    - high_water_mark: この行番号までのすべての行は処理済み (印刷サーバーが受け付けた、拒否した、または空の行)
+    - acknowledged: high_water_mark より後で処理済みの行 (途中の行の送信に失敗した場合などに残る例外)
+    - sent: 印刷サーバーに送信したが、受け付けの ACK をまだ受け取っていない行
+    ファイルには行番号を連続区間で保存するため、印刷した行数が増えてもサイズと読み込み時間はほとんど変わらない。
+    保存は一時ファイルに書き込んでから置き換えるため、途中で停止しても直前の状態が残る。
+    sent のまま再起動した行は、同じ idempotency_key で再送すればサーバー側で二重に印刷されない。
+    high_water_mark はポーリングのカーソルとしても使う (この行より後だけを取得する)。
+    """
+    def __init__(self, path: str, legacy_rows_file: str = None, legacy_cursor_file: str = None, first_row: int = 1):
+        """
+        :param path: 状態を保存するファイル
+        :param legacy_rows_file: 以前の形式 (印刷済みの行番号を1行ずつ追記したファイル)。
+                                 状態ファイルがない場合に一度だけ取り込み、".migrated" を付けて名前を変える
+        :param legacy_cursor_file: 以前の形式のカーソル (処理済みの行数) のファイル。取り込み方は legacy_rows_file と同じ
+        :param first_row: 監視する範囲 (RANGE_NAME) の開始行。これより前の行 (見出し行など) は処理済みとみなす。
+                          legacy_rows_file の行番号は範囲の開始行を 1 とする番号のため、取り込む際にシートの行番号に直す
+        """
+        self.path = path
+        self.high_water_mark = first_row - 1
+        self.acknowledged = set()
+        self.sent = set()
+        if os.path.exists(path):
+            self._load()
+        else:
+            self._migrate(legacy_rows_file, legacy_cursor_file, first_row - 1)
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            state = json.load(f)
+        self.high_water_mark = max(self.high_water_mark, state.get("high_water_mark", 0))
+        self.acknowledged = {row for row in _from_runs(state.get("acknowledged", [])) if row > self.high_water_mark}
+        self._compact()
+        self.sent = _from_runs(state.get("sent", []))
+
+    def _migrate(self, legacy_rows_file: str, legacy_cursor_file: str, row_offset: int):
+        migrated = []
+        if legacy_cursor_file and os.path.exists(legacy_cursor_file):
+            with open(legacy_cursor_file, 'r') as f:
+                value = f.read().strip()
+            if value.isdigit():
+                self.high_water_mark = max(self.high_water_mark, int(value))
+            migrated.append(legacy_cursor_file)
+        if legacy_rows_file and os.path.exists(legacy_rows_file):
+            with open(legacy_rows_file, 'r') as f:
+                rows = {int(line.strip()) + row_offset for line in f if line.strip().isdigit()}
+            self.acknowledged = {row for row in rows if row > self.high_water_mark}
+            migrated.append(legacy_rows_file)
+        if not migrated:
+            return
+        self._compact()
+        self.save()
+        for file_path in migrated:
+            os.replace(file_path, file_path + ".migrated")
+        print(f"以前の形式の印刷済み行を取り込みました: {migrated} (処理済み: 行 {self.high_water_mark} まで + {len(self.acknowledged)}行)")
+
+    def _compact(self):
+        """high_water_mark の直後から連続して処理済みの行を high_water_mark に繰り込む"""
+        while self.high_water_mark + 1 in self.acknowledged:
+            self.high_water_mark += 1
+            self.acknowledged.discard(self.high_water_mark)
+
+    def is_done(self, row_index: int) -> bool:
+        """印刷サーバーが受け付けた (または拒否した、空のためスキップした) 行かどうか"""
+        return row_index <= self.high_water_mark or row_index in self.acknowledged
+
+    def mark_sent(self, rows):
+        """印刷サーバーに送信する行を記録する (送信前に save すること)"""
+        self.sent.update(row for row in rows if not self.is_done(row))
+
+    def mark_acknowledged(self, rows):
+        """印刷サーバーが受け付けた行を記録する"""
+        for row in rows:
+            self.sent.discard(row)
+            if row > self.high_water_mark:
+                self.acknowledged.add(row)
+        self._compact()
+
+    def mark_skipped(self, rows):
+        """印刷する内容がない行を処理済みとして記録する"""
+        self.mark_acknowledged(rows)
+
+    def mark_rejected(self, rows):
+        """
+        印刷サーバーが拒否した (再送しても受け付けられない) 行を処理済みとして記録する。
+        処理済みにしないとカーソルがその行で止まり、以降のポーリングで後ろの行をすべて取得し直すことになる。
+        """
+        self.mark_acknowledged(rows)
+
+    def save(self):
+        """状態を一時ファイルに書き込んでから置き換える"""
+        state = {
+            "version": STATE_VERSION,
+            "high_water_mark": self.high_water_mark,
+            "acknowledged": _to_runs(self.acknowledged),
+            "sent": _to_runs(self.sent),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import random
+import re
+
+# RANGE_NAME の形式: "シート1!B:B" / "'フォームの回答 1'!B2:C" / "B2:C100" / "B:B"
+_RANGE_PATTERN = re.compile(
+    r"^(?:(?P<sheet>.+)!)?(?P<start_col>[A-Za-z]+)(?P<start_row>\d*)(?::(?P<end_col>[A-Za-z]+)(?P<end_row>\d*))?$")
+
+def range_start_row(range_name: str) -> int:
+    """RANGE_NAME の開始行 (例: "B2:C" なら 2、行番号の指定がなければ 1) を返す"""
+    match = _RANGE_PATTERN.match(range_name)
+    if not match:
+        raise ValueError(f"Unsupported RANGE_NAME: {range_name}")
+    return int(match.group('start_row') or 1)
+
+class SheetPoller:
+    """
+    スプレッドシートの新しい行だけを取得するポーラー。
+    - 行の状態ストア (RowStateStore) の high_water_mark をカーソルとし、"B{カーソル+1}:B" のようにカーソルより後の行だけを要求する
+      (シートが大きくなっても1回のポーリングで転送するデータ量と API の負荷は増えない)
+    - ポーリング間隔は、新しい行があった直後は min_interval、新しい行がない間は倍々に延ばして最大 max_interval
+    - API のエラー時は指数的に間隔を延ばし、ゆらぎ (ジッター) を加えて再試行する
+    """
+    def __init__(self, service, spreadsheet_id: str, range_name: str, state,
+                 min_interval: float = 5, max_interval: float = 60):
+        """
+        :param service: Google Sheets API のサービスオブジェクト (service.spreadsheets().values().get() を使う)
+        :param spreadsheet_id: スプレッドシートID
+        :param range_name: 監視する列の範囲 (例: "シート1!B2:B")。開始行より前の行 (見出し行など) は取得しない
+        :param state: 行の状態ストア (RowStateStore)。high_water_mark までの行は処理済みとして取得しない
+        :param min_interval: 新しい行があった直後のポーリング間隔 (秒)
+        :param max_interval: 新しい行がない場合やエラー時のポーリング間隔の上限 (秒)
+        """
+        match = _RANGE_PATTERN.match(range_name)
+        if not match:
+            raise ValueError(f"Unsupported RANGE_NAME: {range_name}")
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_prefix = f"{match.group('sheet')}!" if match.group('sheet') else ""
+        self.start_col = match.group('start_col').upper()
+        self.end_col = (match.group('end_col') or match.group('start_col')).upper()
+        self.start_row = int(match.group('start_row') or 1)
+        # 終了行 (例: "B2:C100" なら 100、"B2" のように1つのセルなら 2)。指定がなければ None (シートの最後まで)
+        if match.group('end_row'):
+            self.end_row = int(match.group('end_row'))
+        elif match.group('end_col') is None and match.group('start_row'):
+            self.end_row = self.start_row
+        else:
+            self.end_row = None
+        self.state = state
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.errors = 0
+
+    @property
+    def cursor(self) -> int:
+        """処理済みの最後の行 (範囲の開始行より前は処理済みとみなす)"""
+        return max(self.state.high_water_mark, self.start_row - 1)
+
+    def fetch_new_rows(self) -> list:
+        """
+        カーソルより後の行を取得する (範囲に終了行がある場合はその行まで)。
+        返り値: [(シートの行番号 (1から始まる), 行のデータのリスト), ...]。空の行は空のリストになる
+        """
+        cursor = self.cursor
+        if self.end_row is not None and cursor >= self.end_row:
+            return [] # 範囲内の行はすべて処理済み
+        range_name = f"{self.sheet_prefix}{self.start_col}{cursor + 1}:{self.end_col}{self.end_row or ''}"
+        result = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=range_name).execute()
+        return [(cursor + 1 + i, row) for i, row in enumerate(result.get('values', []))]
+
+    def record_poll(self, found_rows: bool):
+        """ポーリングの結果から次の間隔を決める"""
+        self.errors = 0
+        if found_rows:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def record_error(self):
+        """API エラー後の再試行の間隔を決める (指数バックオフ + ジッター)"""
+        self.errors += 1
+        backoff = min(self.min_interval * (2 ** self.errors), self.max_interval)
+        self.interval = backoff * random.uniform(0.5, 1.0)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# フォーム送信時のトリガーから新しい回答を受け取る Webhook の受信サーバー (プッシュモード)。
+# リクエストのボディは JSON: {"row": 行番号 (1から始まる), "values": [RANGE_NAME の列の値, ...]}
+#   ("values" の代わりに "message": "メッセージ内容" でもよい)
+# ボディの HMAC-SHA256 を共有シークレットで計算し、"X-Signature: sha256=<16進数>" ヘッダーに付けて送る。
+#
+# Google Apps Script のフォーム送信トリガー (スプレッドシート側) の例:
+#   function onFormSubmit(e) {
+#     var body = JSON.stringify({row: e.range.getRow(), values: [e.values[1]]});
+#     var mac = Utilities.computeHmacSha256Signature(body, SECRET, Utilities.Charset.UTF_8);
+#     var hex = mac.map(function (b) { return ('0' + (b & 0xFF).toString(16)).slice(-2); }).join('');
+#     UrlFetchApp.fetch(WEBHOOK_URL, {method: 'post', contentType: 'application/json', payload: body,
+#                                     headers: {'X-Signature': 'sha256=' + hex}});
+#   }
+# 手元で試す場合は send_fake_trigger (またはこのファイルをスクリプトとして実行) で同じリクエストを送れる。
+
+import hashlib
+import hmac
+import json
+import sys
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIGNATURE_HEADER = "X-Signature"
+WEBHOOK_PATH = "/forms"
+MAX_BODY_SIZE = 64 * 1024 # フォームの回答1件としては十分な大きさ
+
+def sign_payload(secret: str, body: bytes) -> str:
+    """ボディの署名 ("sha256=<16進数>") を返す"""
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+def verify_signature(secret: str, body: bytes, signature: str) -> bool:
+    """署名がボディと共有シークレットに一致するかどうか (比較は一定時間で行う)"""
+    return bool(signature) and hmac.compare_digest(sign_payload(secret, body), signature)
+
+def _parse_payload(body: bytes):
+    """ボディから (行番号, 行のデータのリスト) を取り出す。形式が正しくない場合は ValueError"""
+    payload = json.loads(body.decode("utf-8"))
+    if not isinstance(payload, dict):
+        raise ValueError("Payload must be a JSON object.")
+    row_index = payload.get("row")
+    if not isinstance(row_index, int) or isinstance(row_index, bool) or row_index < 1:
+        raise ValueError("'row' must be a positive integer.")
+    values = payload.get("values")
+    if values is None and "message" in payload:
+        values = [payload["message"]]
+    if not isinstance(values, list):
+        raise ValueError("'values' must be a list.")
+    return row_index, [str(value) for value in values]
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    """
+    POST /forms   署名付きの新しい回答を受け取り、すぐに on_row に渡す。
+                  返り値: 202 {"status": "queued"} / 処理済みの行の場合は 200 {"status": "duplicate"} /
+                          署名が不正な場合は 401、形式 (または Content-Length) が不正な場合は 400
+    """
+    secret = None
+    on_row = None # (行番号, 行のデータのリスト) を受け取る関数
+    is_done = None # 行番号が処理済みかどうかを返す関数
+
+    def log_message(self, format, *args):
+        print(f"Webhook {self.address_string()} - {format % args}")
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != WEBHOOK_PATH:
+            self._send_json(404, {"status": "rejected", "error": "not found"})
+            return
+        length = self.headers.get("Content-Length") or "0"
+        if not length.strip().isdigit():
+            self.close_connection = True
+            self._send_json(400, {"status": "rejected", "error": "invalid Content-Length"})
+            return
+        length = int(length)
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            self._send_json(413, {"status": "rejected", "error": "payload too large"})
+            return
+        body = self.rfile.read(length)
+        if not verify_signature(self.secret, body, self.headers.get(SIGNATURE_HEADER, "")):
+            print("署名が一致しない Webhook リクエストを拒否しました。")
+            self._send_json(401, {"status": "rejected", "error": "invalid signature"})
+            return
+        try:
+            row_index, row_data_list = _parse_payload(body)
+        except ValueError as e: # JSONDecodeError / UnicodeDecodeError を含む
+            self._send_json(400, {"status": "rejected", "error": str(e)})
+            return
+        if self.is_done(row_index):
+            self._send_json(200, {"status": "duplicate", "row": row_index})
+            return
+        self.on_row(row_index, row_data_list)
+        self._send_json(202, {"status": "queued", "row": row_index})
+
+def start_webhook_server(host: str, port: int, secret: str, on_row, is_done) -> ThreadingHTTPServer:
+    """
+    Webhook の受信サーバーをバックグラウンドスレッドで起動する。
+    :param secret: 署名の検証に使う共有シークレット
+    :param on_row: 受け取った行を渡す関数 on_row(行番号, 行のデータのリスト)。受信スレッドから呼ばれる
+    :param is_done: 行番号が処理済みかどうかを返す関数 (処理済みの行は on_row に渡さない)
+    """
+    handler = type("WebhookHandler", (_WebhookHandler,), {
+        "secret": secret, "on_row": staticmethod(on_row), "is_done": staticmethod(is_done),
+    })
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Webhook を待ち受けています: http://{host}:{port}{WEBHOOK_PATH}")
+    return httpd
+
+def send_fake_trigger(url: str, secret: str, row_index: int, message: str) -> dict:
+    """フォーム送信トリガーの代わりに、署名付きの回答を Webhook に送信する (動作確認用)"""
+    body = json.dumps({"row": row_index, "values": [message]}).encode("utf-8")
+    request = urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        SIGNATURE_HEADER: sign_payload(secret, body),
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read() or b"{}")
+
+if __name__ == '__main__':
+    # 使い方: python webhook.py <URL> <共有シークレット> <行番号> <メッセージ>
+    if len(sys.argv) != 5:
+        print("使い方: python webhook.py http://127.0.0.1:8765/forms <共有シークレット> <行番号> <メッセージ>")
+        sys.exit(1)
+    print(send_fake_trigger(sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]))